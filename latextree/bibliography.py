@@ -14,6 +14,7 @@ from node import LatexTreeNode
 from content import Text
 
 class BibItem(LatexTreeNode):
+    __slots__ = ()
 
     def __init__(self):
         LatexTreeNode.__init__(self)
@@ -87,6 +88,7 @@ class BibItem(LatexTreeNode):
         return '%s (%s) %s. %s.' % (author, year, title, publisher)
 
 class Bibliography(LatexTreeNode):
+    __slots__ = ()
     
     def __init__(self, text):
         LatexTreeNode.__init__(self)
@@ -0,0 +1,283 @@
+"""
+cache.py
+On-disk cache of parsed LatexTree subtrees.
+
+LatexParser splits the body of a document into shards at top-level
+\chapter (or \section) commands and parses each shard separately.
+The parsed subtree of each shard is stored under a key computed from the
+shard source and a version string that changes whenever the modules that
+build the tree change. Unchanged shards are loaded from the cache and only
+the post-processing (numbers, titles, xrefs) is run on the whole document.
+
+Subtrees are stored as flat lists of records in pre-order
+    (class names, attributes, number of children)
+where class names lists the name of the node class followed by the names
+of its base classes (e.g. ['Chapter', 'Level', 'Macro']), so that
+classes are looked up by name when the subtree is loaded. The number and
+title attributes are not stored because they are recomputed after every
+parse.
+
+Node classes and subtrees are pickled in the same way (see 
+LatexTreeNode.__reduce__): classes by name (get_named_class) and 
+subtrees as flat tables (pack_tree, unpack_tree), so that generated 
+classes can be unpickled in other processes and deep trees do not hit 
+the recursion limit.
+"""
+
+import os, hashlib, tempfile
+import cPickle as pickle
+
+import logging
+logger = logging.getLogger(__name__)
+
+# bump when the record format changes
+FORMAT_VERSION = 1
+
+# modules whose source determines the parse tree
+VERSION_MODULES = ('taxonomy', 'macrosdef', 'preprocessor', 'walker', 'tokenizer', 'factory', 'registry', 'node', 'content', 'tabular', 'bibliography', 'parser')
+
+# attributes recomputed after parsing
+DERIVED_ATTRIBUTES = ('node_id', 'parent', 'children', 'number', 'title', 'index', 'pre', 'post', 'depth', 'child_index')
+
+_version = None
+
+
+def get_version():
+    '''
+    Version string for cache keys: a hash of the source of the modules
+    that build the tree (computed once per process).
+    '''
+    global _version
+    if _version is None:
+        sha = hashlib.sha1(str(FORMAT_VERSION))
+        for name in VERSION_MODULES:
+            module = __import__(name, globals())
+            filename = os.path.splitext(module.__file__)[0] + '.py'
+            with open(filename, 'rb') as f:
+                sha.update(f.read())
+        _version = sha.hexdigest()
+    return _version
+
+
+def get_class_names(cls):
+    '''
+    Names of cls and its (first) base classes, ending with LatexTreeNode.
+    '''
+    names = []
+    while cls is not object:
+        names.append(cls.__name__)
+        cls = cls.__bases__[0]
+    return names
+
+
+_slot_names = {}
+
+def get_attributes(node):
+    '''
+    Stored attributes of a node: slots (and __dict__ entries, if any) 
+    that are set and not derived.
+    '''
+    cls = node.__class__
+    if cls not in _slot_names:
+        _slot_names[cls] = [key for klass in cls.__mro__ for key in klass.__dict__.get('__slots__', ()) if key not in DERIVED_ATTRIBUTES]
+    attrs = dict([(key, value) for key, value in getattr(node, '__dict__', {}).items() if key not in DERIVED_ATTRIBUTES])
+    for key in _slot_names[cls]:
+        value = getattr(node, key, None)
+        if value is not None:
+            attrs[key] = value
+    return attrs
+
+
+def dump_tree(root):
+    '''
+    Flatten the subtree at root into a list of records (pre-order).
+    '''
+    records = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        records.append((get_class_names(node.__class__), get_attributes(node), len(node.children)))
+        stack.extend(reversed(node.children))
+    return records
+
+
+def resolve_class(names, classes, resolved=None):
+    '''
+    Find the class with the given class names (see get_class_names) in
+    classes (a dict) or, if it is not found, in the NodeFactory registry
+    (see factory.ClassCache). resolved is a dict of earlier results.
+    '''
+    from factory import node_classes
+    names = tuple(names)
+    if resolved is None:
+        resolved = {}
+    if names not in resolved:
+        cls = classes.get(names[0])
+        if cls is None or get_class_names(cls) != list(names):
+            cls = node_classes.get_class(names[0], BaseClass=resolve_class(names[1:], classes, resolved))
+        resolved[names] = cls
+    return resolved[names]
+
+
+def get_named_class(names, resolved=None):
+    '''
+    Node class with the given class names (see get_class_names), looked up
+    in registry.NAMED_CLASSES (see resolve_class). Node classes are pickled 
+    as calls to this function.
+    '''
+    from registry import NAMED_CLASSES
+    return resolve_class(names, NAMED_CLASSES, resolved)
+
+
+def build_tree(records):
+    '''
+    Create the nodes of a subtree from (class, attributes, number of 
+    children) records in pre-order. Returns the list of nodes (pre-order).
+    '''
+    from node import LatexTreeNode
+
+    nodes = []
+    parents = []
+    for cls, attrs, num_children in records:
+        node = cls.__new__(cls)
+        LatexTreeNode.__init__(node)
+        for key, value in attrs.items():
+            setattr(node, key, value)
+        if parents:
+            parents[-1][0].append_child(node)
+            parents[-1][1] -= 1
+            if not parents[-1][1]:
+                parents.pop()
+        nodes.append(node)
+        if num_children:
+            parents.append([node, num_children])
+    return nodes
+
+
+def load_tree(records, classes):
+    '''
+    Rebuild a subtree from a list of records. Node classes are looked up by
+    name (see resolve_class).
+    '''
+    resolved = {}
+    nodes = build_tree([(resolve_class(names, classes, resolved), attrs, num_children) for names, attrs, num_children in records])
+    return nodes[0] if nodes else None
+
+
+def pack_tree(root):
+    '''
+    Flatten the subtree at root for pickling. Returns (class names, records)
+    where class names lists the class names (see get_class_names) of each
+    node class in the subtree once, and records are
+        (position in class names, attributes, number of children)
+    in pre-order. Unlike dump_tree, the number of each node is kept and its
+    title is stored as the position of the title node (if it is in the 
+    subtree).
+    '''
+    class_names = []
+    class_positions = {}
+    positions = {}
+    titled = []
+    records = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        cls = node.__class__
+        if cls not in class_positions:
+            class_positions[cls] = len(class_names)
+            class_names.append(get_class_names(cls))
+        attrs = get_attributes(node)
+        if node.number is not None:
+            attrs['number'] = node.number
+        if node.title is not None:
+            titled.append((attrs, node.title))
+        positions[id(node)] = len(records)
+        records.append((class_positions[cls], attrs, len(node.children)))
+        stack.extend(reversed(node.children))
+    for attrs, title in titled:
+        if id(title) in positions:
+            attrs['title'] = positions[id(title)]
+    return class_names, records
+
+
+def unpack_tree(class_names, records):
+    '''
+    Rebuild a subtree flattened by pack_tree. Returns the root node.
+    '''
+    resolved = {}
+    classes = [get_named_class(names, resolved) for names in class_names]
+    nodes = build_tree([(classes[position], attrs, num_children) for position, attrs, num_children in records])
+    for node in nodes:
+        if node.title is not None:
+            node.title = nodes[node.title]
+    return nodes[0] if nodes else None
+
+
+class ParseCache(object):
+    '''
+    Directory of pickled subtrees.
+        path - cache directory (created if necessary)
+        version - version string included in every key (see get_version)
+        hits, misses - lookup counts
+    '''
+    def __init__(self, path, version=None):
+        self.path = os.path.abspath(path)
+        self.version = version or get_version()
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def __repr__(self):
+        return '%s(%s, %d hits, %d misses)' % (self.__class__.__name__, self.path, self.hits, self.misses)
+
+    def get_key(self, *parts):
+        '''
+        Hash the version and the given strings.
+        '''
+        sha = hashlib.sha1(self.version)
+        for part in parts:
+            if isinstance(part, unicode):
+                part = part.encode('utf-8')
+            sha.update(str(len(part)) + ':' + part)
+        return sha.hexdigest()
+
+    def get_filename(self, key):
+        return os.path.join(self.path, key + '.pickle')
+
+    def get(self, key):
+        '''
+        Return the records stored under key, or None.
+        '''
+        filename = self.get_filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                records = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return records
+
+    def put(self, key, records):
+        '''
+        Store records under key. The file is written under a temporary
+        name and renamed, so concurrent readers never see partial files.
+        '''
+        handle, temp_filename = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                pickle.dump(records, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_filename, self.get_filename(key))
+        except (IOError, OSError):
+            logger.warning('Cannot write to parse cache %s', self.path)
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+
+    def clear(self):
+        '''
+        Remove all entries.
+        '''
+        for name in os.listdir(self.path):
+            if name.endswith('.pickle'):
+                os.remove(os.path.join(self.path, name))
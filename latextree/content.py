@@ -25,6 +25,8 @@ class Content(LatexTreeNode):
     Image and Media objects are given a "width" attribute (hack)
     Tabular objects are given a "colspec" attribute (hack)
     '''
+    __slots__ = ()
+
 
     def __init__(self):
         LatexTreeNode.__init__(self)
@@ -35,7 +37,7 @@ class Content(LatexTreeNode):
         '''
         s = []
         s.append('%s(' % self.__class__.__name__)
-        if hasattr(self, 'content') and self.content:
+        if self.content:
             preview = self.content
             preview_length = 23
             if len(preview) > preview_length:
@@ -50,7 +52,7 @@ class Content(LatexTreeNode):
         '''
         s = []
         s.append('<span class="%s">' % self.get_node_type())
-        if hasattr(self, 'content') and self.content:
+        if self.content:
             s.append(self.content)
         for child in self.children:
             s.append(child.html())
@@ -64,6 +66,7 @@ class Url(Content):
     Content node for external hyperlinks.
     Argument: `url` 
     '''
+    __slots__ = ()
     def __init__(self, url=None):
         Content.__init__(self)
         self.content = url
@@ -77,6 +80,7 @@ class Xref(Content):
     Content node for internal cross-references.
     Argument: `label` 
     '''
+    __slots__ = ()
     def __init__(self, label=None):
         Content.__init__(self)
         self.content = label
@@ -90,6 +94,7 @@ class Image(Content):
     Content node for images (file name).
     Argument: `src` 
     '''
+    __slots__ = ()
     def __init__(self, src=None):
         Content.__init__(self)
         self.content = src
@@ -103,6 +108,7 @@ class Media(Content):
     Content node for videos (url).
     Argument: `src` 
     '''
+    __slots__ = ()
     def __init__(self, src=None):
         Content.__init__(self)
         self.content = src
@@ -117,6 +123,7 @@ class Latex(Content):
     Content node for latex markup.
     Argument: `latex` 
     '''
+    __slots__ = ()
     def __init__(self, latex=None):
         Content.__init__(self)
         self.content = latex
@@ -130,6 +137,7 @@ class Comment(Content):
     Content node for comments.
     Argument: `comment` 
     '''
+    __slots__ = ()
     def __init__(self, comment=None):
         Content.__init__(self)
         self.content = comment
@@ -143,6 +151,7 @@ class Text(Content):
     Content node for plain text.
     Argument: `text` 
     '''
+    __slots__ = ()
     def __init__(self, text=None):
         Content.__init__(self)
         self.content = text
@@ -155,6 +164,7 @@ class Points(Content):
     Content node for points (marks available for a question)
     Argument: `points` 
     '''
+    __slots__ = ()
     def __init__(self, value=None):
         Content.__init__(self)
         self.content = value
@@ -173,6 +183,7 @@ class LatexTreeLink(LatexTreeNode):
     The URL can point to any web resource (e.g. webpage, image, video clip, elements within a webpage)
     Perhaps ctree2html could include these within iframes. 
     '''
+    __slots__ = ('source', 'destination')
     def __init__(self, destination=None):
         LatexTreeNode.__init__(self)
         self.source = source            # anchor LatexTreeNode
@@ -181,15 +192,38 @@ class LatexTreeLink(LatexTreeNode):
     def __repr__(self):
         s = []
         s.append('%s(' % self.__class__.__name__)
-        if hasattr(self, 'source') and self.source:
+        if self.source:
             s.append(repr(self.source))
-        if hasattr(self, 'destination') and self.destination:
+        if self.destination:
             s.append(', ')
             s.append(repr(self.destination))
         s.append(')')
         return ''.join(s)
 
 
+# catch-all classes (created by the parser)
+class Title(LatexTreeNode):
+    ''' 
+    This neds to be defined as a LatexTreeContent node. The chilren contain
+    the title and content attribute set to equal a short tile (as specified
+    by an optional argument: \chapter[short title]{full title}    
+    cases: level, theorem, float (caption)
+    '''
+    __slots__ = ()
+    def __init__(self):
+        LatexTreeNode.__init__(self)
+
+class Break(LatexTreeNode):
+    __slots__ = ()
+    def __init__(self):
+        LatexTreeNode.__init__(self)
+
+class Space(LatexTreeNode):
+    __slots__ = ()
+    def __init__(self):
+        LatexTreeNode.__init__(self)
+
+
 #------------------------------------------------
 def main():
     print "content.py"
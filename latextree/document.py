@@ -18,13 +18,18 @@ Example
 >>> doc = pa.parse_latex_file(filename)
 
 # extract all quizzes
->>> doc.root.get_phenotypes('quiz')
+>>> doc.find_all('quiz')
+
+# save a snapshot and load it again (without parsing)
+>>> doc.save('main.ltree')
+>>> doc = LatexDocument.load('main.ltree')
 """
 
 import os
 from jinja2 import Environment, FileSystemLoader
 
 import settings
+from index import DocumentIndex
 
 import logging
 logger = logging.getLogger(__name__)
@@ -51,19 +56,121 @@ class LatexDocument(object):
     def __init__(self, 
                 filename=None,
                 text=None, 
-                head=dict(), 
-                preamble=dict(), 
-                newcommands=list(), 
-                xrefs=dict(), 
+                head=None, 
+                preamble=None, 
+                newcommands=None, 
+                xrefs=None, 
                 root=None, 
         ):
         self.filename = filename
         self.text = text
-        self.head = head
-        self.preamble = preamble
-        self.newcommands = newcommands
+        self.head = head if head is not None else {}
+        self.preamble = preamble if preamble is not None else {}
+        self.newcommands = newcommands if newcommands is not None else []
+        self._root = None
+        self.index = DocumentIndex()
+        self.root = root
+        self.xrefs = xrefs if xrefs is not None else {}
+
+        # collected by LatexPostProcessor (see postprocessor.py)
+        self.images = []
+        self.videos = []
+        self.quizzes = []
+        self.bibliography = None
+        self.enclosing = {}
+        self.postprocessor = None
+
+        # (hash, top-level nodes, root label) for each shard of the body (set by LatexParser)
+        self.shards = []
+
+    def get_root(self):
+        return self._root
+
+    def set_root(self, root):
+        '''
+        Set the root node and index the tree (see index.py).
+        '''
+        if root is not self._root or self.index.root is not root:
+            self._root = root
+            self.index = DocumentIndex(root)
+
+    root = property(get_root, set_root)
+
+    def __getstate__(self):
+        '''
+        Pickle the tree as a flat table (see LatexTreeNode.__reduce__) and
+        the nodes of each shard as positions in root.children. The index
+        and the attributes set by LatexPostProcessor are recomputed when
+        the document is unpickled.
+        '''
+        state = dict(self.__dict__)
+        for key in ('index', 'xrefs', 'images', 'videos', 'quizzes', 'bibliography', 'enclosing', 'postprocessor'):
+            del state[key]
+        children = self._root.children if self._root is not None else []
+        positions = dict([(id(node), idx) for idx, node in enumerate(children)])
+        state['shards'] = [(digest, [positions[id(node)] for node in nodes if id(node) in positions], label)
+            for digest, nodes, label in self.shards]
+        return state
+
+    def __setstate__(self, state):
+        from postprocessor import LatexPostProcessor
+        state = dict(state)
+        root = state.pop('_root')
+        shards = state.pop('shards')
+        self.__dict__.update(state)
+        self._root = None
+        self.index = DocumentIndex()
         self.root = root
-        self.xrefs = xrefs
+        children = root.children if root is not None else []
+        self.shards = [(digest, [children[idx] for idx in positions], label) for digest, positions, label in shards]
+        LatexPostProcessor().postprocess(self)
+
+    def save(self, filename, compression='zlib'):
+        '''
+        Write a binary snapshot of the document (see snapshot.py).
+        compression is None, 'zlib' or 'bz2'.
+        >>> doc.save('book.ltree')
+        '''
+        from snapshot import save_document
+        save_document(self, filename, compression=compression)
+
+    @staticmethod
+    def load(filename):
+        '''
+        Load a document from a snapshot written by save (no parsing).
+        Only plain values and the classes in snapshot.SAFE_GLOBALS are
+        unpickled from the file, and the parser is not imported.
+        >>> doc = LatexDocument.load('book.ltree')
+        '''
+        from snapshot import load_document
+        return load_document(filename)
+
+    def find_all(self, species=None, genus=None, within=None):
+        '''
+        List the nodes of the given species (or genus) in document order,
+        optionally only those in the subtree at within.
+        >>> doc.find_all('quiz')
+        >>> doc.find_all('equation', within=doc.by_label('sec:lists'))
+        '''
+        return self.index.find_all(species=species, genus=genus, within=within)
+
+    def by_label(self, label):
+        '''
+        Return the node with the given label, or None.
+        >>> doc.by_label('thm:zorn')
+        '''
+        return self.index.by_label(label)
+
+    def update(self, changed_files=None, parser=None, **kwargs):
+        '''
+        Reparse the chapters (or sections) affected by changes to the source
+        files. Returns the indices of the reparsed shards.
+        See LatexParser.update_latex_document.
+        '''
+        if parser is None:
+            from parser import LatexParser
+            parser = LatexParser()
+        return parser.update_latex_document(self, changed_files=changed_files, **kwargs)
 
         
     def make_website(self, copy_static=True, copy_figures=True, LATEX_ROOT=None, WEB_ROOT=None):
@@ -139,8 +246,8 @@ class LatexDocument(object):
             sections = [child for child in self.root.children if child.get_species() == 'section']
             context['sections'] = sections
             
-        # extract bibliography from level-one children
-        bibliography = next((child for child in self.root.children if child.get_species() == 'bibliography'), None)
+        # bibliography (if any)
+        bibliography = self.bibliography
         context['bibliography'] = bibliography
         
         #----------------------------------------------
@@ -156,14 +263,16 @@ class LatexDocument(object):
                 return 'bibliography.html'
             if node.get_genus() == 'document':
                 return 'index.html'
-            chap = node.get_enclosing_chapter()
-            sect = node.get_enclosing_section()
-            cno = chap.number if chap and hasattr(chap, 'number') else 0
-            sno = sect.number if sect and hasattr(sect, 'number') else 0
+            if node in self.enclosing:
+                chap, sect = self.enclosing[node]
+            else:
+                chap, sect = node.get_enclosing_chapter(), node.get_enclosing_section()
+            cno = chap.number if chap and chap.number else 0
+            sno = sect.number if sect and sect.number else 0
 
             url = (r'ch%02dsec%02d.html' % (cno, sno))
             if include_label:
-                if hasattr(node, 'label') and node.label:
+                if node.label:
                     url += ('#%s' % label)
             return url
 
@@ -362,7 +471,7 @@ class LatexDocument(object):
     
         #-------------------------
         # start: iterate over quizzes
-        quizzes = self.root.get_phenotypes('quiz')
+        quizzes = self.quizzes
         if quizzes:
             for quiz in quizzes:
                 
@@ -4,6 +4,9 @@ Created on Thu Apr 27 07:02:26 2017
 @author: scmde
 """
 
+import threading
+from collections import OrderedDict, namedtuple
+
 from node import LatexTreeNode
   
 def ClassFactory(name, argnames, BaseClass=LatexTreeNode):
@@ -17,36 +20,86 @@ def ClassFactory(name, argnames, BaseClass=LatexTreeNode):
                     % (key, self.__class__.__name__))
             setattr(self, key, value)
         BaseClass.__init__(self)
-    newclass = type(name.capitalize(), (BaseClass,),{"__init__": __init__})
+    newclass = type(name.capitalize(), (BaseClass,),{"__init__": __init__, "__slots__": tuple(argnames)})
     return newclass
 
+
+ClassCacheInfo = namedtuple('ClassCacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+class ClassCache(object):
+    '''
+    Bounded, thread-safe registry of generated node classes.
+    Classes are keyed by (class name, base class) so that nodes of the same
+    species share one class. When the registry is full the least recently 
+    used class is dropped (existing nodes keep their class).
+    '''
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.classes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return '%s(%d classes)' % (self.__class__.__name__, len(self.classes))
+
+    def __len__(self):
+        return len(self.classes)
+
+    def __contains__(self, key):
+        name, BaseClass = key
+        return (name.capitalize(), BaseClass) in self.classes
+
+    def __iter__(self):
+        '''
+        Iterate over (class name, base class) keys, least recently used first.
+        '''
+        with self.lock:
+            return iter(list(self.classes))
+
+    def get_class(self, name, BaseClass=LatexTreeNode):
+        '''
+        Return the class for name and BaseClass (created if necessary).
+        '''
+        key = (name.capitalize(), BaseClass)
+        with self.lock:
+            NodeClass = self.classes.pop(key, None)
+            if NodeClass is None:
+                self.misses += 1
+                NodeClass = ClassFactory(name, {}, BaseClass=BaseClass)
+                if len(self.classes) >= self.maxsize:
+                    self.classes.popitem(last=False)
+            else:
+                self.hits += 1
+            self.classes[key] = NodeClass
+        return NodeClass
+
+    def info(self):
+        return ClassCacheInfo(self.hits, self.misses, self.maxsize, len(self.classes))
+
+    def clear(self):
+        with self.lock:
+            self.classes.clear()
+            self.hits = self.misses = 0
+
+# classes generated by NodeFactory
+node_classes = ClassCache()
+
+
 def NodeFactory(name, BaseClass=LatexTreeNode):
     '''
     Factory for producing nodes of different classes
+    Classes are shared between nodes with the same name and BaseClass.
     '''
-    NodeClass = ClassFactory(name, {}, BaseClass=BaseClass)
+    NodeClass = node_classes.get_class(name, BaseClass=BaseClass)
     return NodeClass()
 
 #------------------------------------------------
 def main():
-    from node import Macro, Environment, Switch
-    import taxonomy as tax
-    
-    abstract_macro_classes = dict([(genus, ClassFactory(genus, {}, BaseClass=Macro)) for genus in tax.macros])
-    abstract_environment_classes = dict([(genus, ClassFactory(genus, {}, BaseClass=Environment)) for genus in tax.environments])
-    abstract_switch_classes = dict([(genus, ClassFactory(genus, {}, BaseClass=Switch)) for genus in tax.switches])
-
-    macro_classes = dict([(species, ClassFactory(species, {}, BaseClass=abstract_macro_classes[genus])) for genus in tax.macros for species in tax.macros[genus]])
-    environment_classes = dict([(species, ClassFactory(species, {}, BaseClass=abstract_environment_classes[genus])) for genus in tax.environments for species in tax.environments[genus]])
-    switch_classes = dict([(species, ClassFactory(species, {}, BaseClass=abstract_switch_classes[genus])) for genus in tax.switches for species in tax.switches[genus]])
-
-    classes = macro_classes.copy()
-    classes.update(environment_classes)
-    classes.update(switch_classes)
-
-    print classes
-    print abstract_switch_classes
-    print switch_classes
+    from registry import family_classes, genus_classes, species_classes
+    print family_classes
+    print genus_classes
+    print species_classes
     
 
 if __name__ == '__main__':
@@ -0,0 +1,280 @@
+"""
+index.py
+Species, genus and label indexes of LatexTree documents.
+
+A DocumentIndex maps
+    species -> list of nodes (document order)
+    genus -> list of nodes (document order)
+    label -> node
+for the tree at its root node. Every node of the tree points to the index
+(node.index), so that LatexTreeNode.append_child, insert_child and
+remove_child and changes to node.label keep it up to date.
+
+The index also numbers the nodes:
+    pre, post - position of the node in pre-order and post-order
+    depth - number of ancestors (zero for the root)
+    child_index - position in the children of the parent (None for the root)
+so that x is an ancestor of y if x.pre < y.pre and x.post > y.post, and
+the subtree at x is nodes[x.pre:x.pre + size] with
+size = x.post - x.pre + x.depth + 1.
+
+Nodes appended at the end of the document (as the parser does) are added
+to the lists in document order. When the children of the root are replaced
+from some position on (as LatexParser.update_latex_document does), only the
+replaced part of the document is indexed again. Other changes (insertions,
+removals) mark the index as stale and it is rebuilt, in one traversal, by
+the next query.
+
+>>> from index import DocumentIndex
+>>> index = DocumentIndex(doc.root)
+>>> index.find_all('quiz')
+>>> index.by_label('thm:zorn')
+>>> index.find_all('equation', within=section)
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class DocumentIndex(object):
+    '''
+    Index of the tree at root (which can be None).
+        nodes - all nodes (pre-order)
+        species - species -> list of nodes
+        outer - species -> for each node in the species list, the position
+            (in that list) of its nearest ancestor of the same species, or -1
+        genus - genus -> list of nodes
+        labels - label -> node (the last one in document order)
+        stale - True if the lists must be rebuilt before use
+        shadowed - True if a label is used more than once
+    '''
+    def __init__(self, root=None):
+        self.root = root
+        self.rebuild()
+
+    def __repr__(self):
+        return '%s(%s, %d labels)' % (self.__class__.__name__, self.root.__class__.__name__, len(self.labels))
+
+    def rebuild(self):
+        '''
+        Index the whole tree again.
+        '''
+        self.nodes = []
+        self.species = {}
+        self.outer = {}
+        self.genus = {}
+        self.labels = {}
+        self.stale = False
+        self.shadowed = False
+        if self.root is not None:
+            self.index_nodes(self.root)
+        logger.info('Document index rebuilt.')
+
+    def index_nodes(self, top):
+        '''
+        Append the subtree at top (pre-order) to the lists and number its
+        nodes. The subtree must be at the end of the document.
+        '''
+        if top is self.root:
+            top.depth, top.child_index = 0, None
+        else:
+            top.depth, top.child_index = top.parent.depth + 1, len(top.parent.children) - 1
+        pre = len(self.nodes)
+        post = pre - top.depth
+
+        # positions of the open nodes of each species (starting with the ancestors of top)
+        ancestors = []
+        node = top
+        while node is not self.root:
+            node = node.parent
+            ancestors.append(node)
+        open_nodes = {}
+        for node in reversed(ancestors):
+            open_nodes.setdefault(node.species, []).append(self.bisect(self.species[node.species], node.pre))
+
+        for node, depth, entering in top.iter_events():
+            if not entering:
+                node.post = post
+                post += 1
+                open_nodes[node.species].pop()
+                continue
+            node.index = self
+            node.pre = pre
+            node.depth = top.depth + depth
+            pre += 1
+            for position, child in enumerate(node.children):
+                child.child_index = position
+            self.nodes.append(node)
+            nodes = self.species.setdefault(node.species, [])
+            positions = open_nodes.setdefault(node.species, [])
+            self.outer.setdefault(node.species, []).append(positions[-1] if positions else -1)
+            positions.append(len(nodes))
+            nodes.append(node)
+            self.genus.setdefault(node.genus, []).append(node)
+            if node.label:
+                if node.label in self.labels:
+                    self.shadowed = True
+                self.labels[node.label] = node
+
+        # the ancestors of top finish after it
+        size = pre - top.pre
+        while top is not self.root:
+            top = top.parent
+            top.post += size
+
+    def refresh(self):
+        '''
+        Rebuild the index if it is stale.
+        '''
+        if self.stale:
+            self.rebuild()
+
+    def is_last(self, node):
+        '''
+        Is the subtree at node at the end of the document?
+        '''
+        while node.parent is not None:
+            if node.parent.children[-1] is not node:
+                return False
+            node = node.parent
+        return node is self.root
+
+    def add(self, node):
+        '''
+        Called when the subtree at node has been attached to the tree.
+        '''
+        if node.index is self or not self.is_last(node):
+            self.stale = True
+        if self.stale:
+            for node in node.iter_nodes():
+                node.index = self
+        else:
+            self.index_nodes(node)
+
+    def remove(self, node):
+        '''
+        Called when the subtree at node has been detached from the tree.
+        '''
+        for node in node.iter_nodes():
+            node.index = None
+        self.stale = True
+
+    def replace(self, parent, start, removed):
+        '''
+        Called when the children of parent from position start on have
+        been replaced (removed lists the old ones). If parent is the root,
+        the nodes after its first start children are dropped from the lists
+        and the new children are indexed. Otherwise the index becomes stale.
+        '''
+        for node in removed:
+            for node in node.iter_nodes():
+                node.index = None
+        if parent is not self.root or self.stale or self.shadowed:
+            self.stale = True
+            for child in parent.children[start:]:
+                for node in child.iter_nodes():
+                    node.index = self
+            return
+
+        # the document up to the last unchanged child
+        size = 1
+        if start:
+            size = parent.children[start - 1].pre + self.get_size(parent.children[start - 1])
+        for node in self.nodes[size:]:
+            if node.label and self.labels.get(node.label) is node:
+                del self.labels[node.label]
+        del self.nodes[size:]
+        for species, nodes in self.species.items():
+            del self.outer[species][self.bisect(nodes, size):]
+        for table in (self.species, self.genus):
+            for nodes in table.values():
+                del nodes[self.bisect(nodes, size):]
+        parent.post = size - 1
+
+        for position in range(start, len(parent.children)):
+            self.index_nodes(parent.children[position])
+            parent.children[position].child_index = position
+
+    def relabel(self, node, label):
+        '''
+        Called before the label of node is changed to label.
+        '''
+        if self.labels.get(node.label) is node:
+            del self.labels[node.label]
+            self.stale = True
+        if label in self.labels:
+            self.stale = True
+        elif label:
+            self.labels[label] = node
+
+    def find_all(self, species=None, genus=None, within=None):
+        '''
+        List the nodes of the given species (or genus) in document order.
+        If within is a node, only its descendants (and itself) are listed.
+        '''
+        self.refresh()
+        if species is not None:
+            nodes = self.species.get(species, [])
+        elif genus is not None:
+            nodes = self.genus.get(genus, [])
+        else:
+            raise ValueError('find_all needs a species or genus')
+        if within is None:
+            return list(nodes)
+        return nodes[self.bisect(nodes, within.pre):self.bisect(nodes, within.pre + self.get_size(within))]
+
+    def by_label(self, label):
+        '''
+        Return the node with the given label, or None.
+        '''
+        self.refresh()
+        return self.labels.get(label)
+
+    def get_size(self, node):
+        '''
+        Number of nodes in the subtree at node.
+        '''
+        self.refresh()
+        return node.post - node.pre + node.depth + 1
+
+    def get_subtree(self, node):
+        '''
+        List the nodes of the subtree at node (pre-order).
+        '''
+        self.refresh()
+        return self.nodes[node.pre:node.pre + self.get_size(node)]
+
+    def is_ancestor(self, node, other):
+        '''
+        Is node an ancestor of other (both in the index)?
+        '''
+        self.refresh()
+        return node.pre < other.pre and node.post > other.post
+
+    def get_enclosing(self, node, species):
+        '''
+        Nearest node of the given species on the path from node (included)
+        to the root, or None. Starts from the last node of the species 
+        that does not come after node and follows the outer positions, so 
+        it visits at most one node per level of nesting of the species.
+        '''
+        self.refresh()
+        nodes = self.species.get(species, [])
+        idx = self.bisect(nodes, node.pre + 1) - 1
+        while idx >= 0 and nodes[idx].post < node.post:
+            idx = self.outer[species][idx]
+        return nodes[idx] if idx >= 0 else None
+
+    @staticmethod
+    def bisect(nodes, pre):
+        '''
+        Position of the first node in nodes (pre-order) with node.pre >= pre.
+        '''
+        lo, hi = 0, len(nodes)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if nodes[mid].pre < pre:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
@@ -20,7 +20,9 @@ def main(args=None):
     oparser = OptionParser(usage="%prog main.tex [-opts]", version="%prog: version 1.0", add_help_option=True)
     oparser.add_option("-b", "--bbq", action="store_true", dest="bbq", help="typeset questions in blackboard format")
     oparser.add_option("-e", "--exex", action="store_true", dest="exex", help="extract and typeset exercises")
+    oparser.add_option("-j", "--processes", type="int", dest="processes", help="parse chapters in this many processes")
     oparser.add_option("-i", "--info", action="store_true", dest="info", help="print document info to stdout")
+    oparser.add_option("-o", "--save", dest="save", help="write a snapshot of the parsed document to this file")
     oparser.add_option("-c", "--xrefs", action="store_true", dest="xrefs", help="print (label, entity) pairs to stdout")
     oparser.add_option("-p", "--pdf", action="store_true", dest="pdf", help=" create pdf")
     oparser.add_option("-s", "--show", action="store_true", dest="show", help=" print tree to stdout (recursive)")
@@ -39,7 +41,11 @@ def main(args=None):
     from parser import LatexParser
     pa = LatexParser()
     main_tex = args[0]
-    doc =  pa.parse_latex_file(main_tex)
+    doc =  pa.parse_latex_file(main_tex, processes=options.processes)
+
+    # snapshot
+    if options.save:
+        doc.save(options.save)
 
     # show tree (recursive)
     if options.show:
@@ -61,7 +67,7 @@ def main(args=None):
       
     # extract exercises
     if options.exex:
-        exercises = doc.body.get_phenotypes('exercise')
+        exercises = doc.find_all('exercise')
         if exercises:
             for ex in exercises:
                 print etree.tostring(ex.xml(), pretty_print=True)
@@ -8,11 +8,43 @@ Families are subclassed into genera: Level, List, etc.
 Genera are subclassed into species: Chapter, Section etc. or Itemize, Enumerate, etc.
 """
 
+import re
+import copy_reg
+
 import taxonomy as tax
 
 import logging
 logger = logging.getLogger(__name__)
 
+#------------------------------------------------
+# metaclass
+#------------------------------------------------
+class LatexTreeNodeType(type):
+    '''
+    Metaclass of LatexTreeNode. The taxonomy of each class is computed
+    once, when the class is created, and stored as (interned) class variables
+        species - class name (e.g. chapter)
+        genus - name of the base class (e.g. level)
+        family - name of the base of the base class (e.g. macro) or None
+    '''
+    def __init__(cls, name, bases, attrs):
+        type.__init__(cls, name, bases, attrs)
+        base = cls.__bases__[0]
+        cls.species = intern(cls.__name__.lower())
+        cls.genus = intern(base.__name__.lower())
+        cls.family = intern(base.__bases__[0].__name__.lower()) if base.__bases__ else None
+
+def reduce_node_class(cls):
+    '''
+    Pickle node classes by name: generated classes (see factory.py) are
+    not module attributes, so they are looked up when unpickled
+    (see cache.get_named_class).
+    '''
+    from cache import get_class_names, get_named_class
+    return (get_named_class, (get_class_names(cls),))
+
+copy_reg.pickle(LatexTreeNodeType, reduce_node_class)
+
 #------------------------------------------------
 # base class
 #------------------------------------------------
@@ -22,6 +54,7 @@ class LatexTreeNode(object):
     
     class variables:
         counter - uniqe node_id for each instance
+        species, genus, family - see LatexTreeNodeType
 
     instance variables:
         parent - pointer to parent LatexTreeNode 
@@ -29,11 +62,16 @@ class LatexTreeNode(object):
         label - text label
         number - sequential counter for genus (e.g. theorem) or species (e.g. chapter)
         title - pointer to another LatexTreeNode
-    
-    instance variables that may be attached to some species
+        content - text of Content nodes (and some others, e.g. Row and Cell)
         width - for Image and Video nodes (percentagae)
-        spec - column specification for Tabular nodes
+        index - DocumentIndex of the tree containing the node (see index.py)
+        pre, post, depth, child_index - node numbers set by the index
+    
+    Instance variables are slots (subclasses must define __slots__ too, 
+    otherwise each node gets a __dict__). Optional ones default to None.
     '''
+    __metaclass__ = LatexTreeNodeType
+    __slots__ = ('node_id', 'parent', 'children', '_label', 'number', 'title', 'content', 'width', 'index', 'pre', 'post', 'depth', 'child_index')
     counter = 0    
     
     def __init__(self):
@@ -41,17 +79,36 @@ class LatexTreeNode(object):
         LatexTreeNode.counter += 1
         self.parent = None
         self.children = []
+        self._label = None
+        self.number = None
+        self.title = None
+        self.content = None
+        self.width = None
+        self.index = None
+        self.pre = None
+        self.post = None
+        self.depth = None
+        self.child_index = None
         logger.info('Node %d created.', self.counter)        
 
     def __str__(self):
         return self.__repr__()
 
     def __repr__(self):
-        if hasattr(self, 'content') and self.content:       
+        if self.content:       
             return "%s(%s)" % (self.__class__.__name__, self.content)
         else:
             return "%s()" % (self.__class__.__name__)
 
+    def __reduce__(self):
+        '''
+        Pickle the subtree at this node as a flat table (see cache.pack_tree)
+        rather than nested children lists, so deep trees do not exhaust the
+        recursion limit. The parent and the index are not pickled.
+        '''
+        from cache import pack_tree, unpack_tree
+        return (unpack_tree, pack_tree(self))
+
     #-----------------------------------------------
     # Access functions
     #-----------------------------------------------
@@ -65,17 +122,15 @@ class LatexTreeNode(object):
 
     @classmethod
     def get_species(cls):
-        return cls.__name__.lower()
+        return cls.species
 
     @classmethod
     def get_genus(cls):
-        return cls.__bases__[0].__name__.lower()
+        return cls.genus
 
     @classmethod
     def get_family(cls):
-        if cls.__bases__[0].__bases__ and len(cls.__bases__[0].__bases__) > 0:
-            return cls.__bases__[0].__bases__[0].__name__.lower()
-        return None
+        return cls.family
 
     # @classmethod
     # def get_node_type(cls):
@@ -95,6 +150,16 @@ class LatexTreeNode(object):
     def is_leaf(self):
         return not self.children
 
+    def get_label(self):
+        return self._label
+
+    def set_label(self, label):
+        if self.index is not None:
+            self.index.relabel(self, label)
+        self._label = label
+
+    label = property(get_label, set_label)
+
     def append_child(self, node):
         '''
         Append a child node.
@@ -103,6 +168,104 @@ class LatexTreeNode(object):
         '''
         node.parent = self
         self.children.append(node)
+        if self.index is not None:
+            self.index.add(node)
+
+    def insert_child(self, position, node):
+        '''
+        Insert a child node before children[position].
+        '''
+        node.parent = self
+        self.children.insert(position, node)
+        if self.index is not None:
+            self.index.add(node)
+
+    def remove_child(self, node):
+        '''
+        Remove a child node (and its subtree) from the tree.
+        '''
+        for idx, child in enumerate(self.children):
+            if child is node:
+                del self.children[idx]
+                break
+        else:
+            raise ValueError('%r is not a child of %r' % (node, self))
+        node.parent = None
+        if self.index is not None:
+            self.index.remove(node)
+
+    def replace_children(self, start, nodes):
+        '''
+        Replace the children from children[start] on by nodes (which may
+        include some of the old ones). Returns the old children.
+        '''
+        removed = self.children[start:]
+        for node in removed:
+            node.parent = None
+        del self.children[start:]
+        for node in nodes:
+            node.parent = self
+            self.children.append(node)
+        if self.index is not None:
+            self.index.replace(self, start, removed)
+        return removed
+
+    #-----------------------------------------------
+    # Traversal
+    #-----------------------------------------------
+
+    def iter_nodes(self, order='pre', filter=None, species=None, genus=None):
+        '''
+        Generate the nodes of the subtree at this node (including itself)
+        using an explicit stack (no recursion).
+            order - 'pre' (parents before children) or 'post' (children first)
+            filter - predicate: only nodes for which filter(node) is true
+            species, genus - name or collection of names: only matching nodes
+
+        >>> chapters = list(root.iter_nodes(species='chapter'))
+        >>> numbered = root.iter_nodes(filter=lambda node: node.number)
+        '''
+        match = get_node_filter(filter, species, genus)
+        if order == 'pre':
+            stack = [self]
+            while stack:
+                node = stack.pop()
+                if match is None or match(node):
+                    yield node
+                if node.children:
+                    stack.extend(reversed(node.children))
+        elif order == 'post':
+            stack = [(self, iter(self.children))]
+            while stack:
+                node, children = stack[-1]
+                for child in children:
+                    stack.append((child, iter(child.children)))
+                    break
+                else:
+                    stack.pop()
+                    if match is None or match(node):
+                        yield node
+        else:
+            raise ValueError("Unknown traversal order `%s'" % order)
+
+    def iter_events(self, children=None):
+        '''
+        Generate (node, depth, entering) for each node of the subtree, once
+        with entering=True before its descendants and once with 
+        entering=False after them. The depth of this node is zero.
+            children - function returning the children to visit (default: all)
+        '''
+        yield self, 0, True
+        stack = [(self, iter(children(self) if children else self.children))]
+        while stack:
+            node, nodes = stack[-1]
+            for child in nodes:
+                yield child, len(stack), True
+                stack.append((child, iter(children(child) if children else child.children)))
+                break
+            else:
+                stack.pop()
+                yield node, len(stack), False
 
     #-----------------------------------------------
     # Output
@@ -110,33 +273,37 @@ class LatexTreeNode(object):
 
     def show(self, depth=0):
         '''
-        Print node and its descendants for debugging (recursive).
+        Print node and its descendants for debugging.
         '''
         s = []
         istr = '--'
-        ss = istr*depth + self.get_genus() + ':' + self.get_species() 
-        if hasattr(self, 'content') and self.content:
-            ss += '(' + self.content + ')'
-        s.append(ss)
-        for child in self.children:
-            s.append(child.show(depth=depth+1))
+        for node, level, entering in self.iter_events():
+            if entering:
+                ss = istr*(depth + level) + node.genus + ':' + node.species 
+                if node.content:
+                    ss += '(' + node.content + ')'
+                s.append(ss)
         return '\n'.join(s)
 
 
     def get_slug(self):
         '''
-        Get a text representation of node contents (recursive).
+        Get a text representation of node contents.
         Useful for titles.
         '''
-        s = []
-        if hasattr(self, 'content') and self.content:
-            import re
-            cont = re.sub(r'([^\s\w]|_)+', '', self.content)
-            parts = cont.lower().split(' ')
-            s.append('-'.join(parts))
-        for child in self.children:
-            s.append(child.get_slug())
-        return '_'.join(s)
+        # parts of the slugs of the nodes on the current path
+        parts = [[]]
+        for node, depth, entering in self.iter_events():
+            if entering:
+                s = []
+                if node.content:
+                    cont = SLUG_RE.sub('', node.content)
+                    s.append('-'.join(cont.lower().split(' ')))
+                parts.append(s)
+            else:
+                s = parts.pop()
+                parts[-1].append('_'.join(s))
+        return parts[0][0]
 
     def get_latex(self):
         '''
@@ -147,61 +314,11 @@ class LatexTreeNode(object):
         brackets should go.
         '''
         s = []
-
-        # content
-        if hasattr(self, 'content') and self.content:
-            s.append(self.content)        
-
-        # root node
-        if self.get_species() == 'root':
-            for child in self.children:
-                s.append(child.get_latex())
-
-        # item
-        elif self.get_genus() == 'item':
-            s.append('\\'+self.get_species())
-            pts = self.get_first_child_by_species('points')
-            if pts: 
-                s.append('[%s]' % pts.get_value())
-            # s.append(' ')
-            if hasattr(self, 'label') and self.label:
-                s.append(r'\label{%s}' % self.label)
-            for child in self.children:
-                if not pts or (pts and child != pts):
-                    s.append(child.get_latex())
-
-        # macros
-        elif self.get_species() in tax.macro_species: 
-            s.append('\\'+self.get_species()+'{')           
-            for child in self.children:
-                s.append(child.get_latex())
-            s.append(r'}')
-            if hasattr(self, 'label') and self.label:
-                s.append(r'\label{%s}' % self.label)
-            
-        # environments
-        elif self.get_species() in tax.environment_species:
-            s.append('\\begin{%s}' % self.get_species())
-            if hasattr(self, 'label') and self.label:
-                s.append(r'\label{%s}' % self.label)
-            for child in self.children:
-                s.append(child.get_latex())
-            s.append('\\end{%s}' % self.get_species())
-        
-        # switches
-        elif self.get_species() in tax.switch_species:
-            s.append('{\\%s' % self.get_species())
-            for child in self.children:
-                s.append(child.get_latex())
-            s.append('}')
-        
-        # ignore unlisted species: we don't know if they're 
-        # macros or environments. Perhaps we could record this
-        # in LatexParser() wne we first encounter unknown species.
-        else:
-            for child in self.children:
-                if child.get_species() in tax.species:
-                    s.append(child.get_latex())
+        for node, depth, entering in self.iter_events(children=get_latex_children):
+            if entering:
+                s.extend(get_latex_opening(node))
+            else:
+                s.extend(get_latex_closing(node))
 
         # return ''.join([x.lstrip() for x in s])
         return ''.join(s)
@@ -209,51 +326,113 @@ class LatexTreeNode(object):
 
     def get_mpath(self):
         '''
-        Compute materialized path (two hex digits = max. 256 children).
+        Compute materialized path: the position of the node and each of its
+        ancestors in hex, zero-padded to the same width for all siblings
+        (at least two digits), so that paths sort in document order.
+        '''
+        parts = []
+        node = self
+        while node.parent:
+            idx = node.get_child_index()
+            width = max(2, len('%x' % (len(node.parent.children) - 1)))
+            parts.append('%0*x' % (width, idx))
+            node = node.parent
+        parts.append('')
+        return '.'.join(reversed(parts))
+
+    def get_child_index(self):
+        '''
+        Position of the node in the children of its parent (None for the root).
         '''
-        if not self.parent:
-            return ''
-        idx = self.parent.children.index(self)
-        hexstr = hex(idx)[2:].zfill(2)
-        return self.parent.get_mpath() + '.' + hexstr
+        if self.index is not None:
+            self.index.refresh()
+            return self.child_index
+        if self.parent:
+            for idx, child in enumerate(self.parent.children):
+                if child is self:
+                    return idx
+        return None
 
+    def get_depth(self):
+        '''
+        Number of ancestors.
+        '''
+        if self.index is not None:
+            self.index.refresh()
+            return self.depth
+        depth = 0
+        node = self.parent
+        while node:
+            depth += 1
+            node = node.parent
+        return depth
+
+    def is_ancestor_of(self, node):
+        '''
+        Is this node a (proper) ancestor of node? 
+        '''
+        if self.index is not None and self.index is node.index:
+            return self.index.is_ancestor(self, node)
+        node = node.parent
+        while node:
+            if node is self:
+                return True
+            node = node.parent
+        return False
+
+    def is_descendant_of(self, node):
+        '''
+        Is this node a (proper) descendant of node? 
+        '''
+        return node.is_ancestor_of(self)
 
     def get_xml(self):
         '''
         Serialize as XML. Elements correspond to species.
         '''
         from lxml import etree
-        ename = self.get_species()
+        stack = []
+        for node, depth, entering in self.iter_events():
+            if not entering:
+                element = stack.pop()
+                continue
+            element = node.get_xml_element(etree)
+            if stack:
+                stack[-1].append(element)
+            stack.append(element)
+        return element
+
+    def get_xml_element(self, etree):
+        '''
+        XML element for this node (without children).
+        '''
+        ename = self.species
         if ename[-1] == '*':
              ename = ename[:-1] + 'star'
         element = etree.Element(ename)
         
         # attributes (some block nodes)
-        if hasattr(self, 'number') and self.number:     
+        if self.number:     
             element.set('number', str(self.number))
-        if hasattr(self, 'label') and self.label:       
+        if self.label:       
             element.set('label', self.label)
         
         # titles are pointers to other LatexTreeNode objects
         # they might contain characters that offends xml
         # the get_slug function comes in handy here!
-        if hasattr(self, 'title') and self.title:
+        if self.title:
             text_title = self.title.get_slug()
             element.set('title', text_title)
 
         # width attributes are sometimes attached to Image and Media nodes
         # this is basically a hack. To do it properly, nodes should have
         # ann optional "styles" dict. Useful for row and column specs etc.
-        if hasattr(self, 'width') and self.width:       
+        if self.width:       
             element.set('width', str(self.width))
 
         # content 
-        if hasattr(self, 'content') and self.content:
+        if self.content:
             element.text = self.content.strip()
-       
-        # recursive call
-        for child in self.children:
-            element.append(child.get_xml())
         
         return element
 
@@ -264,80 +443,37 @@ class LatexTreeNode(object):
     def set_titles(self): 
         '''
         Set titles of chapters, figures, etc.
-        Wrapper for the recursive function set_title.
+        Wrapper for set_title.
         '''
         self.set_title()
 
     def set_title(self):
         '''
-        Set title attribute. This is a pointer to another LatexTreeNode object.
+        Set title attribute of this node and its descendants. This is a 
+        pointer to another LatexTreeNode object.
         First child of type "title" is taken.
         '''
-        title = next((child for child in self.children if child.get_species() == 'title'), None)
-        if title:
-            self.title = title
-        # recurse
-        for child in self.children:
-            child.set_title()
+        for node in self.iter_nodes():
+            title = node.get_title_node()
+            if title:
+                node.title = title
 
 
     def set_numbers(self): 
         '''
         Set numbers of chapters, figures, etc.
-        Wrapper for the recursive function set_number.
+        Wrapper for set_number.
         '''
         counters = dict.fromkeys(tax.counters, 0)
         self.set_number(counters)
 
     def set_number(self, counters):
         '''
-        Set number. Applied recursively.
+        Set numbers of this node and its descendants (in document order).
         '''
-        if self.get_genus() in counters or self.get_species() in counters:
-            
-            # chapter (reset all)
-            if self.get_species() == 'chapter':
-                counters['chapter'] += 1
-                for key in counters:
-                    if key != 'chapter':
-                        counters[key] = 0
-                self.number = counters['chapter']
-
-            # section (reset subsection)
-            elif self.get_species() == 'section':
-                counters['section'] += 1
-                counters['subsection'] = 0
-                self.number = counters['section']
-                                    
-            # subsection
-            elif self.get_species() == 'subsection':
-                counters['subsection'] += 1
-                self.number = counters['subsection']
-
-            # figure (reset subfigure)
-            elif self.get_species() == 'figure':
-                counters['figure'] += 1
-                counters['subfigure'] = 0
-                self.number = counters['figure']
-
-            # table (reset subtable)
-            elif self.get_species() == 'table':
-                counters['table'] += 1
-                counters['subtable'] = 0
-                self.number = counters['table']
-                                    
-            # all others with counters (as defined in taxonomy.py)
-            elif self.get_genus() in tax.counters:
-                counters[self.get_genus()] += 1
-                self.number = counters[self.get_genus()]
-
-            elif self.get_species() in tax.counters:
-                counters[self.get_species()] += 1
-                self.number = counters[self.get_species()]
-
-        # recurse
-        for child in self.children:
-            child.set_number(counters)
+        for node in self.iter_nodes():
+            if node.genus in counters or node.species in counters:
+                set_node_number(node, counters)
 
     #-----------------------------------------------
     # For applications
@@ -345,28 +481,18 @@ class LatexTreeNode(object):
 
     def get_phenotypes(self, species):
         '''
-        Get an ordered list of all children of the given species (recursive).
+        Get an ordered list of all descendants of the given species.
         Include self if appropriate.
         '''
-        phenotypes=[]
-        if self.get_species() == species:
-            phenotypes.append(self)
-        for child in self.children:
-            phenotypes.extend(child.get_phenotypes(species))
-        return phenotypes
+        return list(self.iter_nodes(species=species))
 
 
-    # create label -> LatexTreeNode object map (recursive)
+    # create label -> LatexTreeNode object map
     def get_xref_dict(self): 
         '''
-        Create a dictionary of labels mapped to LatexTreeNode objects (recursive).
+        Create a dictionary of labels mapped to LatexTreeNode objects.
         '''
-        xref_dict = {}        
-        if hasattr(self, 'label') and self.label:
-            xref_dict[self.label] = self
-        for child in self.children:
-            xref_dict.update(child.get_xref_dict())
-        return xref_dict
+        return dict([(node.label, node) for node in self.iter_nodes() if node.label])
 #
     def get_first_child_by_species(self, species):
         '''
@@ -375,7 +501,7 @@ class LatexTreeNode(object):
         e.g. title, caption or points
         '''
         for child in self.children:
-            if child.get_species() == species:
+            if child.species == species:
                 return child
         return None
 
@@ -384,7 +510,7 @@ class LatexTreeNode(object):
         Get first title node among children (if any).
         '''
         for child in self.children:
-            if child.get_species() == 'title':
+            if child.species == 'title':
                 return child
         return None
 
@@ -393,44 +519,202 @@ class LatexTreeNode(object):
         Get first caption node among children (if any).
         '''
         for child in self.children:
-            if child.get_species() == 'caption':
+            if child.species == 'caption':
                 return child
         return None
 
-    def get_enclosing_chapter(self):
+    def get_enclosing(self, species):
         '''
-        Get parent chapter (if any).
-        '''        
+        Get the nearest node of the given species on the path from this 
+        node (included) to the root (if any).
+        '''
+        if self.index is not None:
+            return self.index.get_enclosing(self, species)
         node = self
-        while node.get_species() != 'chapter' and node.parent:
+        while node.species != species and node.parent:
             node = node.parent
-        if node.get_species() == 'chapter':
+        if node.species == species:
             return node
         return None
 
+    def get_enclosing_chapter(self):
+        '''
+        Get parent chapter (if any).
+        '''        
+        return self.get_enclosing('chapter')
+
     def get_enclosing_section(self):
         '''
         Get parent section (if any).
         '''        
-        node = self
-        while node.get_species() != 'section' and node.parent:
-            node = node.parent
-        if node.get_species() == 'section':
-            return node
+        return self.get_enclosing('section')
+
+#------------------------------------------------
+# traversal helpers
+#------------------------------------------------
+SLUG_RE = re.compile(r'([^\s\w]|_)+')
+
+def get_node_filter(filter=None, species=None, genus=None):
+    '''
+    Predicate for LatexTreeNode.iter_nodes (None matches all nodes).
+    species and genus can be names or collections of names.
+    '''
+    tests = []
+    if species is not None:
+        species = frozenset([species]) if isinstance(species, basestring) else frozenset(species)
+        tests.append(lambda node: node.species in species)
+    if genus is not None:
+        genus = frozenset([genus]) if isinstance(genus, basestring) else frozenset(genus)
+        tests.append(lambda node: node.genus in genus)
+    if filter is not None:
+        tests.append(filter)
+    if not tests:
         return None
+    if len(tests) == 1:
+        return tests[0]
+    return lambda node: all([test(node) for test in tests])
+
+
+def has_own_latex(node):
+    '''
+    True if the class of node overrides LatexTreeNode.get_latex (e.g. Latex).
+    '''
+    return node.__class__.get_latex.__func__ is not LatexTreeNode.get_latex.__func__
+
+def get_latex_children(node):
+    '''
+    Children serialized by LatexTreeNode.get_latex.
+    '''
+    if has_own_latex(node):
+        return []
+    if node.species == 'root':
+        return node.children
+    elif node.genus == 'item':
+        pts = node.get_first_child_by_species('points')
+        return [child for child in node.children if not pts or (pts and child != pts)]
+    elif node.species in tax.macro_species or node.species in tax.environment_species or node.species in tax.switch_species:
+        return node.children
+    # ignore unlisted species: we don't know if they're 
+    # macros or environments. Perhaps we could record this
+    # in LatexParser() wne we first encounter unknown species.
+    return [child for child in node.children if child.species in tax.species]
+
+def get_latex_opening(node):
+    '''
+    Latex preceding the children of node in LatexTreeNode.get_latex.
+    '''
+    if has_own_latex(node):
+        return [node.get_latex()]
+
+    # content
+    s = []
+    if node.content:
+        s.append(node.content)        
+
+    # root node
+    if node.species == 'root':
+        pass
+
+    # item
+    elif node.genus == 'item':
+        s.append('\\'+node.species)
+        pts = node.get_first_child_by_species('points')
+        if pts: 
+            s.append('[%s]' % pts.get_value())
+        if node.label:
+            s.append(r'\label{%s}' % node.label)
+
+    # macros
+    elif node.species in tax.macro_species: 
+        s.append('\\'+node.species+'{')           
+        
+    # environments
+    elif node.species in tax.environment_species:
+        s.append('\\begin{%s}' % node.species)
+        if node.label:
+            s.append(r'\label{%s}' % node.label)
+    
+    # switches
+    elif node.species in tax.switch_species:
+        s.append('{\\%s' % node.species)
+    return s
+
+def get_latex_closing(node):
+    '''
+    Latex following the children of node in LatexTreeNode.get_latex.
+    '''
+    if has_own_latex(node) or node.species == 'root' or node.genus == 'item':
+        return []
+    if node.species in tax.macro_species: 
+        if node.label:
+            return [r'}', r'\label{%s}' % node.label]
+        return [r'}']
+    if node.species in tax.environment_species:
+        return ['\\end{%s}' % node.species]
+    if node.species in tax.switch_species:
+        return ['}']
+    return []
+
+
+def set_node_number(node, counters):
+    '''
+    Increment the counter of a numbered node and set its number.
+    '''
+    # chapter (reset all)
+    if node.species == 'chapter':
+        counters['chapter'] += 1
+        for key in counters:
+            if key != 'chapter':
+                counters[key] = 0
+        node.number = counters['chapter']
+
+    # section (reset subsection)
+    elif node.species == 'section':
+        counters['section'] += 1
+        counters['subsection'] = 0
+        node.number = counters['section']
+                            
+    # subsection
+    elif node.species == 'subsection':
+        counters['subsection'] += 1
+        node.number = counters['subsection']
+
+    # figure (reset subfigure)
+    elif node.species == 'figure':
+        counters['figure'] += 1
+        counters['subfigure'] = 0
+        node.number = counters['figure']
+
+    # table (reset subtable)
+    elif node.species == 'table':
+        counters['table'] += 1
+        counters['subtable'] = 0
+        node.number = counters['table']
+                            
+    # all others with counters (as defined in taxonomy.py)
+    elif node.genus in tax.counters:
+        counters[node.genus] += 1
+        node.number = counters[node.genus]
+
+    elif node.species in tax.counters:
+        counters[node.species] += 1
+        node.number = counters[node.species]
 
 #------------------------------------------------
 # derived classes
 #------------------------------------------------
 class Macro(LatexTreeNode):
+    __slots__ = ()
     def __init__(self):
         LatexTreeNode.__init__(self)
             
 class Environment(LatexTreeNode):
+    __slots__ = ()
     def __init__(self):
         LatexTreeNode.__init__(self)
             
 class Switch(LatexTreeNode):
+    __slots__ = ()
     def __init__(self):
         LatexTreeNode.__init__(self)
             
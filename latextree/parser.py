@@ -59,7 +59,7 @@ Content is always plain ascii text
     Xref: internal cross-references (label)
 
  """
-import os
+import os, re, hashlib, inspect
 
 from pylatexenc.latexwalker import (
     LatexEnvironmentNode, 
@@ -74,35 +74,98 @@ import walker
 import taxonomy as tax
 
 from node import LatexTreeNode, Macro, Environment, Switch
-from content import Content, Xref, Url, Image, Media, Latex, Comment, Text, Points
-from factory import ClassFactory, NodeFactory
+from content import Content, Xref, Url, Image, Media, Latex, Comment, Text, Points, Title, Break, Space
+from factory import NodeFactory
 from tabular import Tabular, Row, Cell
-from bibliography import Bibliography
+from bibliography import Bibliography, BibItem
 from document import LatexDocument
+from postprocessor import LatexPostProcessor
+from cache import dump_tree, load_tree, get_class_names
+from registry import FrozenMapping, family_classes, genus_classes, species_classes, NAMED_CLASSES
 
 import logging
 logger = logging.getLogger(__name__)
 
+# document environment, level commands and the delimiters that can enclose them
+SHARD_RE = re.compile(r'''
+    %[^\n]*                                     # comment
+    | \\begin\s*\{(?P<begin>[^\}]*)\}
+    | \\end\s*\{(?P<end>[^\}]*)\}
+    | \\(?P<level>chapter|section)(?![a-zA-Z*])
+    | \\(?P<open>\[|\()                          # \[...\] and \(...\)
+    | \\(?P<close>\]|\))
+    | \\(?P<macro>[a-zA-Z]+)                     # \itemize...\enditemize
+    | \\.
+    | (?P<brace>[{}])
+    ''', re.X)
 
-# some catch-all classes. These should be hived off somewhere else
-class Title(LatexTreeNode):
-    ''' 
-    This neds to be defined as a LatexTreeContent node. The chilren contain
-    the title and content attribute set to equal a short tile (as specified
-    by an optional argument: \chapter[short title]{full title}    
-    cases: level, theorem, float (caption)
+# bibliography files (part of the cache key of a shard)
+BIBLIOGRAPHY_RE = re.compile(r'\\bibliography\s*\{([^\}]*)\}')
+
+
+
+def build_macro_handlers():
     '''
-    def __init__(self):
-        LatexTreeNode.__init__(self)
+    Handler (LatexParser method name) for each macro of the taxonomy.
+    Macros listed in more than one group are taken from the first.
+    '''
+    groups = (
+        (['label'], 'parse_label_macro'),
+        (tax.macro_sets['pre'], 'parse_pre_macro'),
+        (['bibliography'], 'parse_bibliography_macro'),
+        (tax.macro_sets['level'], 'parse_level_macro'),
+        (tax.macro_sets['item'], 'parse_item_macro'),
+        (['\\'], 'parse_break_macro'),
+        (tax.macro_sets['break'], 'parse_break_macro'),
+        (tax.macro_sets['space'], 'parse_space_macro'),
+        (tax.macro_sets['escaped'], 'parse_escaped_macro'),
+        (tax.macro_sets['accent'], 'parse_accent_macro'),
+        (['subfigure'], 'parse_subfigure_macro'),
+        (tax.macro_sets['media'], 'parse_media_macro'),
+        (tax.reference_species, 'parse_reference_macro'),
+    )
+    handlers = {}
+    for names, handler in groups:
+        for name in names:
+            handlers.setdefault(name, handler)
+    return handlers
 
-class Break(LatexTreeNode):
-    def __init__(self):
-        LatexTreeNode.__init__(self)
+def build_environment_handlers():
+    '''
+    Handler (LatexParser method name) for each special environment.
+    '''
+    handlers = {'tabular': 'parse_tabular_environment'}
+    handlers.update([(name, 'parse_pre_environment') for name in tax.environment_sets['pre']])
+    handlers.update([(name, 'parse_dispmath_environment') for name in tax.environment_sets['dispmath']])
+    return handlers
+
+# modes of nodelist tasks (see LatexParser.nodelist_task)
+SCAN, PLAIN, GROUP = range(3)
+
+# dispatch tables: walker node type, macro name or environment name -> handler
+NODE_HANDLERS = FrozenMapping([
+    (LatexCharsNode, 'parse_walker_chars_node'),
+    (LatexCommentNode, 'parse_walker_comment_node'),
+    (LatexMathNode, 'parse_walker_math_node'),
+    (LatexGroupNode, 'parse_walker_group_node'),
+    (LatexEnvironmentNode, 'parse_walker_environment_node'),
+    (LatexMacroNode, 'parse_walker_macro_node'),
+])
+MACRO_HANDLERS = FrozenMapping(build_macro_handlers())
+ENVIRONMENT_HANDLERS = FrozenMapping(build_environment_handlers())
+
+_handlers = {}
+
+def get_handlers(cls):
+    '''
+    Resolve the method names of the dispatch tables for a parser class 
+    (once per class). Returns read-only mappings to unbound methods.
+    '''
+    if cls not in _handlers:
+        _handlers[cls] = tuple([FrozenMapping([(key, getattr(cls, name)) for key, name in table.items()])
+            for table in (NODE_HANDLERS, MACRO_HANDLERS, ENVIRONMENT_HANDLERS)])
+    return _handlers[cls]
 
-class Space(LatexTreeNode):
-    def __init__(self):
-        LatexTreeNode.__init__(self)
-    
 
 class LatexParserError(Exception):
     '''
@@ -123,26 +186,60 @@ class LatexParser(object):
     also need to locate files whose location are specified relative to main.tex 
     '''
     
-    def __init__(self):       
+    def __init__(self, front_end=None):       
 
         # filename will be set by parse_latex_document
         # probably not needed anymore
         self.filename = None
 
-        # create classes        
-        abstract_macro_classes = dict([(genus, ClassFactory(genus, {}, BaseClass=Macro)) for genus in tax.macros])
-        abstract_environment_classes = dict([(genus, ClassFactory(genus, {}, BaseClass=Environment)) for genus in tax.environments])
-        abstract_switch_classes = dict([(genus, ClassFactory(genus, {}, BaseClass=Switch)) for genus in tax.switches])
+        # name of the walker front end (see walker.FRONT_ENDS, default walker.DEFAULT_FRONT_END)
+        self.front_end = front_end
+
+        # node classes (shared by all parsers, see registry.py)
+        self.classes = species_classes
+        self.named_classes = NAMED_CLASSES
+
+        # work stack (see run_work)
+        self.work = None
 
-        macro_classes = dict([(species, ClassFactory(species, {}, BaseClass=abstract_macro_classes[genus])) for genus in tax.macros for species in tax.macros[genus]])
-        environment_classes = dict([(species, ClassFactory(species, {}, BaseClass=abstract_environment_classes[genus])) for genus in tax.environments for species in tax.environments[genus]])
-        switch_classes = dict([(species, ClassFactory(species, {}, BaseClass=abstract_switch_classes[genus])) for genus in tax.switches for species in tax.switches[genus]])
+        # dispatch tables (shared by all parsers of the same class until 
+        # a handler is registered)
+        self.node_handlers, self.macro_handlers, self.environment_handlers = get_handlers(self.__class__)
+
+    def register_node_handler(self, node_type, handler):
+        '''
+        Parse walker nodes of the given type (a pylatexenc LatexNode class) 
+        with handler(parser, wnode, stack, **kwargs), which returns the stack.
+        '''
+        if isinstance(self.node_handlers, FrozenMapping):
+            self.node_handlers = dict(self.node_handlers)
+        self.node_handlers[node_type] = handler
+
+    def register_macro_handler(self, macroname, handler):
+        '''
+        Parse \macroname with handler(parser, macroname, wnode, stack, **kwargs),
+        which returns the stack. Starred level macros are registered as
+        e.g. `sectionstar', other starred macros without the star.
+
+        >>> def parse_tip(parser, macroname, wnode, stack, **kwargs):
+        ...     stack[-1].append_child(Text(text='(tip)'))
+        ...     return stack
+        >>> pa.register_macro_handler('tip', parse_tip)
+        '''
+        if isinstance(self.macro_handlers, FrozenMapping):
+            self.macro_handlers = dict(self.macro_handlers)
+        self.macro_handlers[macroname] = handler
 
-        self.classes = macro_classes.copy()
-        self.classes.update(environment_classes)
-        self.classes.update(switch_classes)
+    def register_environment_handler(self, envname, handler):
+        '''
+        Parse the envname environment with 
+        handler(parser, envname, wnode, stack, **kwargs), which returns the stack.
+        '''
+        if isinstance(self.environment_handlers, FrozenMapping):
+            self.environment_handlers = dict(self.environment_handlers)
+        self.environment_handlers[envname] = handler
         
-    def parse_walker_chars_node(self, wnode, stack):
+    def parse_walker_chars_node(self, wnode, stack, **kwargs):
         '''
         Parse a LatexCharsNode object.
         Double newlines are replaced by a Break() object.
@@ -159,7 +256,7 @@ class LatexParser(object):
                 stack[-1].append_child(Text(text=para))
         return stack
         
-    def parse_walker_comment_node(self, wnode, stack):
+    def parse_walker_comment_node(self, wnode, stack, **kwargs):
         '''
         Parse a LatexCommentNode object.
         '''
@@ -172,101 +269,121 @@ class LatexParser(object):
     def parse_walker_group_node(self, wnode, stack, **kwargs):
         '''
         Parse a LatexGroupNode object.
+        Switches (e.g. {\bf ...}) are pushed onto the stack; the scope of a 
+        switch extends to the next switch or to the closing brace.
         '''
         if not wnode.isNodeType(LatexGroupNode):
             raise LatexParserError("Expected LatexGroupNode object, not `%s'" % type(wnode))
         
-        for wnode2 in wnode.nodelist:
-            # check for switches
-            if wnode2.isNodeType(LatexMacroNode) and wnode2.macroname in tax.switch_species:
-                # terminate previous switch (if any)
-                if (
-                    wnode2.macroname in tax.switches['style'] and stack[-1].get_species() in tax.switches['style']
-                ) or (
-                    wnode2.macroname in tax.switches['language'] and stack[-1].get_species() in tax.switches['language']
-                ):
-                    node = stack.pop()
-                    stack[-1].append_child(node)
-                node = self.classes[wnode2.macroname]()
-                stack.append(node)
+        return self.schedule(stack, 
+            self.nodelist_task(wnode.nodelist, GROUP, kwargs), 
+            (self.close_group, stack))
 
-            # otherwise parse the node (recursively)
-            else:
-                stack = self.parse_walker_node(wnode2, stack, **kwargs)
+    def parse_walker_switch(self, wnode, stack):
+        '''
+        Push a switch onto the stack (inside a group).
+        '''
+        # terminate previous switch (if any)
+        if (
+            wnode.macroname in tax.switch_sets['style'] and stack[-1].species in tax.switch_sets['style']
+        ) or (
+            wnode.macroname in tax.switch_sets['language'] and stack[-1].species in tax.switch_sets['language']
+        ):
+            self.pop_node(stack)
+        node = self.classes[wnode.macroname]()
+        stack.append(node)
+        return stack
 
-        # pop stack if necessary (the scope of a switch extends to next switch or a closing brace)
-        if stack[-1].get_species() in tax.switch_species:
-            node = stack.pop()
-            stack[-1].append_child(node)            
+    def close_group(self, stack):
+        '''
+        Pop stack if necessary (the scope of a switch extends to next switch or a closing brace)
+        '''
+        if stack[-1].species in tax.switch_species:
+            self.pop_node(stack)
 
-        return stack
-        
+    def pop_node(self, stack):
+        '''
+        Pop the node at the top of the stack and append it to its parent.
+        '''
+        node = stack.pop()
+        stack[-1].append_child(node)
 
     def parse_walker_environment_node(self, wnode, stack, **kwargs):
         '''
         Parse a LatexEnvironmentNode object.
         
+        The environment is passed to the handler registered for its name 
+        (see ENVIRONMENT_HANDLERS and register_environment_handler).
+        Unlisted environments are parsed by parse_default_environment.
         tabular and dispmath are processed from scratch and appended to the 
         children of the parent container (stack_top). All others are pushed 
-        onto the stack. We then call parse_walker_nodelist recursively on 
-        the contents of the environment. For tabular environments, we call 
-        parse_walker_nodelist recursively on the contents of each cell.
+        onto the stack, and the contents of the environment are scheduled
+        for parsing (see schedule). For tabular environments, we call 
+        parse_walker_nodelist on the contents of each cell.
         '''
         if not wnode.isNodeType(LatexEnvironmentNode):
-            raise LatexParserError("Expected LatexGroupNode object, not `%s'" % type(node))
+            raise LatexParserError("Expected LatexEnvironmentNode object, not `%s'" % type(wnode))
 
         envname = wnode.envname
         #--------------------
-        # 0. starred environments
+        # starred environments
         # xml will not accept * in an element name
         # but starred environments are important for mathjax numbering
         # better to remove stars in LatexTreeNode.get_xml() rather than here.
         # if envname[-1] == '*':
         #     envname = envname[:-1]
 
-        #--------------------
-        # 1A. dispmath (output verbatimm for MathJax to handle)
-        if envname in tax.environments['dispmath']:
-            new_walker_math_node = LatexMathNode(displaytype=envname, nodelist=wnode.nodelist)
-            if envname in self.classes:
-                node = self.classes[envname]()
-            else:
-                node = NodeFactory(envname, BaseClass=Content)
-            node.content =  walker.math_node_to_latex(new_walker_math_node, **kwargs)
-            
-            # append as child of parent and bail out
-            stack[-1].append_child(node)
-            return stack
-            
-        #--------------------
-        # 1B. preformatted text
-        if envname in tax.environments['pre']:
-            new_walker_environment_node = LatexEnvironmentNode(envname=envname, nodelist=wnode.nodelist)
-            if envname in self.classes:
-                node = self.classes[envname]()
-            else:
-                node = NodeFactory(envname, BaseClass=Content)
-            node.content =  walker.nodelist_to_latex(wnode.nodelist)
-            
-            # append as child of parent and bail out
-            stack[-1].append_child(node)
-            return stack
+        handler = self.environment_handlers.get(envname)
+        if handler is None:
+            return self.parse_default_environment(envname, wnode, stack, **kwargs)
+        return handler(self, envname, wnode, stack, **kwargs)
+
+    def parse_dispmath_environment(self, envname, wnode, stack, **kwargs):
+        '''
+        dispmath (output verbatim for MathJax to handle)
+        '''
+        new_walker_math_node = LatexMathNode(displaytype=envname, nodelist=wnode.nodelist)
+        if envname in self.classes:
+            node = self.classes[envname]()
+        else:
+            node = NodeFactory(envname, BaseClass=Content)
+        node.content =  walker.math_node_to_latex(new_walker_math_node, **kwargs)
+        
+        # append as child of parent and bail out
+        stack[-1].append_child(node)
+        return stack
             
-        #--------------------
-        # 2. tabular: parse from scratch (see tabular.py)
-        # parse_walker_nodelist is called on the contents of each cell
-        if envname == 'tabular':
-            from tabular import Tabular
-            colspec = list(walker.nodelist_to_latex(wnode.args[0].nodelist))
-            text = walker.nodelist_to_latex(wnode.nodelist)
-            node = Tabular(spec=colspec, text=text)
+    def parse_pre_environment(self, envname, wnode, stack, **kwargs):
+        '''
+        preformatted text
+        '''
+        if envname in self.classes:
+            node = self.classes[envname]()
+        else:
+            node = NodeFactory(envname, BaseClass=Content)
+        node.content =  walker.nodelist_to_latex(wnode.nodelist)
+        
+        # append as child of parent and bail out
+        stack[-1].append_child(node)
+        return stack
             
-            # append as child of parent and bail out
-            stack[-1].append_child(node)
-            return stack
+    def parse_tabular_environment(self, envname, wnode, stack, **kwargs):
+        '''
+        tabular: parse from scratch (see tabular.py)
+        parse_walker_nodelist is called on the contents of each cell
+        '''
+        colspec = list(walker.nodelist_to_latex(wnode.args[0].nodelist))
+        text = walker.nodelist_to_latex(wnode.nodelist)
+        node = Tabular(spec=colspec, text=text)
+        
+        # append as child of parent and bail out
+        stack[-1].append_child(node)
+        return stack
 
-        #--------------------                             
-        # 3. default: unlisted environments are subclassed from Environment (no genus)
+    def parse_default_environment(self, envname, wnode, stack, **kwargs):
+        '''
+        default: unlisted environments are subclassed from Environment (no genus)
+        '''
         if envname in self.classes:
             node = self.classes[envname]()
         else:
@@ -274,32 +391,34 @@ class LatexParser(object):
 
         # push new environment onto stack
         stack.append(node)
+        tasks = []
         
         # deal with theorem titles (specified as optional argument)
-        if wnode.optargs and envname in tax.environments['theorem']:
+        if wnode.optargs and envname in tax.environment_sets['theorem']:
             stack.append(Title())
-            stack = self.parse_walker_nodelist(wnode.optargs[0].nodelist, stack, **kwargs)
-            title = stack.pop()
-            stack[-1].append_child(title)            
+            tasks.append(self.nodelist_task(wnode.optargs[0].nodelist, SCAN, kwargs))
+            tasks.append((self.pop_node, stack))
 
-        # call parse_walker_nodelist on the contents of the environment
-        stack = self.parse_walker_nodelist(wnode.nodelist, stack, **kwargs)
+        # parse the contents of the environment
+        tasks.append(self.nodelist_task(wnode.nodelist, SCAN, kwargs))
 
         # List environments: pop and append final item
-        if envname in tax.environments['list']:
-            item = stack.pop()
-            stack[-1].append_child(item)
+        if envname in tax.environment_sets['list']:
+            tasks.append((self.pop_node, stack))
 
         # pop current environment and append to parent
-        node = stack.pop()
-        stack[-1].append_child(node)
+        tasks.append((self.pop_node, stack))
 
-        return stack
+        return self.schedule(stack, *tasks)
                     
     def parse_walker_macro_node(self, wnode, stack, **kwargs):
         '''
         Parse a LatexMacroNode object.
 
+        The macro is passed to the handler registered for its name (see
+        MACRO_HANDLERS and register_macro_handler). Unlisted macros are
+        parsed by parse_default_macro.
+
         displaymath:
         \[ and \] are aliases for \begin{displaymath} and \end{displaymath}
         The nodes following a \[ are processed in parse_walker_nodelist, 
@@ -313,230 +432,242 @@ class LatexParser(object):
             raise LatexParserError("Expected LatexMacroNode object, not `%s'" % type(wnode))
 
         #------------------------------        
-        # 0. Starred macros (convert or kill: xml will not accept * in an element name)
+        # Starred macros (convert or kill: xml will not accept * in an element name)
         macroname = wnode.macroname
         if macroname[-1] == '*':
             macroname = macroname[:-1]
-            if macroname in tax.macros['level']:
+            if macroname in tax.macro_sets['level']:
                 macroname = macroname + 'star'
 
-        #--------------------
-        # 1A. Label: set as id attribute of nearest numbered container and bail out
-        if macroname == 'label':
-            # simple method: the immediate parent. This might be the best option.          
-            # stack[-1].label = wnode.nodeargs[0].nodelist[0].chars 
-            idx = -1
-            while (-idx < len(stack)) and (stack[idx].get_genus() not in tax.numbered_genera) and (stack[idx].get_species() not in tax.numbered_species):
-                idx = idx - 1 
-            stack[idx].label = wnode.nodeargs[0].nodelist[0].chars
-            return stack
+        handler = self.macro_handlers.get(macroname)
+        if handler is None:
+            if macroname.isspace():
+                return self.parse_space_macro(macroname, wnode, stack, **kwargs)
+            return self.parse_default_macro(macroname, wnode, stack, **kwargs)
+        return handler(self, macroname, wnode, stack, **kwargs)
 
-        #--------------------
-        # 1B. preformatted text
-        if macroname in tax.macros['pre']:
-            if macroname in self.classes:
-                node = self.classes[macroname]()
-            else:
-                node = NodeFactory(macroname, BaseClass=Content)
-            node.content =  walker.macro_node_to_latex(wnode)
-            # append to parent and bail out
-            stack[-1].append_child(node)
-            return stack
+    #--------------------
+    # Macro handlers
+    # Each handler is called as handler(parser, macroname, wnode, stack, **kwargs)
+    # and returns the stack.
+    #--------------------
 
-        #------------------------------
-        # 2: Block macros (bibliography, chapter, item)
-        #------------------------------
-        
-        #--------------------
-        # 2.1 Bibliography: reads .bib file
-        if macroname == 'bibliography':
-
-            # check we have a LATEX_ROOT
-            if not self.filename:
-                raise LatexParserError("Cannot create bibliography. Latex source file not known.")
-
-            # find bibtex filename
-            bibtex_filename = wnode.nodeargs[0].nodelist[0].chars
-            if '.' not in bibtex_filename:
-                bibtex_filename += '.bib'
-            bibtex_filename  = os.path.join(os.path.abspath(os.path.dirname(self.filename)), bibtex_filename)
-            
-            # create Bibliography() object
-            bib = self.parse_bibtex_file(bibtex_filename)                
-            
-            # append to root node (document) then bail out
-            stack[0].append_child(bib)
-            return stack
+    def parse_label_macro(self, macroname, wnode, stack, **kwargs):
+        '''
+        Label: set as id attribute of nearest numbered container.
+        '''
+        # simple method: the immediate parent. This might be the best option.          
+        # stack[-1].label = wnode.nodeargs[0].nodelist[0].chars 
+        idx = -1
+        while (-idx < len(stack)) and (stack[idx].genus not in tax.numbered_genera) and (stack[idx].species not in tax.numbered_species):
+            idx = idx - 1 
+        stack[idx].label = wnode.nodeargs[0].nodelist[0].chars
+        return stack
 
-        #--------------------
-        # 2.2 Levels: chapter, section, subsection, subsubsection
-        if macroname in tax.macros['level']:
-
-           # pop stack to appropriate level
-            if macroname in ['chapter', 'section', 'subsection', 'subsubsection']:
-                if stack[-1].get_species() == 'subsubsection':
-                    subsubsec = stack.pop()
-                    stack[-1].append_child(subsubsec)
-                if macroname in ['chapter', 'section', 'subsection']:
-                    if stack[-1].get_species() == 'subsection':
-                        subsec = stack.pop()
-                        stack[-1].append_child(subsec)
-                    if macroname in ['chapter', 'section']:
-                        if stack[-1].get_species() == 'section':
-                            sec = stack.pop()
-                            stack[-1].append_child(sec)
-                        if macroname == 'chapter':
-                            if stack[-1].get_species() == 'chapter':
-                                chapter = stack.pop()
-                                stack[-1].append_child(chapter)
-            
-            # create new level node and push onto stack
+    def parse_pre_macro(self, macroname, wnode, stack, **kwargs):
+        '''
+        Preformatted text.
+        '''
+        if macroname in self.classes:
             node = self.classes[macroname]()
-            stack.append(node)
+        else:
+            node = NodeFactory(macroname, BaseClass=Content)
+        node.content =  walker.macro_node_to_latex(wnode)
+        # append to parent and bail out
+        stack[-1].append_child(node)
+        return stack
 
-            # parse the level title (recursive). 
-            # For theorem titles we used wnode.optargs[0].nodelist because
-            # there the title is passed as an optional argument (environment).
-            # Here wnode.nodeoptarg contains the short title (not implemented)
-            if wnode.nodeargs:
-                stack.append(Title())
-                stack = self.parse_walker_nodelist(wnode.nodeargs[0].nodelist, stack)
-                title = stack.pop()
-                stack[-1].append_child(title)
-        
-            # over and out
-            return stack
+    def parse_bibliography_macro(self, macroname, wnode, stack, **kwargs):
+        '''
+        Bibliography: reads .bib file.
+        '''
+        # check we have a LATEX_ROOT
+        if not self.filename:
+            raise LatexParserError("Cannot create bibliography. Latex source file not known.")
 
-        #--------------------
-        # 2.3 Items
-        if macroname in tax.macros['item']:
+        # find bibtex filename
+        bibtex_filename = self.get_bibtex_filename(wnode.nodeargs[0].nodelist[0].chars)
+        
+        # create Bibliography() object
+        bib = self.parse_bibtex_file(bibtex_filename)                
+        
+        # append to root node (document) then bail out
+        stack[0].append_child(bib)
+        return stack
 
-            # create item object            
-            node = self.classes[macroname]()
-            
-            # pop previous item off stack (if any) and append to parent list
-            if stack[-1].get_genus() == 'item':
-                prev = stack.pop()
-                stack[-1].append_child(prev)
-            
-            # now append this one
-            stack.append(node)           
-
-            # check for optional argument 
-            if wnode.nodeoptarg:
-                if macroname in ['question', 'part', 'subpart', 'subsubpart']:
-                    if wnode.nodeoptarg:
-                        pts = walker.node_to_latex(wnode.nodeoptarg)
-                        stack[-1].append_child(Points(value=pts))
+    def parse_level_macro(self, macroname, wnode, stack, **kwargs):
+        '''
+        Levels: chapter, section, subsection, subsubsection.
+        '''
+        # pop stack to appropriate level
+        if macroname in ['chapter', 'section', 'subsection', 'subsubsection']:
+            if stack[-1].species == 'subsubsection':
+                subsubsec = stack.pop()
+                stack[-1].append_child(subsubsec)
+            if macroname in ['chapter', 'section', 'subsection']:
+                if stack[-1].species == 'subsection':
+                    subsec = stack.pop()
+                    stack[-1].append_child(subsec)
+                if macroname in ['chapter', 'section']:
+                    if stack[-1].species == 'section':
+                        sec = stack.pop()
+                        stack[-1].append_child(sec)
+                    if macroname == 'chapter':
+                        if stack[-1].species == 'chapter':
+                            chapter = stack.pop()
+                            stack[-1].append_child(chapter)
         
-            return stack
+        # create new level node and push onto stack
+        node = self.classes[macroname]()
+        stack.append(node)
 
-        #--------------------
-        # 3. short ones
+        # parse the level title. 
+        # For theorem titles we used wnode.optargs[0].nodelist because
+        # there the title is passed as an optional argument (environment).
+        # Here wnode.nodeoptarg contains the short title (not implemented)
+        if wnode.nodeargs:
+            stack.append(Title())
+            return self.schedule(stack, 
+                self.nodelist_task(wnode.nodeargs[0].nodelist, SCAN, {}),
+                (self.pop_node, stack))
+    
+        # over and out
+        return stack
 
-        # breaks
-        if macroname == '\\' or macroname in tax.macros['break']:
-            node = Break()
+    def parse_item_macro(self, macroname, wnode, stack, **kwargs):
+        '''
+        Items: the previous item (if any) is closed.
+        '''
+        # create item object            
+        node = self.classes[macroname]()
+        
+        # pop previous item off stack (if any) and append to parent list
+        if stack[-1].genus == 'item':
+            prev = stack.pop()
+            stack[-1].append_child(prev)
         
-        # spaces
-        elif macroname.isspace() or macroname in tax.macros['space']:
-            node = Space()
-
-        # escaped characters
-        elif macroname in tax.macros['escaped']:
-            code = tax.escaped_encodings[macroname]
-            node = Text(text = code)            
-
-        # accents
-        elif macroname in tax.macros['accent']:
-            accent = macroname.strip()
-            character = wnode.nodeargs[0].nodelist[0].chars
-            text = character
-            if (accent, character) in tax.html_encodings:
-                text = tax.html_encodings[(accent, character)]
-            node = Text(text = text)            
+        # now append this one
+        stack.append(node)           
+
+        # check for optional argument 
+        if wnode.nodeoptarg:
+            if macroname in ['question', 'part', 'subpart', 'subsubpart']:
+                pts = walker.node_to_latex(wnode.nodeoptarg)
+                stack[-1].append_child(Points(value=pts))
+    
+        return stack
 
-        #--------------------
-        # 4A. subfigure (hack)
-        elif macroname == 'subfigure':
-            node = NodeFactory('subfigure', BaseClass=Macro)
-            stack.append(node)
-            if wnode.nodeoptarg:
-                stack.append(Title())
-                stack = self.parse_walker_node(wnode.nodeoptarg, stack)
-                title = stack.pop()
-                stack[-1].append_child(title)
-            if wnode.nodeargs:
-                stack = self.parse_walker_nodelist(wnode.nodeargs, stack)
-                node = stack.pop()
-                stack[-1].append_child(node)
-                return stack
+    def parse_break_macro(self, macroname, wnode, stack, **kwargs):
+        stack[-1].append_child(Break())
+        return stack
 
-        #--------------------
-        # 4B. media
-        elif macroname in tax.macros['media']:
-
-            # extract src or url
-            node = None
-            if wnode.nodeargs and len(wnode.nodeargs) > 0:
-                wnode2 = wnode.nodeargs[0].nodelist[0]
-                if hasattr(wnode2, 'chars'):
-                    if macroname == 'includegraphics':
-                        node = Image(src = wnode2.chars)
-                    if macroname == 'includevideo':
-                        node = Media(src = wnode2.chars)
-            
-            # compute approx. width from optional argument
-            if node and wnode.nodeoptarg:
-                pct = 30
-                if wnode.nodeoptarg.isNodeType(LatexGroupNode):
-                    raw = walker.nodelist_to_latex(wnode.nodeoptarg.nodelist)
-                else:
-                    raw = walker.nodelist_to_latex(wnode.nodeoptarg)
-                pairs = dict([s.split('=') for s in raw.split(',')])
-                if 'scale' in pairs:
-                    pct = 100*float(pairs['scale'])
-                elif 'width' in pairs:
-                    wspec = pairs['width']
-                    import re
-                    m = re.search(r'(.+)\\linewidth', wspec)
-                    if m:
-                        pct = 100*float(m.groups()[0])
-                    m = re.search(r'(.+)cm', wspec)
-                    if m:
-                        pct = 100*float(m.groups()[0])/15
-                node.width = int(float(pct)) # round
+    def parse_space_macro(self, macroname, wnode, stack, **kwargs):
+        stack[-1].append_child(Space())
+        return stack
 
-        #--------------------
-        # 5. xrefs and hrefs
-        elif macroname in tax.macros['xref'] + tax.macros['href']:
-            
-            # extract label or url (and the anchor text for href and hyperref)
-            if wnode.nodeargs and len(wnode.nodeargs) > 0:
-                node = self.classes[macroname]() 
-                node.content = wnode.nodeargs[0].nodelist[0].chars
-                if macroname in ['href', 'hyperref'] and len(wnode.nodeargs) > 1:
-                    stack.append(node)
-                    stack = self.parse_walker_node(wnode.nodeargs[1], stack)
-                    node = stack.pop()
+    def parse_escaped_macro(self, macroname, wnode, stack, **kwargs):
+        code = tax.escaped_encodings[macroname]
+        stack[-1].append_child(Text(text = code))
+        return stack
 
-        #--------------------
-        # 6. the rest
-        else:
-            if macroname in self.classes:
-                node = self.classes[macroname]()
+    def parse_accent_macro(self, macroname, wnode, stack, **kwargs):
+        accent = macroname.strip()
+        character = wnode.nodeargs[0].nodelist[0].chars
+        text = character
+        if (accent, character) in tax.html_encodings:
+            text = tax.html_encodings[(accent, character)]
+        stack[-1].append_child(Text(text = text))
+        return stack
+
+    def parse_subfigure_macro(self, macroname, wnode, stack, **kwargs):
+        '''
+        subfigure (hack)
+        '''
+        node = NodeFactory('subfigure', BaseClass=Macro)
+        stack.append(node)
+        tasks = []
+        if wnode.nodeoptarg:
+            stack.append(Title())
+            tasks.append(self.nodelist_task([wnode.nodeoptarg], PLAIN, {}))
+            tasks.append((self.pop_node, stack))
+        if wnode.nodeargs:
+            tasks.append(self.nodelist_task(wnode.nodeargs, SCAN, {}))
+        tasks.append((self.pop_node, stack))
+        return self.schedule(stack, *tasks)
+
+    def parse_media_macro(self, macroname, wnode, stack, **kwargs):
+        '''
+        Media: images and videos.
+        '''
+        # extract src or url
+        node = None
+        if wnode.nodeargs and len(wnode.nodeargs) > 0:
+            wnode2 = wnode.nodeargs[0].nodelist[0]
+            if hasattr(wnode2, 'chars'):
+                if macroname == 'includegraphics':
+                    node = Image(src = wnode2.chars)
+                if macroname == 'includevideo':
+                    node = Media(src = wnode2.chars)
+        if not node:
+            return stack
+        
+        # compute approx. width from optional argument
+        if wnode.nodeoptarg:
+            pct = 30
+            if wnode.nodeoptarg.isNodeType(LatexGroupNode):
+                raw = walker.nodelist_to_latex(wnode.nodeoptarg.nodelist)
             else:
-                node = NodeFactory(macroname, BaseClass=Macro)
-    
-            # call parse_walker_nodelist on the macro arguments (recursive)
-            if wnode.nodeargs:
+                raw = walker.nodelist_to_latex(wnode.nodeoptarg)
+            pairs = dict([s.split('=') for s in raw.split(',')])
+            if 'scale' in pairs:
+                pct = 100*float(pairs['scale'])
+            elif 'width' in pairs:
+                wspec = pairs['width']
+                m = re.search(r'(.+)\\linewidth', wspec)
+                if m:
+                    pct = 100*float(m.groups()[0])
+                m = re.search(r'(.+)cm', wspec)
+                if m:
+                    pct = 100*float(m.groups()[0])/15
+            node.width = int(float(pct)) # round
+
+        stack[-1].append_child(node)
+        return stack
+
+    def parse_reference_macro(self, macroname, wnode, stack, **kwargs):
+        '''
+        xrefs and hrefs
+        '''
+        # extract label or url (and the anchor text for href and hyperref)
+        if wnode.nodeargs and len(wnode.nodeargs) > 0:
+            node = self.classes[macroname]() 
+            node.content = wnode.nodeargs[0].nodelist[0].chars
+            if macroname in ['href', 'hyperref'] and len(wnode.nodeargs) > 1:
                 stack.append(node)
-                stack = self.parse_walker_nodelist(wnode.nodeargs, stack, **kwargs)
-                node = stack.pop()
+                return self.schedule(stack, 
+                    self.nodelist_task([wnode.nodeargs[1]], PLAIN, {}),
+                    (self.pop_node, stack))
+            stack[-1].append_child(node)
+        return stack
 
-        # append new node (if any) to children of parent and bail out
-        if node:
-            stack[-1].append_child(node)           
+    def parse_default_macro(self, macroname, wnode, stack, **kwargs):
+        '''
+        The rest: unlisted macros are subclassed from Macro (no genus)
+        '''
+        if macroname in self.classes:
+            node = self.classes[macroname]()
+        else:
+            node = NodeFactory(macroname, BaseClass=Macro)
+
+        # parse the macro arguments
+        if wnode.nodeargs:
+            stack.append(node)
+            return self.schedule(stack, 
+                self.nodelist_task(wnode.nodeargs, SCAN, kwargs),
+                (self.pop_node, stack))
+
+        # append new node to children of parent and bail out
+        stack[-1].append_child(node)           
         return stack
   
 
@@ -549,7 +680,7 @@ class LatexParser(object):
 
         if wnode.displaytype == 'inline':
             node = Latex()
-        elif wnode.displaytype in tax.environments['dispmath']:
+        elif wnode.displaytype in tax.environment_sets['dispmath']:
             node = self.classes[wnode.displaytype]()        
         else:
             node = NodeFactory(wnode.displaytype, BaseClass=Environment)
@@ -560,125 +691,130 @@ class LatexParser(object):
         return stack
         
 
-    def parse_walker_node(self, wnode, stack, **kwargs):
+    def dispatch_walker_node(self, wnode, stack, kwargs):
         '''
-        Parse a walker node object. Returns a LatexTreeNode object 
+        Call the handler registered for the type of a walker node (see 
+        NODE_HANDLERS and register_node_handler).
         '''
-        if wnode.isNodeType(LatexCharsNode):
-            return self.parse_walker_chars_node(wnode, stack)
-        
-        elif wnode.isNodeType(LatexCommentNode):
-            return self.parse_walker_comment_node(wnode, stack)
-        
-        elif wnode.isNodeType(LatexMathNode):
-            return self.parse_walker_math_node(wnode, stack, **kwargs)
-        
-        elif wnode.isNodeType(LatexGroupNode):
-            return self.parse_walker_group_node(wnode, stack, **kwargs)
+        handler = self.node_handlers.get(type(wnode))
+        if handler is None:
+            # subclasses of the walker node types
+            for node_type in self.node_handlers:
+                if isinstance(wnode, node_type):
+                    handler = self.node_handlers[node_type]
+                    break
+            else:
+                raise LatexParserError("Expected LatexNode object, not `%s'" % type(wnode))
+        return handler(self, wnode, stack, **kwargs)
 
-        elif wnode.isNodeType(LatexEnvironmentNode):
-            return self.parse_walker_environment_node(wnode, stack, **kwargs)
-        
-        elif wnode.isNodeType(LatexMacroNode):
-            return self.parse_walker_macro_node(wnode, stack, **kwargs)
-        else:
-            raise LatexParserError("Expected LatexNode object, not `%s'" % type(wnode))
-            return None
-        
+    def parse_walker_node(self, wnode, stack, **kwargs):
+        '''
+        Parse a walker node object. The new LatexTreeNode objects are 
+        appended to the children of stack[-1]. Returns the stack.
+        '''
+        return self.run_work(stack, [self.nodelist_task([wnode], PLAIN, kwargs)])
     
     def parse_walker_nodelist(self, walker_nodelist, stack, **kwargs):
         '''
-        Parse a list of LatexNode objects.
-        Returns a list of LatexTreeNode objects 
+        Parse a list of LatexNode objects. The new LatexTreeNode objects are
+        appended to the children of stack[-1]. Returns the stack.
                 
-        The function pre-processes the list of LatexNode objects, and 
-        combines them where necessary into nicer LatexNode objects, before 
-        parsing them to produce LatexTreeNode objects
-        
         The \[ command means we enter "dispmathmode", where all subsequent
         nodes are appended to a new LatexMathNode until a \] command is 
-        encountered, at which point the new LatexMathNode is closed, i.e. 
-        popped from the stack and appended to the children of its parent node.
-        
-        Having combined LatexNodes in this way, we can then safely use
-        parse_walker_node() on each of the (possibly modified) LatexNodes.
-        The function parse_walker_math_node is called on the new 
-        LatexMathNode objects/ This function deals with the _ and ^ commands.
+        encountered (see run_work). The function parse_walker_math_node is 
+        called on the new LatexMathNode objects. This function deals with
+        the _ and ^ commands.
         
         The individual LatexTreeNode objects are appended as children to
-        the stack_top node (parent container) inside their individual
-        parse_walker_node functions (parse_walker_macro_node etc.)
-        
-        STRANGE BEHAVIOUR: if we set
-            walker_node = LatexMathNode(displaytype='displaymath')
-        you might assume that the walker_node.nodelist will be empty
-        but it appears not! Adding nodes directly as
-            walker_node.nodelist.append(new_walker_node)
-        results in lots of previously-encountered text being present 
-        in walker_node.nodelist
-        Starting with new_nodelist = [] then adding to this before 
-        setting walker_node.nodelist = new_nodelist at the end seems to work.
-        '''
-
-        idx = 0
-        while idx < len(walker_nodelist):
-
-            if walker_nodelist[idx] is None:
-                idx = idx + 1 
-                continue
-                
-            wnode = walker_nodelist[idx]
-            
-            # check for \[ macro. This is an alias for \begin{displaymath}
-            # check also for \(...\), which is an alternative to $....$
-            if (walker_nodelist[idx].isNodeType(LatexMacroNode) and 
-                    walker_nodelist[idx].macroname in ['[', '(']):
-                macroname = walker_nodelist[idx].macroname
-                # assemble new nodelist
-                new_nodelist = []
-                while idx < len(walker_nodelist):
-                    idx = idx + 1
-                    if (walker_nodelist[idx].isNodeType(LatexMacroNode) and 
-                            walker_nodelist[idx].macroname in [']',')']):
-                        break
-                    new_nodelist.append(walker_nodelist[idx])                
-                # create new LatexMathNode
-                displaytype = 'displaymath' if macroname == '[' else 'inline'
-                walker_node = LatexMathNode(displaytype=displaytype)
-                walker_node.nodelist = new_nodelist
-
-            # next look for "\itemize \item \item \enditemize"-type constructions
-            elif (walker_nodelist[idx].isNodeType(LatexMacroNode) and 
-                    walker_nodelist[idx].macroname in tax.environment_species):
-                macroname = walker_nodelist[idx].macroname
-                end_macroname = 'end' + macroname
-                new_nodelist = []
-                while idx < len(walker_nodelist):
-                    idx = idx + 1
-                    if (walker_nodelist[idx].isNodeType(LatexMacroNode) and 
-                            walker_nodelist[idx].macroname == end_macroname):
-                        break
-                    new_nodelist.append(walker_nodelist[idx])
-                # create new LatexEnvironmentNode
-                walker_node = LatexEnvironmentNode(envname=macroname, nodelist=[])
-                walker_node.nodelist = new_nodelist
-                
-            # # check for switches
-            # elif (walker_nodelist[idx].isNodeType(LatexMacroNode) and
-            #         walker_nodelist[idx].macroname in tax.switches):
-            #     switchname = walker_nodelist[idx].macroname
-            #     print '***********************%s' % walker_nodelist[idx].macroname
-            
-            # otherwise just take next one
-            else:
-                walker_node = walker_nodelist[idx]
-            
-            # parse the walker_wnode and move to next
-            stack = self.parse_walker_node(walker_node, stack, **kwargs)
-            idx = idx + 1
-        
+        the stack_top node (parent container) by the handlers of the walker
+        nodes (parse_walker_macro_node etc.)
+        '''
+        return self.run_work(stack, [self.nodelist_task(walker_nodelist, SCAN, kwargs)])
+
+    #--------------------
+    # Work stack
+    # Nested walker nodes are not parsed recursively. Instead, handlers
+    # push tasks onto self.work (see schedule), where a task is either
+    #   [nodelist, index, end, mode, kwargs]: parse nodelist[index:end]
+    #   (function, arg, ...): call function(arg, ...)
+    # Tasks are run by run_work (last in, first out).
+    #--------------------
+
+    def nodelist_task(self, nodelist, mode, kwargs):
+        '''
+        Task to parse a list (or walker.NodeRange) of LatexNode objects.
+            mode: SCAN (combine \[...\] and \itemize...\enditemize runs), 
+                  PLAIN (parse each node) or GROUP (PLAIN and push switches)
+        '''
+        nodelist, start, end = walker.get_range(nodelist)
+        return [nodelist, start, end, mode, kwargs]
+
+    def schedule(self, stack, *tasks):
+        '''
+        Push tasks onto the work stack (the first task is run first). 
+        Handlers call this last, and return its value (the stack). 
+        Outside run_work the tasks are run immediately.
+        '''
+        if self.work is None:
+            return self.run_work(stack, tasks)
+        self.work.extend(reversed(tasks))
+        return stack
+
+    def run_work(self, stack, tasks):
+        '''
+        Run tasks, and the tasks they schedule, until none are left.
+        Returns the stack.
+
+        In SCAN mode, a \[ or \( macro starts a run of nodes ending with
+        the next \] or \) macro, which is parsed as a LatexMathNode. 
+        Similarly, \itemize...\enditemize runs are parsed as environments.
+        Runs are passed as walker.NodeRange objects (no copies).
+        '''
+        outer_work, self.work = self.work, list(reversed(tasks))
+        work = self.work
+        try:
+            while work:
+                task = work[-1]
+                if type(task) is tuple:
+                    work.pop()
+                    task[0](*task[1:])
+                    continue
+
+                nodelist, idx, end, mode, kwargs = task
+                if idx >= end:
+                    work.pop()
+                    continue
+                wnode = nodelist[idx]
+                task[1] = idx + 1
+                if wnode is None:
+                    continue
+
+                if wnode.isNodeType(LatexMacroNode):
+                    macroname = wnode.macroname
+                    if mode == SCAN:
+                        # \[...\] is an alias for \begin{displaymath}...\end{displaymath}
+                        # and \(...\) an alternative to $....$
+                        if macroname in ('[', '('):
+                            close = walker.find_macro(nodelist, idx + 1, end, (']', ')'))
+                            displaytype = 'displaymath' if macroname == '[' else 'inline'
+                            wnode = LatexMathNode(displaytype=displaytype, nodelist=walker.NodeRange(nodelist, idx + 1, close))
+                            task[1] = close + 1
+
+                        # "\itemize \item \item \enditemize"-type constructions
+                        elif macroname in tax.environment_species:
+                            close = walker.find_macro(nodelist, idx + 1, end, ('end' + macroname,))
+                            wnode = LatexEnvironmentNode(envname=macroname, nodelist=walker.NodeRange(nodelist, idx + 1, close))
+                            task[1] = close + 1
+
+                    elif mode == GROUP and macroname in tax.switch_species:
+                        self.parse_walker_switch(wnode, stack)
+                        continue
+
+                self.dispatch_walker_node(wnode, stack, kwargs)
+        finally:
+            self.work = outer_work
         return stack
-        
+
 
     def parse_walker_preamble(self, walker_nodelist):
         '''
@@ -738,18 +874,275 @@ class LatexParser(object):
         from preprocessor import LatexPreProcessor
         pp = LatexPreProcessor()
         text = pp.preprocess(text)
-        walker_nodes = walker.parse(text)
+        walker_nodes = walker.parse(text, front_end=self.front_end)
         root = NodeFactory('root', BaseClass=LatexTreeNode)
         stack = [root]
         self.parse_walker_nodelist(walker_nodes, [root], **kwargs)
         return stack[0]
         
 
-    def parse_latex_document(self, text, **kwargs):
+    def get_bibtex_filename(self, name):
+        '''
+        Locate a bibtex file (relative to the latex source file).
+        '''
+        if '.' not in name:
+            name += '.bib'
+        return os.path.join(os.path.abspath(os.path.dirname(self.filename)), name)
+
+
+    def create_root(self, preamble):
+        '''
+        Create the root node. Its class is given by \documentclass (if known).
+        '''
+        doc_class = preamble.get('documentclass')
+        if doc_class in self.classes:
+            return self.classes[doc_class]()
+        return NodeFactory('root', BaseClass=LatexTreeNode)
+
+
+    def split_latex_document(self, text):
+        '''
+        Split a (preprocessed) latex document into pieces that can be parsed
+        separately. Returns (preamble, shards) where preamble is the text 
+        outside the document environment and shards are the pieces of its 
+        body, split before each top-level \chapter (or \section if there 
+        are no chapters). Returns None if there is no document environment.
+
+        Top-level commands are those outside braces, environments, \[...\]
+        and \itemize...\enditemize. Each of these pops the stack back to the
+        root node, so parsing the shards in turn gives the same tree as
+        parsing the whole body.
+        '''
+        depth = 0
+        envs = []
+        begin = end = None
+        levels = {'chapter': [], 'section': []}
+        for match in SHARD_RE.finditer(text):
+            kind = match.lastgroup
+            if kind == 'brace':
+                depth += 1 if match.group(kind) == '{' else -1
+            elif kind in ('begin', 'open'):
+                if match.group(kind) == 'document' and begin is None and not envs and not depth:
+                    begin = match
+                envs.append(match.group(kind))
+            elif kind in ('end', 'close'):
+                if envs:
+                    envs.pop()
+                if match.group(kind) == 'document' and begin and not envs and not depth:
+                    end = match
+                    break
+            elif kind == 'macro':
+                name = match.group(kind)
+                if name in tax.environment_species:
+                    envs.append(name)
+                elif envs and name == 'end' + envs[-1]:
+                    envs.pop()
+            elif kind == 'level' and envs == ['document'] and not depth:
+                levels[match.group(kind)].append(match.start())
+
+        if not (begin and end):
+            return None
+        positions = [begin.end()] + (levels['chapter'] or levels['section']) + [end.start()]
+        shards = [text[start:stop] for start, stop in zip(positions[:-1], positions[1:])]
+        return text[:begin.start()] + text[end.end():], shards
+
+
+    def parse_latex_shard(self, text, root_class, cache=None, **kwargs):
+        '''
+        Parse a piece of a document body (see split_latex_document).
+        Returns a root node of class root_class whose children are the 
+        top-level nodes of the piece.
+
+        If a ParseCache is given, the subtree is looked up under a key 
+        computed from the text, root_class, kwargs and the contents of any 
+        bibtex files, and stored there after parsing.
+        '''
+        key = None
+        if cache is not None:
+            key = self.get_shard_key(cache, text, root_class, **kwargs)
+        if key:
+            records = cache.get(key)
+            if records is not None:
+                return load_tree(records, self.named_classes)
+
+        root = self.build_latex_shard(text, root_class, **kwargs)
+        if key:
+            cache.put(key, dump_tree(root))
+        return root
+
+
+    def get_shard_key(self, cache, text, root_class, **kwargs):
+        '''
+        Cache key of a shard: computed from the text, root_class, kwargs, 
+        the front end, any handlers registered on this parser (see 
+        get_handlers_key) and the contents of any bibtex files.
+        Returns None if the shard should not be cached.
+        '''
+        handlers_key = self.get_handlers_key()
+        if handlers_key is None:
+            return None
+        parts = [text, '.'.join(get_class_names(root_class)), repr(sorted(kwargs.items())), self.front_end or walker.DEFAULT_FRONT_END, handlers_key]
+        for name in BIBLIOGRAPHY_RE.findall(text):
+            bibtex_filename = self.get_bibtex_filename(name.strip())
+            if os.path.exists(bibtex_filename):
+                with open(bibtex_filename) as bibtex_file:
+                    parts.append(bibtex_file.read())
+        return cache.get_key(*parts)
+
+
+    def get_handlers_key(self):
+        '''
+        Part of the cache key for the handlers registered on this parser:
+        the name, module and source of each handler in the tables that are
+        not shared (see can_fork). Returns '' if no handlers have been 
+        registered and None if the source of a handler is not available.
+        '''
+        parts = []
+        for handlers in (self.node_handlers, self.macro_handlers, self.environment_handlers):
+            if isinstance(handlers, FrozenMapping):
+                parts.append('')
+                continue
+            for name, handler in sorted(handlers.items()):
+                handler = getattr(handler, 'im_func', handler)
+                try:
+                    source = inspect.getsource(handler)
+                except (IOError, TypeError):
+                    logger.info('Source of handler %s not found: shards are not cached.', name)
+                    return None
+                parts.append('%r %s.%s\n%s' % (name, handler.__module__, getattr(handler, '__name__', ''), source))
+        if not any(parts):
+            return ''
+        return hashlib.sha1('\0'.join(parts)).hexdigest()
+
+
+    def build_latex_shard(self, text, root_class, **kwargs):
+        '''
+        Parse a shard (without the cache).
+        '''
+        # parse in a document environment (trailing whitespace is dropped at the end of the input)
+        walker_nodes = walker.parse('\\begin{document}' + text + '\\end{document}', front_end=self.front_end)[0].nodelist
+        root = root_class()
+        stack = self.parse_walker_nodelist(walker_nodes, [root], **kwargs)
+        while len(stack) > 1:
+            node = stack.pop()
+            stack[-1].append_child(node)
+        return root
+
+
+    def can_fork(self):
+        '''
+        Can shards be parsed by copies of this parser in other processes?
+        Not if handlers have been registered on this parser (they may not
+        be picklable).
+        '''
+        return all([isinstance(handlers, FrozenMapping) for handlers in (self.node_handlers, self.macro_handlers, self.environment_handlers)])
+
+
+    def parse_latex_shards_in_pool(self, shards, root_class, processes, cache=None, **kwargs):
+        '''
+        Parse shards (a dict: index -> text) in a pool of worker processes.
+        Shards found in the cache are not sent to the pool. The workers 
+        return the parsed subtrees, which are pickled as flat tables (see 
+        LatexTreeNode.__reduce__). Returns a dict: index -> root node 
+        (see parse_latex_shard).
+        '''
+        roots = {}
+        keys = {}
+        for idx, text in shards.items():
+            if cache is not None:
+                keys[idx] = self.get_shard_key(cache, text, root_class, **kwargs)
+            if keys.get(idx):
+                records = cache.get(keys[idx])
+                if records is not None:
+                    roots[idx] = load_tree(records, self.named_classes)
+        todo = sorted([idx for idx in shards if idx not in roots])
+        if not todo:
+            return roots
+
+        import multiprocessing
+        tasks = [(self.__class__, self.front_end, self.filename, shards[idx], root_class, kwargs) for idx in todo]
+        pool = multiprocessing.Pool(min(processes, len(tasks)))
+        try:
+            results = pool.map(parse_shard_task, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        for idx, root in zip(todo, results):
+            roots[idx] = root
+            if keys.get(idx):
+                cache.put(keys[idx], dump_tree(root))
+        return roots
+
+
+    def parse_latex_shards(self, doc, shards, cache=None, previous=None, processes=None, **kwargs):
+        '''
+        Parse the shards of a document body and append their top-level nodes
+        to doc.root. Sets doc.shards (see get_shard_nodes).
+        Returns the indices of the shards that were parsed.
+        '''
+        doc.shards, parsed = self.get_shard_nodes(shards, type(doc.root), cache=cache, previous=previous, processes=processes, **kwargs)
+        for digest, nodes, label in doc.shards:
+            if label:
+                doc.root.label = label
+            for node in nodes:
+                doc.root.append_child(node)
+        return parsed
+
+
+    def get_shard_nodes(self, shards, root_class, cache=None, previous=None, processes=None, **kwargs):
+        '''
+        Parse the shards of a document body. previous is the doc.shards list
+        of an earlier parse: shards with the same text keep their nodes 
+        instead of being parsed. Returns (a list of (hash of text, top-level
+        nodes, root label) tuples, the indices of the shards that were parsed).
+
+        If processes is more than one, the shards are parsed in a pool of
+        that many worker processes (see parse_latex_shards_in_pool). The
+        shards are returned in document order, so the tree is the same 
+        as that of a serial parse.
+        '''
+        reusable = {}
+        for digest, nodes, label in previous or []:
+            reusable.setdefault(digest, []).append((nodes, label))
+
+        # which shards need parsing?
+        digests = [hashlib.sha1(text.encode('utf-8') if isinstance(text, unicode) else text).hexdigest() for text in shards]
+        reused = {}
+        for idx, digest in enumerate(digests):
+            if reusable.get(digest):
+                reused[idx] = reusable[digest].pop(0)
+        roots = {}
+        if processes and processes > 1 and len(shards) - len(reused) > 1 and self.can_fork():
+            todo = dict([(idx, text) for idx, text in enumerate(shards) if idx not in reused])
+            roots = self.parse_latex_shards_in_pool(todo, root_class, processes, cache=cache, **kwargs)
+
+        entries = []
+        parsed = []
+        for idx, text in enumerate(shards):
+            if idx in reused:
+                nodes, label = reused[idx]
+            else:
+                root = roots.get(idx) or self.parse_latex_shard(text, root_class, cache=cache, **kwargs)
+                nodes, label = root.children, getattr(root, 'label', None)
+                parsed.append(idx)
+            entries.append((digests[idx], nodes, label))
+        return entries, parsed
+
+
+    def parse_latex_document(self, text, cache=None, processes=None, **kwargs):
         '''
         Parse a latex document. Returns a LatexDocument object.
         Wrepper for parse_walker_nodelist
         The text must have a \begin{document} ... \end{document} element.
+
+        The body is split into shards (chapters or sections, see 
+        split_latex_document) which are parsed in turn. If a ParseCache is 
+        given, the subtree of each shard is taken from the cache if the shard
+        has been parsed before. If processes is more than one, the shards are
+        parsed in that many worker processes (see parse_latex_shards). 
+        Numbers, titles and xrefs are computed for the whole document once
+        the shards have been put together.
         '''        
         #--------------------
         # preprocess
@@ -757,16 +1150,27 @@ class LatexParser(object):
         pp = LatexPreProcessor()
         text = pp.preprocess(text)
 
-        #--------------------
-        # initial parse using LatexWalker (returns a list of LatexNode objects)
-        walker_nodes = walker.parse(text)
-
         #--------------------
         # init LatexDocument object
         doc = LatexDocument()
         if hasattr(self, 'filename') and self.filename:
             doc.filename = self.filename
 
+        #--------------------
+        # parse shard by shard (see split_latex_document)
+        split = self.split_latex_document(text)
+        if split:
+            preamble, shards = split
+            doc.preamble = self.parse_walker_preamble(walker.parse(preamble, front_end=self.front_end))
+            doc.root = self.create_root(doc.preamble)
+            self.parse_latex_shards(doc, shards, cache=cache, processes=processes, **kwargs)
+            self.postprocess_document(doc)
+            return doc
+
+        #--------------------
+        # initial parse using LatexWalker (returns a list of LatexNode objects)
+        walker_nodes = walker.parse(text, front_end=self.front_end)
+
         #--------------------
         # parse preamble
         doc.preamble = self.parse_walker_preamble(walker_nodes)
@@ -778,11 +1182,7 @@ class LatexParser(object):
             if type(wnode) == LatexEnvironmentNode and wnode.envname == 'document':
                 
                 # check preamble for document class
-                doc.root = NodeFactory('root', BaseClass=LatexTreeNode)
-                if 'documentclass' in doc.preamble:
-                    doc_class = doc.preamble['documentclass']
-                    if doc_class in self.classes:
-                        doc.root = self.classes[doc_class]()
+                doc.root = self.create_root(doc.preamble)
 
                 # init stack
                 stack = [doc.root]
@@ -800,19 +1200,21 @@ class LatexParser(object):
                 
         #--------------------
         # postprocess
-        if doc.root:
-            doc.root.set_numbers()
-            doc.root.set_titles()
-            doc.xrefs = doc.root.get_xref_dict()
-            doc.images = doc.root.get_phenotypes('image')
-            doc.videos = doc.root.get_phenotypes('media')
-            
+        self.postprocess_document(doc)
 
         # end
         return doc
+
+
+    def postprocess_document(self, doc):
+        '''
+        Set numbers and titles, collect xrefs, images, videos etc. 
+        in one traversal of the tree (see postprocessor.py).
+        '''
+        LatexPostProcessor().postprocess(doc)
         
         
-    def parse_latex_file(self, filename, **kwargs):
+    def parse_latex_file(self, filename, keep_source=False, use_mmap=False, encoding=None, **kwargs):
         '''
         The main entry point.  We record the filename in the LatexParser which
         is passed onto the resulting LatexDocument object.
@@ -823,19 +1225,97 @@ class LatexParser(object):
             e.g. /tex/MA1234/main.tex -> /web/MA1234/index.html
         We also need to copy images
             e.g. /tex/MA1234/figures/pic.png -> /tex/MA1234/static/img/pic.png
+        The source files can be memory-mapped (use_mmap) and decoded (encoding),
+        see reader.resolve_latex_document, and are recorded in doc.head for
+        update_latex_document. The assembled source is only kept
+        in doc.head['source'] if keep_source is True. A ParseCache can be
+        passed as cache (see parse_latex_document).
         '''
         filename = os.path.abspath(filename) if filename else None
         if filename:
             self.filename = filename
             import reader
-            text = reader.read_latex_document(filename)
+            text, graph = reader.resolve_latex_document(filename, use_mmap=use_mmap, encoding=encoding)
             doc = self.parse_latex_document(text, **kwargs)
             doc.head['filename'] = filename
-            doc.head['source'] = text
+            doc.head['encoding'] = encoding
+            doc.head['use_mmap'] = use_mmap
+            if keep_source:
+                doc.head['source'] = text
+            doc.head['dependencies'] = graph
+            doc.head['source_map'] = graph.source_map
             return doc            
         return None
         
         
+    def update_latex_document(self, doc, changed_files=None, cache=None, **kwargs):
+        '''
+        Update a document created by parse_latex_file after some of its 
+        source files have changed (by default, the files modified since
+        they were read). The source is read and split into shards again: 
+        shards whose text has not changed keep their subtrees, the others 
+        are parsed. The top-level nodes of doc.root are replaced from the 
+        first changed one on, and only those are indexed again and visited
+        by the postprocessor, which restarts from the numbers, xrefs, images
+        and videos recorded before that node (see postprocessor.py).
+        The parse options (kwargs) should be those of the original parse.
+        Returns the indices of the shards that were parsed.
+        '''
+        filename = doc.head.get('filename')
+        graph = doc.head.get('dependencies')
+        if not filename or graph is None:
+            raise LatexParserError("Cannot update document. Latex source file not known.")
+
+        # anything to do?
+        if changed_files is None:
+            changed_files = graph.modified_files()
+        if not [name for name in changed_files if os.path.abspath(name) in graph]:
+            return []
+
+        # read and split the source again
+        import reader
+        from preprocessor import LatexPreProcessor
+        self.filename = filename
+        source, graph = reader.resolve_latex_document(filename, use_mmap=doc.head.get('use_mmap', False), encoding=doc.head.get('encoding'))
+        text = LatexPreProcessor().preprocess(source)
+        split = self.split_latex_document(text)
+        preamble = self.parse_walker_preamble(walker.parse(split[0], front_end=self.front_end)) if split else {}
+
+        # start again if the document cannot be spliced
+        if not (split and doc.shards and doc.root) or preamble.get('documentclass') != doc.preamble.get('documentclass'):
+            new_doc = self.parse_latex_document(source, cache=cache, **kwargs)
+            doc.root, doc.preamble, doc.shards = new_doc.root, new_doc.preamble, new_doc.shards
+            parsed = range(len(doc.shards))
+            start = None
+        else:
+            doc.preamble = preamble
+            doc.shards, parsed = self.get_shard_nodes(split[1], type(doc.root), cache=cache, previous=doc.shards, **kwargs)
+
+            # replace the top-level nodes from the first changed one on
+            children = [node for digest, nodes, label in doc.shards for node in nodes]
+            start = 0
+            while start < min(len(children), len(doc.root.children)) and children[start] is doc.root.children[start]:
+                start += 1
+            removed = doc.root.replace_children(start, children[start:])
+            labels = [label for digest, nodes, label in doc.shards if label]
+            if doc.root.label != (labels[-1] if labels else None):
+                doc.root.label = labels[-1] if labels else None
+                start = None
+
+        doc.head['dependencies'] = graph
+        doc.head['source_map'] = graph.source_map
+        if 'source' in doc.head:
+            doc.head['source'] = source
+
+        # numbers, titles, xrefs etc. from the first changed node on
+        processor = doc.postprocessor
+        if start is not None and processor is not None and len(processor.checkpoints) == start + len(removed) + 1:
+            processor.repostprocess(doc, start, removed)
+        else:
+            self.postprocess_document(doc)
+        return parsed
+
+
     def parse_bibtex_file(self, bibtex_filename):
         '''
         Create Bibliography() object from a bibtex file
@@ -846,6 +1326,22 @@ class LatexParser(object):
         
 
     
+#------------------------------------------------
+# worker processes (see LatexParser.parse_latex_shards_in_pool)
+#------------------------------------------------
+def parse_shard_task(task):
+    '''
+    Parse a shard in a worker process. task is a tuple
+        (parser class, front end, filename, text, root class, kwargs)
+    Returns the root node of the subtree.
+    '''
+    parser_class, front_end, filename, text, root_class, kwargs = task
+    parser = parser_class()
+    parser.front_end = front_end
+    parser.filename = filename
+    return parser.build_latex_shard(text, root_class, **kwargs)
+
+
 #------------------------------------------------
 def main(args=None):
 
@@ -0,0 +1,169 @@
+"""
+postprocessor.py
+Post-processing of LatexTree documents.
+
+After parsing, LatexPostProcessor visits every node of the tree once (in
+document order) and
+    sets numbers (see taxonomy.counters) and titles
+    collects labels (xrefs), images, videos, quizzes and the bibliography
+    records the enclosing chapter and section of each node
+
+The top-level nodes (children of the root) are visited in turn and the
+state of the visitor (counters, number of images etc.) is recorded before
+each of them. When the top-level nodes are replaced from some position on
+(see LatexParser.update_latex_document), repostprocess goes back to the
+state recorded at that position and visits only the new nodes.
+
+>>> from postprocessor import LatexPostProcessor
+>>> LatexPostProcessor().postprocess(doc)
+>>> doc.xrefs['fig:union'].number
+"""
+
+import taxonomy as tax
+from node import set_node_number
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class LatexPostProcessor(object):
+    '''
+    Single-pass visitor for LatexTree documents.
+        counters - current value of each counter
+        xrefs - label -> node
+        images, videos, quizzes - lists of nodes (document order)
+        bibliography - first bibliography node (or None)
+        enclosing - node -> (enclosing chapter, enclosing section)
+        history - (label, previous node or None) for each xref set
+        checkpoints - the state before each top-level node and at the end
+    '''
+    def __init__(self):
+        self.counters = dict.fromkeys(tax.counters, 0)
+        self.xrefs = {}
+        self.images = []
+        self.videos = []
+        self.quizzes = []
+        self.bibliography = None
+        self.enclosing = {}
+        self.history = []
+        self.checkpoints = []
+
+    def visit(self, root, children=None):
+        '''
+        Visit the subtree at root (including root). children is a function
+        returning the children to visit (default: all), see iter_events.
+        '''
+        counters = self.counters
+        chapters = [None]
+        sections = [None]
+        enclosing = (None, None)
+        for node, depth, entering in root.iter_events(children):
+            species = node.species
+
+            if not entering:
+                if species == 'chapter':
+                    chapters.pop()
+                    enclosing = (chapters[-1], sections[-1])
+                elif species == 'section':
+                    sections.pop()
+                    enclosing = (chapters[-1], sections[-1])
+                continue
+
+            # enclosing chapter and section (includes the node itself)
+            if species == 'chapter':
+                chapters.append(node)
+                enclosing = (node, sections[-1])
+            elif species == 'section':
+                sections.append(node)
+                enclosing = (chapters[-1], node)
+            self.enclosing[node] = enclosing
+
+            # numbers
+            if node.genus in counters or species in counters:
+                set_node_number(node, counters)
+
+            # titles
+            title = node.get_title_node()
+            if title:
+                node.title = title
+
+            # labels
+            if node.label:
+                self.history.append((node.label, self.xrefs.get(node.label)))
+                self.xrefs[node.label] = node
+
+            # collections
+            if species == 'image':
+                self.images.append(node)
+            elif species == 'media':
+                self.videos.append(node)
+            elif species == 'quiz':
+                self.quizzes.append(node)
+            elif species == 'bibliography' and self.bibliography is None:
+                self.bibliography = node
+
+    def get_checkpoint(self):
+        return (dict(self.counters), len(self.images), len(self.videos), len(self.quizzes), self.bibliography, len(self.history))
+
+    def restore_checkpoint(self, checkpoint):
+        '''
+        Go back to the state of an earlier checkpoint (the enclosing dict
+        is not changed).
+        '''
+        counters, num_images, num_videos, num_quizzes, self.bibliography, num_xrefs = checkpoint
+        self.counters = dict(counters)
+        del self.images[num_images:]
+        del self.videos[num_videos:]
+        del self.quizzes[num_quizzes:]
+        while len(self.history) > num_xrefs:
+            label, node = self.history.pop()
+            if node is None:
+                del self.xrefs[label]
+            else:
+                self.xrefs[label] = node
+
+    def visit_top_level(self, root, start=0):
+        '''
+        Visit the children of root from root.children[start] on.
+        '''
+        del self.checkpoints[start:]
+        for child in root.children[start:]:
+            self.checkpoints.append(self.get_checkpoint())
+            self.visit(child)
+        self.checkpoints.append(self.get_checkpoint())
+
+    def postprocess(self, doc):
+        '''
+        Visit the tree of a LatexDocument and set its xrefs, images, videos,
+        quizzes, bibliography and enclosing attributes (and postprocessor,
+        see repostprocess).
+        '''
+        if doc.root:
+            self.visit(doc.root, children=lambda node: [])
+            self.visit_top_level(doc.root)
+        self.set_attributes(doc)
+        return doc
+
+    def repostprocess(self, doc, start, removed):
+        '''
+        Update a document postprocessed by this object after the children 
+        of doc.root from position start on have been replaced (removed 
+        lists the old ones, see LatexTreeNode.replace_children). Only the
+        new children are visited.
+        '''
+        self.restore_checkpoint(self.checkpoints[start])
+        for node in removed:
+            for node in node.iter_nodes():
+                self.enclosing.pop(node, None)
+        self.visit_top_level(doc.root, start)
+        self.set_attributes(doc)
+        return doc
+
+    def set_attributes(self, doc):
+        doc.postprocessor = self
+        doc.xrefs = self.xrefs
+        doc.images = self.images
+        doc.videos = self.videos
+        doc.quizzes = self.quizzes
+        doc.bibliography = self.bibliography
+        doc.enclosing = self.enclosing
@@ -5,32 +5,318 @@ Created on Sun Jul 16 20:01:27 2017
 @author: scmde
 """
 
+import re
+from collections import namedtuple
+
+import taxonomy as tax
+import macrosdef
+
 import logging
 logger = logging.getLogger(__name__)
 
 
+# macro definitions, control words, escaped characters (e.g. \\) and comments in one pattern
+MACRO_PATTERN = (
+    r'\\def\s*\\(?P<defname>[a-zA-Z]+)(?P<params>(?:\s*#\d)*)\s*'
+    r'|\\(?P<command>newcommand|renewcommand|providecommand)(?![a-zA-Z])\*?'
+    r'|\\(?P<name>[a-zA-Z]+)'
+    r'|\\.'
+    r'|%[^\n]*'
+)
+
+# rule names (used as group names in the combined scanner)
+NAME_RE = re.compile(r'^[a-zA-Z_]\w*$')
+
+# named groups in rule patterns
+GROUP_NAME_RE = re.compile(r'\(\?P<\w+>')
+
+# braces and escaped characters
+BRACE_RE = re.compile(r'\\.|[{}]', re.S)
+
+# braces, square brackets and escaped characters
+BRACKET_RE = re.compile(r'\\.|[{}\]]', re.S)
+
+# a single token (undelimited macro argument)
+TOKEN_RE = re.compile(r'\\[a-zA-Z]+|\\.|.', re.S)
+
+# a macro name in a \newcommand definition
+CSNAME_RE = re.compile(r'\s*(?:\{\s*\\([a-zA-Z]+|.)\s*\}|\\([a-zA-Z]+|.))', re.S)
+
+# number of arguments in a \newcommand definition, e.g. [2]
+NUMARGS_RE = re.compile(r'\s*\[\s*(\d)\s*\]')
+
+# parameters in a macro body (## is an escaped #)
+PARAM_RE = re.compile(r'##|#(\d)')
+
+WHITESPACE_RE = re.compile(r'\s*')
+
+# macros understood by the parser (never expanded from \newcommand definitions)
+RESERVED_MACROS = frozenset(tax.species) | frozenset(macrosdef.macro_dict)
+
+def find_closing_brace(text, idx):
+    '''
+    Return the index just past the brace closing the one at text[idx],
+    or -1 if it is never closed. Escaped braces are skipped.
+    '''
+    depth = 0
+    for match in BRACE_RE.finditer(text, idx):
+        token = match.group()
+        if token == '{':
+            depth += 1
+        elif token == '}':
+            depth -= 1
+            if depth == 0:
+                return match.end()
+    return -1
+
+def find_closing_bracket(text, idx):
+    '''
+    Return the index just past the square bracket closing the one at text[idx],
+    or -1 if it is never closed. Brackets inside braces are skipped.
+    '''
+    depth = 0
+    for match in BRACKET_RE.finditer(text, idx+1):
+        token = match.group()
+        if token == '{':
+            depth += 1
+        elif token == '}':
+            depth -= 1
+        elif token == ']' and depth == 0:
+            return match.end()
+    return -1
+
+def read_argument(text, idx):
+    '''
+    Read an undelimited macro argument starting at text[idx] (leading
+    whitespace is skipped). This is either a brace group, returned
+    without its braces, or a single token. Returns (arg, end) or None.
+    '''
+    idx = WHITESPACE_RE.match(text, idx).end()
+    if idx >= len(text):
+        return None
+    if text[idx] == '{':
+        end = find_closing_brace(text, idx)
+        if end < 0:
+            return None
+        return text[idx+1:end-1], end
+    if text[idx] == '}':
+        return None
+    match = TOKEN_RE.match(text, idx)
+    return match.group(), match.end()
+
+def read_optional_argument(text, idx):
+    '''
+    Read an optional argument [...] starting at text[idx] (leading
+    whitespace is skipped). Returns (arg, end) or None.
+    '''
+    idx = WHITESPACE_RE.match(text, idx).end()
+    if text[idx:idx+1] != '[':
+        return None
+    end = find_closing_bracket(text, idx)
+    if end < 0:
+        return None
+    return text[idx+1:end-1], end
+
+
+# rewrite rule: the handler is called on each match of the pattern (see LatexPreProcessor.add_rule)
+PreProcessorRule = namedtuple('PreProcessorRule', ['name', 'regex', 'handler'])
+
+
+class MacroTemplate(object):
+    '''
+    Compiled expansion template for a user macro defined by \def or \newcommand.
+
+    The body is split once into literal chunks and parameter indices,
+    so expanding a macro is a single join over its parts.
+        name - macro name (without the backslash)
+        numargs - number of parameters #1..#9
+        default - default value of #1 (if the first argument is optional)
+    '''
+    def __init__(self, name, body, numargs=0, default=None):
+        self.name = name
+        self.numargs = numargs
+        self.default = default
+        self.parts = []
+        start = 0
+        for match in PARAM_RE.finditer(body):
+            self.parts.append(body[start:match.start()])
+            if match.group(1) and 0 < int(match.group(1)) <= numargs:
+                self.parts.append(int(match.group(1)) - 1)
+            else:
+                self.parts.append(match.group()[1:])
+            start = match.end()
+        self.parts.append(body[start:])
+        self.parts = [part for part in self.parts if part != '']
+
+    def __repr__(self):
+        return '%s(%s, %d)' % (self.__class__.__name__, self.name, self.numargs)
+
+    def read_args(self, text, idx):
+        '''
+        Read the arguments of a use of the macro starting at text[idx].
+        Returns (args, end) or None if the arguments are incomplete.
+        '''
+        args = []
+        if self.default is not None:
+            optarg = read_optional_argument(text, idx)
+            if optarg:
+                args.append(optarg[0])
+                idx = optarg[1]
+            else:
+                args.append(self.default)
+        while len(args) < self.numargs:
+            arg = read_argument(text, idx)
+            if not arg:
+                return None
+            args.append(arg[0])
+            idx = arg[1]
+        return args, idx
+
+    def expand(self, args=()):
+        '''
+        Substitute the arguments into the template.
+        '''
+        return ''.join([args[part] if isinstance(part, int) else part for part in self.parts])
+
+
 class LatexPreProcessorError(Exception):
     '''
     Generic exception class raised by LatexPreProcessor.
     '''
     def __init__(self, msg):
         self.msg = msg
-        LatexPreProcessorError.__init__(self, msg)
+        Exception.__init__(self, msg)
 
 class LatexPreProcessor(object):    
     '''
     Class to pre-process latex markup before passing to LatexWalker
     In particular we must expand \def\bit{\begin{itemize}} and similar.
+
+    Rewrites are registered as rules (a regex pattern and a handler).
+    The rules are compiled into a single scanner, so preprocess() walks
+    the source once whatever the number of rules. The default rules are
+        macros: expand user macros (see expand_defs)
+        backticks: replace ` by '
+        double_dollars: replace $$...$$ by \[...\]
+    Further rules can be registered with add_rule().
+
+    User macros (\def, \newcommand, \providecommand) are compiled into
+    MacroTemplate objects, stored in self.macros. The expansion is
+    bounded: max_depth limits nested expansions and max_expansion limits
+    the total number of characters produced by expansions.
+
+    Macros understood by the parser (taxonomy species and macrosdef
+    entries) are often given \newcommand definitions so that the source
+    compiles under LaTeX, e.g. \newcommand{\includevideo}[2][1]{\url{#2}}.
+    These are listed in self.reserved and are never expanded.
     '''
-    def __init__(self):
-        pass        
+    def __init__(self, max_depth=32, max_expansion=2**24, reserved=None):
+        self.max_depth = max_depth
+        self.max_expansion = max_expansion
+        self.reserved = reserved if reserved is not None else RESERVED_MACROS
+        self.macros = {}
+        self.rules = []
+        self.rule_dict = {}
+        self.scanners = {}
+        self.scanner = None
+        self.add_rule('macros', MACRO_PATTERN, self.rewrite_macro)
+        self.add_rule('backticks', r'`', self.rewrite_backtick)
+        self.add_rule('double_dollars', r'\$\$', self.rewrite_double_dollar)
+
+    def add_rule(self, name, pattern, handler, before=None):
+        '''
+        Register a rewrite rule. At any position the rules are tried in
+        order of registration, unless `before` names an existing rule to
+        insert this one ahead of (e.g. before='macros' to rewrite a macro
+        that the macros rule would otherwise consume).
+
+        The handler is called as handler(match, depth) where match is the
+        match object of the rule's own pattern (match.string is the text
+        being scanned) and depth is the macro expansion depth. It returns
+            None: leave the matched text as it is
+            replacement: replace the matched text
+            (replacement, end): replace text[match.start():end] and resume
+                scanning at end (replacement None keeps the text)
+        '''
+        if not NAME_RE.match(name) or name in self.rule_dict:
+            raise LatexPreProcessorError('Invalid or duplicate rule name: %s' % name)
+        rule = PreProcessorRule(name, re.compile(pattern, re.S), handler)
+        if before in self.rule_dict:
+            self.rules.insert(self.rules.index(self.rule_dict[before]), rule)
+        else:
+            self.rules.append(rule)
+        self.rule_dict[name] = rule
+        self.scanners = {}
+
+    def get_scanner(self, names=None):
+        '''
+        Return the combined scanner for the named rules (default all).
+        Each rule becomes an alternative wrapped in a group named after the
+        rule (its own named groups are made non-capturing), so
+        match.lastgroup identifies the rule that matched.
+        '''
+        key = tuple(names) if names else None
+        if key not in self.scanners:
+            rules = [rule for rule in self.rules if not names or rule.name in names]
+            patterns = ['(?P<%s>%s)' % (rule.name, GROUP_NAME_RE.sub('(?:', rule.regex.pattern)) for rule in rules]
+            self.scanners[key] = re.compile('|'.join(patterns), re.S)
+        return self.scanners[key]
 
     def preprocess(self, text):
-        text = self.expand_defs(text)
-        text = self.replace_backticks(text)
-        text = self.replace_double_dollars(text)
+        '''
+        Apply all registered rules in a single scan of the text.
+        '''
+        return self.rewrite(text)
+
+    def rewrite(self, text, names=None):
+        '''
+        Apply the named rules (default all) in a single scan of the text.
+        '''
+        self.macros = {}
+        self.expansion_size = 0
+        self.display_math = False
+        self.scanner = self.get_scanner(names)
+        text = self.scan(text)
+        if self.display_math:
+            logger.warning('Unmatched $$ (closed at end of text)')
+            text += r'\]'
         return text
 
+    def scan(self, text, depth=0):
+        '''
+        Scan text once with self.scanner, calling the handler of each
+        matching rule. The output is built as a list of chunks and
+        joined once at the end. Handlers may call scan() recursively
+        (e.g. to rescan macro expansions) up to self.max_depth.
+        '''
+        if depth > self.max_depth:
+            raise LatexPreProcessorError('Macro expansion exceeded depth %d' % self.max_depth)
+
+        chunks = []
+        start = 0
+        idx = 0
+        while True:
+            match = self.scanner.search(text, idx)
+            if not match:
+                break
+            rule = self.rule_dict[match.lastgroup]
+            result = rule.handler(rule.regex.match(text, match.start()), depth)
+            idx = max(match.end(), match.start() + 1)
+            if result is None:
+                continue
+            if isinstance(result, tuple):
+                replacement, idx = result
+                if replacement is None:
+                    continue
+            else:
+                replacement = result
+            chunks.append(text[start:match.start()])
+            chunks.append(replacement)
+            start = idx
+
+        chunks.append(text[start:])
+        return ''.join(chunks)
+
     def replace_double_dollars(self, text):
         parts = text.split('$$')
         if len(parts) > 1:
@@ -44,46 +330,110 @@ class LatexPreProcessor(object):
     def replace_tildes(self, text):
         return text.replace(r'~', r' ')
         
+    def rewrite_backtick(self, match, depth):
+        return "'"
+
+    def rewrite_double_dollar(self, match, depth):
+        self.display_math = not self.display_math
+        return r'\[' if self.display_math else r'\]'
+
     def expand_defs(self, text):
-        
-        import re
-        pattern = re.compile(r'\\def\s*(\\\w+)\s*')
+        '''
+        Expand user macros in a single left-to-right scan (macros rule only).
+
+        \def definitions are recorded and cut out of the text as they are met.
+        \newcommand and \providecommand definitions are recorded but left in
+        place (they are captured in the preamble). \renewcommand only
+        redefines macros that were defined by the user, so standard macros
+        such as \emph are left for the parser. Comments are skipped.
+
+        Later occurrences of a defined macro are replaced by its definition,
+        with arguments substituted. Whitespace following an argument-free
+        macro is copied across.
+        '''
+        return self.rewrite(text, names=('macros',))
 
-        # find matches (and remove as we go)
-        def_dict = dict()
-        match = re.search(pattern, text)
-        while match:
+    def rewrite_macro(self, match, depth):
+        '''
+        Handler for the macros rule: record definitions and expand uses
+        of macros in self.macros. Expansions are rescanned.
+        '''
+        text = match.string
+        idx = match.end()
 
-            # check that first character is "{" (catch space here)
+        # definition: \def\macro#1#2{...} (cut out of the text)
+        if match.group('defname'):
+            end = find_closing_brace(text, idx) if text[idx:idx+1] == '{' else -1
+            if end < 0:
+                logger.error('Malformed \\def at position %s', match.start())
+                return None
+            numargs = match.group('params').count('#')
+            self.macros[match.group('defname')] = MacroTemplate(
+                match.group('defname'), text[idx+1:end-1], numargs=numargs)
+            return '', end
+
+        # definition: \newcommand{\macro}[2][default]{...} (left in place)
+        if match.group('command'):
+            definition = self.read_newcommand(text, idx)
+            if not definition:
+                logger.error('Malformed \\%s at position %s', match.group('command'), match.start())
+                return None
+            macro, end = definition
+            command = match.group('command')
+            if macro.name in self.reserved:
+                logger.info('%s: \\%s is understood by the parser (not expanded)', command, macro.name)
+            elif (command == 'newcommand'
+                    or (command == 'providecommand' and macro.name not in self.macros)
+                    or (command == 'renewcommand' and macro.name in self.macros)):
+                self.macros[macro.name] = macro
+            return None, end
+
+        # expansion: \macro (leave undefined macros, escapes and comments alone)
+        if match.group('name') not in self.macros:
+            return None
+        macro = self.macros[match.group('name')]
+        if macro.numargs:
+            args = macro.read_args(text, idx)
+            if not args:
+                logger.warning('Missing arguments to \\%s at position %s', macro.name, match.start())
+                return None
+            args, idx = args
+            expansion = macro.expand(args)
+        else:
+            expansion = macro.expand()
+        self.expansion_size += len(expansion)
+        if self.expansion_size > self.max_expansion:
+            raise LatexPreProcessorError('Macro expansion exceeded %d characters' % self.max_expansion)
+        return self.scan(expansion, depth=depth+1), idx
+
+    def read_newcommand(self, text, idx):
+        '''
+        Read the remainder of \newcommand{\macro}[numargs][default]{body}
+        starting at text[idx]. Returns (MacroTemplate, end) or None.
+        '''
+        match = CSNAME_RE.match(text, idx)
+        if not match:
+            return None
+        name = match.group(1) or match.group(2)
+        idx = match.end()
+
+        numargs = 0
+        match = NUMARGS_RE.match(text, idx)
+        if match:
+            numargs = int(match.group(1))
             idx = match.end()
-            if text[idx] != '{':
-                logger.error('The first character should be a "{"')
-                print 'First character should be a "{" at position %s' % idx
-                continue
 
-            # find the closing brace
-            stack = ['{']
-            idx = idx + 1
-            while len(stack) > 0 and idx < len(text):
-                if text[idx] == '{': stack.append('{')
-                if text[idx] == '}': stack.pop()
-                idx = idx + 1
-
-            # record the macro name and its definition
-            def_dict[match.group(1)]  = text[match.end()+1:idx-1]
-            
-            # cut the definition out of the text
-            text = text[:match.start()] + text[idx:]
-
-            # move to next match (exits on None)
-            match = re.search(pattern, text) 
-
-        # expand (copy the whitespace across)
-        import re
-        for key, val in def_dict.items():
-            text = re.sub('\\' + key +'(\s+)', '\\' + val + r'\1', text)
-            
-        return text
+        default = None
+        if numargs:
+            optarg = read_optional_argument(text, idx)
+            if optarg:
+                default, idx = optarg
+
+        idx = WHITESPACE_RE.match(text, idx).end()
+        end = find_closing_brace(text, idx) if text[idx:idx+1] == '{' else -1
+        if end < 0:
+            return None
+        return MacroTemplate(name, text[idx+1:end-1], numargs=numargs, default=default), end
 
 #------------------------------------------------
 def main(args=None):
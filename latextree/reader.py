@@ -2,64 +2,451 @@
 reader.py 
 Utility functions for reading latex files.
     read_latex_document (recursive)
+    resolve_latex_document (returns the text and the include graph)
     parse_latex_opt_args
 """
     
-import os, re
+import os, re, sys, time, mmap, codecs, threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
 import logging
 log = logging.getLogger(__name__)
 
-    
+
+# include commands, escaped characters and comments in one pattern
+INCLUDE_RE = re.compile(r'''
+    \\(?P<command>input|include|subfile)(?![a-zA-Z])\s*\{(?P<filename>[^\}]*)\}
+    | \\(?P<import>import|subimport)(?![a-zA-Z])\s*\{(?P<path>[^\}]*)\}\s*\{(?P<importname>[^\}]*)\}
+    | \\.
+    | %[^\n]*
+''', re.S | re.X)
+
+# document body of a subfile
+SUBFILE_BODY_RE = re.compile(r'\\begin\{document\}(.*)\\end\{document\}', re.S)
+
+NEWLINE_RE = re.compile(r'\n')
+
+# size of the blocks copied into the assembled document
+COPY_BLOCK_SIZE = 1 << 20
+
+
+class LatexReaderError(Exception):
+    '''
+    Generic exception class raised by the reader.
+    '''
+    def __init__(self, msg):
+        self.msg = msg
+        Exception.__init__(self, msg)
+
+
+class SourceFile(object):
+    '''
+    A file in the include graph of a latex document.
+        filename - absolute path
+        size - size in bytes (when read)
+        mtime - modification time (when read)
+        includes - absolute paths of the files it includes (document order)
+        read_time - seconds taken to read the file
+    '''
+    def __init__(self, filename, size=None, mtime=None, read_time=None):
+        self.filename = filename
+        self.size = size
+        self.mtime = mtime
+        self.read_time = read_time
+        self.includes = []
+
+    def __repr__(self):
+        return '%s(%s, %s)' % (self.__class__.__name__, self.filename, self.size)
+
+    def is_modified(self):
+        '''
+        Check the size and mtime recorded when the file was read against the disk.
+        '''
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return True
+        return stat.st_size != self.size or stat.st_mtime != self.mtime
+
+
+class DependencyGraph(object):
+    '''
+    Include graph of a latex document. 
+        root - absolute path of the main file
+        files - SourceFile objects keyed by absolute path (in reading order)
+        cycles - (filename, included filename) pairs skipped to break a cycle
+        read_time - seconds taken to read all the files
+        source_map - SourceMap of the assembled text
+    '''
+    def __init__(self, root=None):
+        self.root = root
+        self.files = OrderedDict()
+        self.cycles = []
+        self.read_time = None
+        self.source_map = None
+
+    def __repr__(self):
+        return '%s(%s, %d files)' % (self.__class__.__name__, self.root, len(self.files))
+
+    def __contains__(self, filename):
+        return filename in self.files
+
+    def __iter__(self):
+        return iter(self.files.values())
+
+    def dependencies(self, filename):
+        '''
+        Files included by filename (directly or indirectly).
+        '''
+        found = []
+        stack = list(reversed(self.files[filename].includes))
+        while stack:
+            name = stack.pop()
+            if name not in found:
+                found.append(name)
+                stack.extend(reversed(self.files[name].includes))
+        return found
+
+    def dependents(self, filename):
+        '''
+        Files that include filename (directly or indirectly).
+        '''
+        return [name for name in self.files if filename in self.dependencies(name)]
+
+    def modified_files(self):
+        '''
+        Files that have changed on disk since they were read.
+        '''
+        return [name for name, source in self.files.items() if source.is_modified()]
+
+
+class SourceMap(object):
+    '''
+    Map positions in an assembled document back to the files they came from.
+
+    The assembled text is a sequence of segments, each a contiguous slice
+    of one source file. Segments are stored in parallel arrays sorted by
+    their start offset in the assembled text, together with the positions
+    of the newlines in the assembled text, so locate() is two binary searches.
+        offsets - start of each segment in the assembled text
+        file_ids - index into self.filenames for each segment
+        lines, columns - position of the start of each segment in its file
+        newlines - offsets of the newlines in the assembled text
+    '''
+    def __init__(self):
+        self.offsets = array('l')
+        self.file_ids = array('i')
+        self.lines = array('l')
+        self.columns = array('l')
+        self.newlines = array('l')
+        self.filenames = []
+        self.file_index = {}
+        self.length = 0
+
+    def __repr__(self):
+        return '%s(%d segments, %d files)' % (self.__class__.__name__, len(self.offsets), len(self.filenames))
+
+    def add_segment(self, filename, line, column, text):
+        '''
+        Record that text, which starts at (line, column) of filename,
+        comes next in the assembled text.
+        '''
+        if not text:
+            return
+        self.start_segment(filename, line, column)
+        self.extend(text)
+
+    def start_segment(self, filename, line, column):
+        '''
+        Start a segment at (line, column) of filename. Its text is added
+        (in one or more pieces) with extend.
+        '''
+        if filename not in self.file_index:
+            self.file_index[filename] = len(self.filenames)
+            self.filenames.append(filename)
+        self.offsets.append(self.length)
+        self.file_ids.append(self.file_index[filename])
+        self.lines.append(line)
+        self.columns.append(column)
+
+    def extend(self, text):
+        '''
+        Add text to the last segment.
+        '''
+        self.newlines.extend(self.length + match.start() for match in NEWLINE_RE.finditer(text))
+        self.length += len(text)
+
+    def locate(self, pos):
+        '''
+        Return (filename, line, column) of a position in the assembled text.
+        Lines and columns are numbered from 1.
+        '''
+        if pos < 0 or pos >= self.length:
+            raise IndexError('Position %d outside assembled text' % pos)
+        idx = bisect_right(self.offsets, pos) - 1
+        filename = self.filenames[self.file_ids[idx]]
+        start = self.offsets[idx]
+        first = bisect_left(self.newlines, start)
+        last = bisect_left(self.newlines, pos)
+        if last == first:
+            return filename, self.lines[idx], self.columns[idx] + pos - start
+        return filename, self.lines[idx] + last - first, pos - self.newlines[last-1]
+
+
+def resolve_include(command, path, filename, current_dir, root_dir):
+    '''
+    Compute the absolute path of an included file.
+        \input{file}, \include{file}, \subfile{file}: relative to the including file
+        \import{path}{file}: relative to the main file
+        \subimport{path}{file}: relative to the including file
+    A .tex extension is appended if necessary.
+    '''
+    filename = filename.strip()
+    if command == 'import':
+        filename = os.path.join(root_dir, path.strip(), filename)
+    elif command == 'subimport':
+        filename = os.path.join(current_dir, path.strip(), filename)
+    else:
+        filename = os.path.join(current_dir, filename)
+    if not os.path.splitext(filename)[1]:
+        filename = filename + '.tex'
+    return os.path.abspath(filename)
+
+
+def find_includes(text, filename, root_dir):
+    '''
+    Find the include commands in text (commented-out commands are ignored).
+    Returns a list of (start, end, command, included filename) tuples.
+    '''
+    includes = []
+    for match in INCLUDE_RE.finditer(text):
+        command = match.group('command') or match.group('import')
+        if command:
+            nested_filename = resolve_include(command, match.group('path'),
+                match.group('filename') or match.group('importname'), os.path.dirname(filename), root_dir)
+            includes.append((match.start(), match.end(), command, nested_filename))
+    return includes
+
+
+def read_source_file(filename, use_mmap=False):
+    '''
+    Read a file. Returns (text, stat, seconds taken).
+    If use_mmap is True the file is memory-mapped and text is a read-only
+    mmap buffer of its bytes (empty files are read as an empty string);
+    the caller is responsible for closing it.
+    '''
+    start_time = time.time()
+    with open(filename, 'rb' if use_mmap else 'r') as f:
+        log.info('Reading from %s', filename)
+        stat = os.fstat(f.fileno())
+        if use_mmap and stat.st_size:
+            text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            text = f.read()
+    return text, stat, time.time() - start_time
+
+
+def map_in_threads(function, items, max_workers):
+    '''
+    Return [function(item) for item in items], computed on at most 
+    max_workers threads. The threads are joined before returning and the
+    first exception raised by function is raised again.
+    '''
+    results = [None] * len(items)
+    errors = []
+    pending = list(enumerate(items))
+    lock = threading.Lock()
+    def work():
+        while not errors:
+            with lock:
+                if not pending:
+                    return
+                idx, item = pending.pop(0)
+            try:
+                results[idx] = function(item)
+            except Exception:
+                errors.append(sys.exc_info())
+    threads = [threading.Thread(target=work) for n in range(min(max_workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+def prefetch_sources(filename, root_dir, max_workers=8, use_mmap=False):
+    '''
+    Read filename and every file it includes (directly or indirectly).
+    Files are read concurrently on at most max_workers threads (see
+    map_in_threads), one wave per level of the include tree.
+    Include commands are found by scanning the raw buffers, so with
+    use_mmap=True no file is copied into memory before it is stitched.
+    Returns a dict mapping filenames to (text, stat, seconds, includes).
+    '''
+    read = lambda name: read_source_file(name, use_mmap=use_mmap)
+    sources = {}
+    pending = [filename]
+    while pending:
+        if len(pending) > 1 and max_workers > 1:
+            results = map_in_threads(read, pending, max_workers)
+        else:
+            results = [read(name) for name in pending]
+
+        # scan for the next wave of files
+        discovered = []
+        for name, (text, stat, seconds) in zip(pending, results):
+            includes = find_includes(text, name, root_dir)
+            sources[name] = (text, stat, seconds, includes)
+            for include in includes:
+                if include[3] not in sources and include[3] not in discovered:
+                    discovered.append(include[3])
+        pending = discovered
+    return sources
+
+
+def resolve_latex_document(filename, max_workers=8, use_mmap=False, encoding=None):
+    """
+    Read latex document from file, expanding \input, \include, \subfile,
+    \import and \subimport commands (commented-out commands are ignored).
+    Returns the assembled text and the DependencyGraph of the files read.
+    Cyclic includes are logged and skipped.
+
+    The included files are prefetched concurrently (see prefetch_sources),
+    then stitched together in document order. The time taken to read each
+    file is recorded in its SourceFile entry, and the origin of each part
+    of the assembled text is recorded in graph.source_map.
+
+    The stitched regions are copied, in blocks of COPY_BLOCK_SIZE bytes,
+    onto the end of one string, which grows in place, and each file is
+    released as soon as its last region has been copied: reading needs
+    about the size of the document plus the size of the largest file.
+    With use_mmap=True the files are unmapped once the regions are known
+    and the regions are read from the files block by block, so reading
+    needs about the size of the document.
+    If an encoding is given, the assembled text is decoded to unicode
+    (the preambles of subfiles are skipped) and the source map counts
+    columns in characters.
+    """
+    filename = os.path.abspath(filename)
+    root_dir = os.path.dirname(filename)
+    graph = DependencyGraph(root=filename)
+
+    start_time = time.time()
+    sources = prefetch_sources(filename, root_dir, max_workers=max_workers, use_mmap=use_mmap)
+    graph.read_time = time.time() - start_time
+
+    # (filename, start, end, line, start of the line) of each region, in document order
+    regions = []
+
+    def add_region(filename, text, start, end, cursor):
+        # cursor is [position, line, start of the line] in the current reading of filename
+        if end <= start:
+            return
+        position, line, line_start = cursor
+        for match in NEWLINE_RE.finditer(text, position, start):
+            line += 1
+            line_start = match.end()
+        cursor[:] = [start, line, line_start]
+        regions.append((filename, start, end, line, line_start))
+
+    def read_source(filename, chain, body_only=False):
+
+        text, stat, seconds, includes = sources[filename]
+        if filename not in graph:
+            graph.files[filename] = SourceFile(filename, size=stat.st_size, mtime=stat.st_mtime, read_time=seconds)
+            log.info('Read %s (%d bytes) in %.4fs', filename, stat.st_size, seconds)
+        source = graph.files[filename]
+        chain.append(filename)
+        cursor = [0, 1, 0]
+
+        # subfiles are complete documents: keep the body only
+        start_index, end_index = 0, len(text)
+        if body_only:
+            body = SUBFILE_BODY_RE.search(text)
+            if body:
+                start_index, end_index = body.span(1)
+
+        # process include commands (recursive calls)
+        for start, end, command, nested_filename in includes:
+            if start < start_index or end > end_index:
+                continue
+            add_region(filename, text, start_index, start, cursor)
+            start_index = end
+
+            if nested_filename not in source.includes:
+                source.includes.append(nested_filename)
+            if nested_filename in chain:
+                log.error('Cyclic \\%s of %s in %s (skipped)', command, nested_filename, filename)
+                graph.cycles.append((filename, nested_filename))
+                continue
+            read_source(nested_filename, chain, body_only=(command == 'subfile'))
+
+        add_region(filename, text, start_index, end_index, cursor)
+        chain.pop()
+
+    def release(filename):
+        text = sources[filename][0]
+        sources[filename] = (None,) + sources[filename][1:]
+        if isinstance(text, mmap.mmap):
+            text.close()
+
+    def read_blocks(filename, start, end):
+        # text[start:end] of a source in blocks (read from the file if it has been unmapped)
+        text = sources[filename][0]
+        if text is not None:
+            for position in xrange(start, end, COPY_BLOCK_SIZE):
+                yield text[position:min(position + COPY_BLOCK_SIZE, end)]
+            return
+        with open(filename, 'rb') as f:
+            f.seek(start)
+            for position in xrange(start, end, COPY_BLOCK_SIZE):
+                yield f.read(min(COPY_BLOCK_SIZE, end - position))
+
+    source_map = SourceMap()
+    try:
+        read_source(filename, [])
+
+        # memory-mapped files are read again block by block, so that
+        # their pages do not stay resident while the document is copied
+        last = dict([(region[0], idx) for idx, region in enumerate(regions)])
+        for name in sources.keys():
+            if name not in last or isinstance(sources[name][0], mmap.mmap):
+                release(name)
+
+        document = ''
+        for idx, (name, start, end, line, line_start) in enumerate(regions):
+            prefix = ''.join(read_blocks(name, line_start, start))
+            if encoding:
+                prefix = prefix.decode(encoding)
+                decoder = codecs.getincrementaldecoder(encoding)()
+            source_map.start_segment(name, line, len(prefix) + 1)
+            for block in read_blocks(name, start, end):
+                source_map.extend(decoder.decode(block) if encoding else block)
+                # resized in place: document is the only reference to the string
+                document += block
+            if encoding:
+                source_map.extend(decoder.decode('', True))
+            block = None
+            if last[name] == idx:
+                release(name)
+    finally:
+        for name in sources.keys():
+            release(name)
+    graph.source_map = source_map
+    if encoding:
+        document = document.decode(encoding)
+    return document, graph
+
 
 def read_latex_document(filename):
     """
     Read latex document from file (recursive via input|include commands)
     """
-    
-    def read_source(filename, level=0):
-        
-        # careful now!
-        if level > 4:
-            log.warning('Recursion depth limit exceeded')
-            return ''
-        
-        with open(filename) as f:
-            log.info('Reading from %s', filename)
-            text = f.read()
-            
-        
-        # find input commands
-        pattern = re.compile(r'[^%+]\\(input|include)\{([^\}]*)\}')
-        matches = re.finditer(pattern, text)
-        
-        # return contents if none found (end recursion)
-        if not matches:
-            return text
-        
-        # otherwise process input commands (recursive calls)
-        else:
-            s = ''
-            start_index = 0
-            for match in matches:
-                
-                end_index = match.start()
-                s += text[start_index:end_index]
-                start_index = match.end()
-                nested_filename = match.groups()[1]
-                
-                # append .tex extension if necessary
-                if not re.search(r'\.', nested_filename):
-                    nested_filename = nested_filename + '.tex'
-                
-                nested_filename = os.path.join(os.path.dirname(filename), nested_filename)
-                log.info('Reading from %s', nested_filename)
-                
-                # recursive call
-                s += read_source(nested_filename, level=level+1)
-            s += text[start_index:]
-            return s
-    
-    return read_source(filename)
+    return resolve_latex_document(filename)[0]
     
 def parse_latex_opt_args(self, text):
     '''
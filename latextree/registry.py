@@ -0,0 +1,85 @@
+"""
+registry.py
+Node classes for the families, genera and species of taxonomy.py
+
+The classes are created once per process (when this module is first
+imported) and shared by all LatexParser objects. They are exposed as
+read-only mappings:
+    family_classes: family -> class (Macro, Environment, Switch)
+    genus_classes: (family, genus) -> class
+    species_classes: species -> class
+    NAMED_CLASSES: class name -> class, for all the node classes above
+        and the other node classes of the parser (see cache.get_named_class)
+
+>>> from registry import species_classes
+>>> species_classes['chapter'].get_genus()
+'level'
+"""
+
+from collections import Mapping
+
+import taxonomy as tax
+from node import LatexTreeNode, Macro, Environment, Switch
+from content import Content, Xref, Url, Image, Media, Latex, Comment, Text, Points, Title, Break, Space
+from tabular import Tabular, Row, Cell
+from bibliography import Bibliography, BibItem
+from factory import ClassFactory
+
+
+class FrozenMapping(Mapping):
+    '''
+    Read-only dictionary.
+    '''
+    def __init__(self, *args, **kwargs):
+        self._data = dict(*args, **kwargs)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self._data)
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+
+def build_classes():
+    '''
+    Create the genus and species classes for the taxonomy.
+    Returns (family_classes, genus_classes, species_classes) as dicts.
+    Species listed under more than one family are taken from the last
+    (macros, then environments, then switches).
+    '''
+    families = (
+        ('macro', Macro, tax.macros),
+        ('environment', Environment, tax.environments),
+        ('switch', Switch, tax.switches),
+    )
+    family_classes = {}
+    genus_classes = {}
+    species_classes = {}
+    for family, FamilyClass, genera in families:
+        family_classes[family] = FamilyClass
+        for genus in genera:
+            GenusClass = ClassFactory(genus, {}, BaseClass=FamilyClass)
+            genus_classes[(family, genus)] = GenusClass
+            for species in genera[genus]:
+                species_classes[species] = ClassFactory(species, {}, BaseClass=GenusClass)
+    return family_classes, genus_classes, species_classes
+
+
+family_classes, genus_classes, species_classes = [FrozenMapping(classes) for classes in build_classes()]
+
+# classes by name (for rebuilding cached, unpickled and snapshot subtrees without the parser)
+NAMED_CLASSES = FrozenMapping([(cls.__name__, cls) for cls in 
+    [LatexTreeNode, Content, Xref, Url, Image, Media, Latex, Comment, Text, Points, Title, Break, Space, Tabular, Row, Cell, Bibliography, BibItem]
+    + family_classes.values() + genus_classes.values() + species_classes.values()])
@@ -0,0 +1,338 @@
+"""
+snapshot.py
+Binary snapshots of parsed LatexTree documents.
+
+A snapshot stores a LatexDocument so that it can be loaded without the
+parser (e.g. by a web server at startup). It is a flat node table:
+    classes - class names of each node class (see cache.get_class_names)
+    nodes - class code and parent position of each node (pre-order)
+    attributes - (node position, name, value) triples
+and the strings of the names, labels and contents are stored once each
+in a string pool. The rest of the document (preamble, head, shards) and
+attribute values that are not strings or small integers are pickled (see
+LatexDocument.__getstate__). Numbers, titles, xrefs etc. are recomputed by
+LatexPostProcessor when the snapshot is loaded.
+
+Snapshots are meant to be copied between machines, so they are not
+unpickled with the usual unpickler (which can call any function named in
+its input): only the classes in SAFE_GLOBALS are looked up, and any other
+global in the pickle makes the snapshot invalid. Loading a snapshot does
+not import the parser (see registry.NAMED_CLASSES).
+
+File layout:
+    header - MAGIC, format version, compression code, byte order
+    body - sections (length-prefixed), compressed as a whole:
+        document state (pickle)
+        string pool: kinds (str or unicode), lengths, utf-8 bytes
+        class table: number of names and pool positions of the names, for each class
+        node table: class codes, parent positions (-1 for the root)
+        attributes: node positions, name positions, value kinds, values
+Tables are arrays of 32-bit integers (or bytes) written in the byte order
+of the machine and swapped when loaded on another byte order.
+
+The body can be compressed with zlib (default) or bz2. lzma is not part
+of the Python 2 standard library.
+
+>>> from snapshot import save_document, load_document
+>>> save_document(doc, 'book.ltree')
+>>> doc = load_document('book.ltree')
+"""
+
+import sys, struct, zlib, bz2
+from array import array
+from cStringIO import StringIO
+import cPickle as pickle
+
+from cache import get_class_names, get_attributes, get_named_class
+
+import logging
+logger = logging.getLogger(__name__)
+
+MAGIC = 'LTREESNP'
+
+# bump when the layout changes
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct('<8sBBB')
+SECTION = struct.Struct('<I')
+
+COMPRESSIONS = {
+    None: (0, None, None),
+    'zlib': (1, zlib.compress, zlib.decompress),
+    'bz2': (2, bz2.compress, bz2.decompress),
+}
+
+BYTE_ORDERS = ('little', 'big')
+
+# pool string kinds
+STR, UNICODE = 0, 1
+
+# attribute value kinds
+POOL, INTEGER, PICKLED = 0, 1, 2
+
+INT_MIN, INT_MAX = -2**31, 2**31 - 1
+
+# globals that can be unpickled: (module, name)
+SAFE_GLOBALS = frozenset([
+    ('array', 'array'),
+    ('collections', 'OrderedDict'),
+    ('reader', 'DependencyGraph'),
+    ('reader', 'SourceFile'),
+    ('reader', 'SourceMap'),
+])
+
+
+class SnapshotError(Exception):
+    '''
+    Raised when a snapshot cannot be read.
+    '''
+    def __init__(self, msg):
+        self.msg = msg
+        Exception.__init__(self, msg)
+
+
+class StringPool(object):
+    '''
+    Interned strings (str and unicode) by position.
+    '''
+    def __init__(self):
+        self.strings = []
+        self.positions = {}
+
+    def add(self, value):
+        '''
+        Return the position of value (added if necessary).
+        '''
+        key = (type(value), value)
+        if key not in self.positions:
+            self.positions[key] = len(self.strings)
+            self.strings.append(value)
+        return self.positions[key]
+
+    def dump(self):
+        '''
+        Encode the pool as (kinds, lengths, data).
+        '''
+        kinds = array('B')
+        lengths = array('i')
+        parts = []
+        for value in self.strings:
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+                kinds.append(UNICODE)
+            else:
+                kinds.append(STR)
+            lengths.append(len(value))
+            parts.append(value)
+        return kinds.tostring(), lengths.tostring(), ''.join(parts)
+
+    @staticmethod
+    def load(kinds, lengths, data):
+        '''
+        Decode a pool encoded by dump. Returns the list of strings.
+        '''
+        strings = []
+        pos = 0
+        for kind, length in zip(kinds, lengths):
+            value = data[pos:pos + length]
+            pos += length
+            strings.append(intern(value) if kind == STR else value.decode('utf-8'))
+        return strings
+
+
+def find_safe_global(module, name):
+    '''
+    find_global of the unpickler of snapshots: only SAFE_GLOBALS are found.
+    '''
+    if (module, name) not in SAFE_GLOBALS:
+        raise pickle.UnpicklingError('%s.%s is not allowed in a snapshot' % (module, name))
+    __import__(module)
+    return getattr(sys.modules[module], name)
+
+
+def load_state(data):
+    '''
+    Unpickle the document state of a snapshot (see find_safe_global).
+    '''
+    unpickler = pickle.Unpickler(StringIO(data))
+    unpickler.find_global = find_safe_global
+    return unpickler.load()
+
+
+def dump_document(doc):
+    '''
+    Encode a LatexDocument as a list of sections (strings), see above.
+    '''
+    state = doc.__getstate__()
+    root = state.pop('_root')
+    pool = StringPool()
+    class_codes = {}
+    class_table = array('i')
+    codes = array('i')
+    parents = array('i')
+    attr_nodes = array('i')
+    attr_names = array('i')
+    attr_kinds = array('B')
+    attr_values = array('i')
+    extra = []
+
+    positions = {}
+    stack = [root] if root is not None else []
+    while stack:
+        node = stack.pop()
+        cls = node.__class__
+        if cls not in class_codes:
+            class_codes[cls] = len(class_codes)
+            names = get_class_names(cls)
+            class_table.append(len(names))
+            class_table.extend([pool.add(name) for name in names])
+        position = len(codes)
+        positions[id(node)] = position
+        codes.append(class_codes[cls])
+        parents.append(positions[id(node.parent)] if position else -1)
+        for key, value in get_attributes(node).items():
+            attr_nodes.append(position)
+            attr_names.append(pool.add(key))
+            if isinstance(value, basestring):
+                attr_kinds.append(POOL)
+                attr_values.append(pool.add(value))
+            elif type(value) is int and INT_MIN <= value <= INT_MAX:
+                attr_kinds.append(INTEGER)
+                attr_values.append(value)
+            else:
+                attr_kinds.append(PICKLED)
+                attr_values.append(len(extra))
+                extra.append(value)
+        stack.extend(reversed(node.children))
+
+    state['extra'] = extra
+    data = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+    try:
+        load_state(data)
+    except pickle.UnpicklingError, error:
+        raise ValueError('The document cannot be stored in a snapshot (%s)' % error)
+    return [data] + list(pool.dump()) + \
+        [table.tostring() for table in (class_table, codes, parents, attr_nodes, attr_names, attr_kinds, attr_values)]
+
+
+def load_sections(sections, byte_order):
+    '''
+    Decode the sections of a snapshot (see dump_document).
+    Returns (root node, document state).
+    '''
+    from node import LatexTreeNode
+
+    state = load_state(sections[0])
+    tables = []
+    for typecode, section in zip('Bi' + 'iiiiiBi', sections[1:3] + sections[4:]):
+        table = array(typecode)
+        table.fromstring(section)
+        if byte_order != sys.byteorder:
+            table.byteswap()
+        tables.append(table)
+    kinds, lengths, class_table, codes, parents, attr_nodes, attr_names, attr_kinds, attr_values = tables
+    strings = StringPool.load(kinds, lengths, sections[3])
+
+    # classes
+    resolved = {}
+    classes = []
+    pos = 0
+    while pos < len(class_table):
+        num_names = class_table[pos]
+        classes.append(get_named_class([strings[idx] for idx in class_table[pos + 1:pos + 1 + num_names]], resolved))
+        pos += num_names + 1
+
+    # nodes (parents come before their children)
+    init = LatexTreeNode.__init__
+    nodes = []
+    for position, code in enumerate(codes):
+        cls = classes[code]
+        node = cls.__new__(cls)
+        init(node)
+        if position:
+            parent = parents[position]
+            if not 0 <= parent < position:
+                raise ValueError('bad parent of node %d' % position)
+            nodes[parent].append_child(node)
+        nodes.append(node)
+
+    # attributes
+    extra = state.pop('extra')
+    for position, name, kind, value in zip(attr_nodes, attr_names, attr_kinds, attr_values):
+        if kind == POOL:
+            value = strings[value]
+        elif kind == PICKLED:
+            value = extra[value]
+        setattr(nodes[position], strings[name], value)
+    return (nodes[0] if nodes else None), state
+
+
+def load_document(filename):
+    '''
+    Load a LatexDocument from a snapshot file.
+    '''
+    from document import LatexDocument
+
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if len(data) < HEADER.size:
+        raise SnapshotError('%s is not a LatexTree snapshot' % filename)
+    magic, version, compression, byte_order = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise SnapshotError('%s is not a LatexTree snapshot' % filename)
+    if version != FORMAT_VERSION:
+        raise SnapshotError('Snapshot %s has format version %d (expected %d)' % (filename, version, FORMAT_VERSION))
+    decompressors = dict([(code, decompress) for code, compress, decompress in COMPRESSIONS.values()])
+    if compression not in decompressors or byte_order >= len(BYTE_ORDERS):
+        raise SnapshotError('Snapshot %s is corrupt' % filename)
+    body = data[HEADER.size:]
+    if decompressors[compression]:
+        try:
+            body = decompressors[compression](body)
+        except (zlib.error, IOError), error:
+            raise SnapshotError('Snapshot %s is corrupt (%s)' % (filename, error))
+
+    # split into sections
+    sections = []
+    pos = 0
+    try:
+        while pos < len(body):
+            length, = SECTION.unpack_from(body, pos)
+            pos += SECTION.size
+            sections.append(body[pos:pos + length])
+            pos += length
+        if len(sections) != 11 or pos != len(body):
+            raise ValueError('%d sections' % len(sections))
+        root, state = load_sections(sections, BYTE_ORDERS[byte_order])
+    except (struct.error, EOFError, IndexError, ValueError, KeyError, TypeError, AttributeError, pickle.UnpicklingError), error:
+        raise SnapshotError('Snapshot %s is corrupt (%s)' % (filename, error))
+
+    doc = LatexDocument.__new__(LatexDocument)
+    state['_root'] = root
+    doc.__setstate__(state)
+    logger.info('Snapshot %s loaded.', filename)
+    return doc
+
+
+def save_document(doc, filename, compression='zlib'):
+    '''
+    Write a snapshot of a LatexDocument to a file.
+        compression - None, 'zlib' or 'bz2'
+    '''
+    if compression not in COMPRESSIONS:
+        raise ValueError("Unknown compression `%s'" % compression)
+    write_sections(filename, dump_document(doc), compression)
+    logger.info('Snapshot %s saved.', filename)
+
+
+def write_sections(filename, sections, compression):
+    '''
+    Write the header and the sections (see dump_document) of a snapshot.
+    '''
+    code, compress, decompress = COMPRESSIONS[compression]
+    body = ''.join([SECTION.pack(len(section)) + section for section in sections])
+    if compress:
+        body = compress(body)
+    with open(filename, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, code, BYTE_ORDERS.index(sys.byteorder)))
+        f.write(body)
@@ -3,17 +3,18 @@ tabular.py
 We deal with tabular environments directly (rather than via latexwalker
 """
 
-import walker
 from node import LatexTreeNode
 
 import logging
 logger = logging.getLogger(__name__)
 
 class Row(LatexTreeNode):
+    __slots__ = ()
     def __init__(self):
         LatexTreeNode.__init__(self)
         
 class Cell(LatexTreeNode):
+    __slots__ = ()
     def __init__(self):
         LatexTreeNode.__init__(self)
         
@@ -21,9 +22,11 @@ class Tabular(LatexTreeNode):
     '''
     Class to represent tabular environments.
     '''
+    __slots__ = ()
     def __init__(self, spec, text):
         LatexTreeNode.__init__(self)
         
+        import walker
         from parser import LatexParser
         pa = LatexParser()
 
@@ -49,10 +49,37 @@ switches = {
     'language': ('cy', 'en', 'fr', 'de', 'bi')
 }
 
-macro_species = [mac for key in macros for mac in macros[key]]
-environment_species = [env for key in environments for env in environments[key]]
-switch_species = [sw for key in switches for sw in switches[key]]
-species = macro_species + environment_species + switch_species
+# genus -> frozenset of species (for membership tests)
+macro_sets = dict([(genus, frozenset(macros[genus])) for genus in macros])
+environment_sets = dict([(genus, frozenset(environments[genus])) for genus in environments])
+switch_sets = dict([(genus, frozenset(switches[genus])) for genus in switches])
+
+macro_species = frozenset([mac for key in macros for mac in macros[key]])
+environment_species = frozenset([env for key in environments for env in environments[key]])
+switch_species = frozenset([sw for key in switches for sw in switches[key]])
+species = macro_species | environment_species | switch_species
+
+# cross-references and hyperlinks
+reference_species = macro_sets['xref'] | macro_sets['href']
+
+class Category(object):
+    '''
+    Categories of species (bit flags).
+    '''
+    MACRO = 1
+    ENVIRONMENT = 2
+    SWITCH = 4
+
+# species -> (genus, family) and species -> Category flags
+# (species listed more than once take the last genus, as in registry.py)
+species_index = {}
+species_category = {}
+for _family, _category, _genera in (('macro', Category.MACRO, macros), ('environment', Category.ENVIRONMENT, environments), ('switch', Category.SWITCH, switches)):
+    for _genus in _genera:
+        for _species in _genera[_genus]:
+            species_index[_species] = (_genus, _family)
+            species_category[_species] = species_category.get(_species, 0) | _category
+del _family, _category, _genera, _genus, _species
 
 # set parameters to be captured from document preamble
 preamble_capture = (
@@ -74,8 +101,8 @@ preamble_capture = (
 )
 
 # numbered
-numbered_genera = ['level', 'theorem', 'float', 'item', 'task', 'subfigure']
-numbered_species = ['subfigure']
+numbered_genera = frozenset(['level', 'theorem', 'float', 'item', 'task', 'subfigure'])
+numbered_species = frozenset(['subfigure'])
 
 # titled (not used)
 titled_genera   = ['document', 'level', 'theorem', 'float']
@@ -0,0 +1,45 @@
+# conftest.py
+# shared fixtures: the example documents in tex/ and a small tree builder
+import os
+import pytest
+from parser import LatexParser
+from document import LatexDocument
+from registry import species_classes
+
+TEX_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'tex')
+
+FIXTURES = ['LatexTreeTestArticle', 'LatexTreeTestBook', 'LatexTreeTestExam']
+
+@pytest.fixture(scope='session')
+def tex_root():
+    return TEX_ROOT
+
+@pytest.fixture(scope='session')
+def main_tex_files():
+    return [os.path.join(TEX_ROOT, fixture, 'main.tex') for fixture in FIXTURES]
+
+@pytest.fixture(scope='session', params=FIXTURES)
+def main_tex(request):
+    return os.path.join(TEX_ROOT, request.param, 'main.tex')
+
+@pytest.fixture(scope='session')
+def parsed_doc(main_tex):
+    # parsed once per session: tests must not change it
+    return LatexParser().parse_latex_file(main_tex)
+
+def build_book(*chapters):
+    '''
+    A document with a book root and a chapter for each (label, children).
+    '''
+    doc = LatexDocument(root=species_classes['book']())
+    for label, children in chapters:
+        chapter = species_classes['chapter']()
+        chapter.label = label
+        doc.root.append_child(chapter)
+        for child in children:
+            chapter.append_child(child)
+    return doc
+
+@pytest.fixture(scope='session')
+def make_book():
+    return build_book
@@ -0,0 +1,91 @@
+# test_cache.py
+import os, shutil
+import pytest
+from lxml import etree
+from parser import LatexParser
+from node import LatexTreeNode
+from cache import ParseCache, dump_tree, load_tree
+from content import Text
+
+def get_xml(doc):
+    return etree.tostring(doc.root.get_xml())
+
+def test_cached_parse(tmpdir, main_tex, parsed_doc):
+    doc = parsed_doc
+    cache = ParseCache(str(tmpdir.join('cache')))
+    doc1 = LatexParser().parse_latex_file(main_tex, cache=cache)
+    assert cache.hits == 0
+    doc2 = LatexParser().parse_latex_file(main_tex, cache=cache)
+    assert cache.hits == cache.misses
+    for doc3 in (doc1, doc2):
+        assert get_xml(doc3) == get_xml(doc)
+        assert doc3.root.get_latex() == doc.root.get_latex()
+        assert sorted(doc3.xrefs) == sorted(doc.xrefs)
+        assert doc3.preamble == doc.preamble
+
+def test_changed_chapter(tmpdir, tex_root):
+    shutil.copytree(os.path.join(tex_root, 'LatexTreeTestBook'), str(tmpdir.join('book')))
+    main_tex = str(tmpdir.join('book', 'main.tex'))
+    cache = ParseCache(str(tmpdir.join('cache')))
+    LatexParser().parse_latex_file(main_tex, cache=cache)
+    misses = cache.misses
+    lists_tex = tmpdir.join('book', 'lists.tex')
+    lists_tex.write(lists_tex.read().replace(r'\chapter{Lists}', r'\chapter{Lists}\label{ch:new}'))
+    doc = LatexParser().parse_latex_file(main_tex, cache=cache)
+    assert cache.misses == misses + 1
+    assert doc.xrefs['ch:new'].get_species() == 'chapter'
+    assert get_xml(doc) == get_xml(LatexParser().parse_latex_file(main_tex))
+
+def test_dump_tree():
+    text = r'\section{One}\label{sec:one}\begin{itemize}\item $x$ \item \foo{y}\end{itemize}'
+    pa = LatexParser()
+    root = pa.parse_latex_shard(text, LatexTreeNode)
+    root2 = load_tree(dump_tree(root), pa.named_classes)
+    assert root2.show() == root.show()
+    assert root2.children[0].__class__ is pa.classes['section']
+    assert root2.children[0].label == 'sec:one'
+
+def test_parallel_parse(tmpdir, main_tex, parsed_doc):
+    doc = parsed_doc
+    cache = ParseCache(str(tmpdir.join('cache')))
+    for doc2 in (LatexParser().parse_latex_file(main_tex, processes=2),
+                 LatexParser().parse_latex_file(main_tex, processes=3, cache=cache)):
+        assert get_xml(doc2) == get_xml(doc)
+        assert doc2.root.get_latex() == doc.root.get_latex()
+        assert [node.number for node in doc2.root.iter_nodes()] == [node.number for node in doc.root.iter_nodes()]
+        assert sorted(doc2.xrefs) == sorted(doc.xrefs)
+        assert [shard[0] for shard in doc2.shards] == [shard[0] for shard in doc.shards]
+    assert cache.misses == len(doc.shards)
+
+def test_parallel_registered_handler(tex_root):
+    # parsers with registered handlers parse serially
+    pa = LatexParser()
+    pa.register_macro_handler('chapter', lambda parser, macroname, wnode, stack, **kwargs: stack)
+    assert not pa.can_fork()
+    doc = pa.parse_latex_file(os.path.join(tex_root, 'LatexTreeTestBook', 'main.tex'), processes=2)
+    assert not doc.find_all('chapter')
+
+def parse_tip(parser, macroname, wnode, stack, **kwargs):
+    stack[-1].append_child(Text(text='(tip)'))
+    return stack
+
+def parse_hint(parser, macroname, wnode, stack, **kwargs):
+    stack[-1].append_child(Text(text='(hint)'))
+    return stack
+
+def test_cached_registered_handler(tmpdir, tex_root):
+    # shards parsed with registered handlers are cached under other keys
+    main_tex = os.path.join(tex_root, 'LatexTreeTestBook', 'main.tex')
+    cache = ParseCache(str(tmpdir.join('cache')))
+    LatexParser().parse_latex_file(main_tex, cache=cache)
+    for handler, text in [(parse_tip, '(tip)'), (parse_hint, '(hint)'), (parse_tip, '(tip)')]:
+        pa = LatexParser()
+        pa.register_macro_handler('chapter', handler)
+        doc = pa.parse_latex_file(main_tex, cache=cache)
+        assert not doc.find_all('chapter') and text in doc.root.get_latex()
+    assert cache.hits == len(doc.shards)
+    doc = LatexParser().parse_latex_file(main_tex, cache=cache)
+    assert doc.find_all('chapter')
+    pa = LatexParser()
+    pa.register_macro_handler('chapter', lambda parser, macroname, wnode, stack, **kwargs: stack)
+    assert pa.get_handlers_key() is not None
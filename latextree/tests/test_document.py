@@ -1,5 +1,7 @@
 # test_document.py
+import os, shutil
 import pytest
+from lxml import etree
 from document import LatexDocument
 from parser import LatexParser
 
@@ -94,3 +96,77 @@ def test_walker(latex_source):
     source2 = doc.root.get_latex()
     source2 = ''.join([x.strip() for x in source2.split('\n')])
     assert source1 == source2
+
+
+def test_update(tmpdir, tex_root):
+    shutil.copytree(os.path.join(tex_root, 'LatexTreeTestBook'), str(tmpdir.join('book')))
+    main_tex = str(tmpdir.join('book', 'main.tex'))
+    doc = LatexParser().parse_latex_file(main_tex)
+    chapters = doc.root.get_phenotypes('chapter')
+    assert doc.update() == []
+
+    # add a section to the second chapter
+    lists_tex = tmpdir.join('book', 'lists.tex')
+    lists_tex.write(lists_tex.read().replace(r'\chapter{Lists}', r'\chapter{Lists}\section{New}\label{sec:new}'))
+    assert doc.update([str(lists_tex)]) == [2]
+    new_chapters = doc.root.get_phenotypes('chapter')
+    assert new_chapters[0] is chapters[0]
+    assert new_chapters[1] is not chapters[1]
+    assert new_chapters[2:] == chapters[2:]
+    assert doc.xrefs['sec:new'].number == 1
+    assert doc.find_all('chapter') == new_chapters and doc.by_label('sec:new') is doc.xrefs['sec:new']
+    assert doc.xrefs['sec:new'].get_enclosing_chapter().number == 2
+    assert etree.tostring(doc.root.get_xml()) == etree.tostring(LatexParser().parse_latex_file(main_tex).root.get_xml())
+
+def test_update_encoding(tmpdir):
+    tmpdir.join('main.tex').write(r'\documentclass{book}\begin{document}\chapter{Caf' + '\xe9' + r'}\input{two}\end{document}', mode='wb')
+    tmpdir.join('two.tex').write(r'\chapter{Cr' + '\xe8' + r'me}', mode='wb')
+    main_tex = str(tmpdir.join('main.tex'))
+    doc = LatexParser().parse_latex_file(main_tex, encoding='latin-1')
+    tmpdir.join('two.tex').write(r'\chapter{Br' + '\xfb' + r'l' + '\xe9' + r'e}', mode='wb')
+    assert doc.update([str(tmpdir.join('two.tex'))]) == [2]
+    xml = etree.tostring(doc.root.get_xml(), encoding='utf-8')
+    assert u'Br\xfbl\xe9e'.encode('utf-8') in xml
+    assert xml == etree.tostring(LatexParser().parse_latex_file(main_tex, encoding='latin-1').root.get_xml(), encoding='utf-8')
+
+def test_update_incremental(tmpdir, tex_root, monkeypatch):
+    from postprocessor import LatexPostProcessor
+    shutil.copytree(os.path.join(tex_root, 'LatexTreeTestBook'), str(tmpdir.join('book')))
+    main_tex = str(tmpdir.join('book', 'main.tex'))
+    doc = LatexParser().parse_latex_file(main_tex)
+    chapters = doc.find_all('chapter')
+
+    # count the nodes visited by the postprocessor
+    visited = []
+    visit = LatexPostProcessor.visit
+    def counting_visit(self, root, children=None):
+        visited.extend(root.iter_nodes())
+        return visit(self, root, children=children)
+    monkeypatch.setattr(LatexPostProcessor, 'visit', counting_visit)
+
+    # nothing to reparse: nothing is visited
+    assert doc.update([main_tex]) == []
+    assert visited == []
+
+    # change the last chapter: only its nodes are visited and indexed again
+    children = list(doc.root.children)
+    links_tex = tmpdir.join('book', 'links.tex')
+    links_tex.write(links_tex.read() + '\n' + r'\section{More}\label{sec:more}' + '\n')
+    doc.update([str(links_tex)])
+    new_chapters = doc.find_all('chapter')
+    assert new_chapters[:-1] == chapters[:-1] and new_chapters[-1] is not chapters[-1]
+    start = [child is old for child, old in zip(doc.root.children, children)].index(False)
+    assert start >= len(children) - 3
+    assert set(visited) == set([node for child in doc.root.children[start:] for node in child.iter_nodes()])
+    assert not doc.index.stale
+
+    # same numbers, index and xrefs as a full parse
+    fresh = LatexParser().parse_latex_file(main_tex)
+    get_state = lambda doc: [(node.number, node.pre, node.post, node.depth, node.child_index, node.get_mpath(),
+        node.title.get_mpath() if node.title else None, [other.get_mpath() for other in doc.enclosing[node] if other])
+        for node in doc.root.iter_nodes()]
+    assert get_state(doc) == get_state(fresh)
+    assert sorted([(label, node.get_mpath()) for label, node in doc.xrefs.items()]) == \
+        sorted([(label, node.get_mpath()) for label, node in fresh.xrefs.items()])
+    assert doc.by_label('sec:more') is doc.xrefs['sec:more']
+    assert [node.get_mpath() for node in doc.images] == [node.get_mpath() for node in fresh.images]
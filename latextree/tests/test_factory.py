@@ -0,0 +1,47 @@
+# test_factory.py
+import threading
+import pytest
+from node import LatexTreeNode, Macro, Environment
+from content import Text
+from factory import ClassCache, NodeFactory, node_classes
+from bibliography import Bibliography
+
+def test_node_factory():
+    node1 = NodeFactory('foo', BaseClass=Macro)
+    node2 = NodeFactory('foo', BaseClass=Macro)
+    assert node1.__class__ is node2.__class__
+    assert node1 is not node2
+    assert NodeFactory('foo', BaseClass=Environment).__class__ is not node1.__class__
+    assert ('foo', Macro) in node_classes
+
+def test_bounded():
+    cache = ClassCache(maxsize=2)
+    foo = cache.get_class('foo')
+    cache.get_class('bar')
+    assert cache.get_class('foo') is foo
+    cache.get_class('baz')
+    assert len(cache) == 2
+    assert ('bar', LatexTreeNode) not in cache
+    assert [name for name, base in cache] == ['Foo', 'Baz']
+    assert cache.info() == (1, 3, 2, 2)
+
+def test_threads():
+    cache = ClassCache()
+    classes = []
+    def get_classes():
+        classes.extend([cache.get_class('foo%d' % (i % 10)) for i in range(1000)])
+    threads = [threading.Thread(target=get_classes) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(classes)) == len(cache) == 10
+    assert cache.info().misses == 10
+
+def test_bibliography():
+    text = '\n'.join(['@book{key%d, title={Title %d}, author={A. Author}, year={2017}}' % (i, i) for i in range(100)])
+    bib = Bibliography(text)
+    titles = [child for item in bib.children for child in item.children if child.get_species() == 'title']
+    assert len(titles) == 100
+    assert len(set([title.__class__ for title in titles])) == 1
+    assert issubclass(titles[0].__class__, Text)
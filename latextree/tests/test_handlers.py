@@ -0,0 +1,98 @@
+# test_handlers.py
+import sys
+import pytest
+import taxonomy as tax
+import walker
+from pylatexenc.latexwalker import LatexCommentNode
+from parser import LatexParser, MACRO_HANDLERS, ENVIRONMENT_HANDLERS
+from content import Text
+from node import LatexTreeNode
+
+def parse(parser, body):
+    return parser.parse_latex_document(r'\documentclass{article}\begin{document}%s\end{document}' % body).root
+
+@pytest.mark.parametrize('macroname, handler', [
+    ('label', 'parse_label_macro'),
+    ('eqref', 'parse_pre_macro'),
+    ('bibliography', 'parse_bibliography_macro'),
+    ('chapter', 'parse_level_macro'),
+    ('question', 'parse_item_macro'),
+    ('\\', 'parse_break_macro'),
+    (' ', 'parse_space_macro'),
+    ('$', 'parse_escaped_macro'),
+    ("'", 'parse_accent_macro'),
+    ('includegraphics', 'parse_media_macro'),
+    ('href', 'parse_reference_macro'),
+])
+def test_macro_handlers(macroname, handler):
+    assert MACRO_HANDLERS[macroname] == handler
+    assert LatexParser().macro_handlers[macroname] == getattr(LatexParser, handler)
+
+def test_environment_handlers():
+    assert ENVIRONMENT_HANDLERS['tabular'] == 'parse_tabular_environment'
+    for envname in tax.environment_sets['dispmath']:
+        assert ENVIRONMENT_HANDLERS[envname] == 'parse_dispmath_environment'
+    assert 'itemize' not in ENVIRONMENT_HANDLERS
+
+def test_register_macro_handler():
+    def parse_tip(parser, macroname, wnode, stack, **kwargs):
+        stack[-1].append_child(Text(text='(tip)'))
+        return stack
+    pa = LatexParser()
+    pa.register_macro_handler('tip', parse_tip)
+    root = parse(pa, r'\tip{x}')
+    assert [child.content for child in root.children if child.species == 'text'] == ['(tip)', 'x']
+
+    # other parsers are not affected
+    root = parse(LatexParser(), r'\tip{x}')
+    assert [child.species for child in root.children] == ['tip', 'text']
+
+def test_register_environment_handler():
+    def parse_solution(parser, envname, wnode, stack, **kwargs):
+        return stack
+    pa = LatexParser()
+    pa.register_environment_handler('solution', parse_solution)
+    assert parse(pa, r'\begin{solution}x\end{solution}').children == []
+
+def test_register_node_handler():
+    pa = LatexParser()
+    pa.register_node_handler(LatexCommentNode, lambda parser, wnode, stack, **kwargs: stack)
+    assert [child.species for child in parse(pa, 'a%b\n').children] == ['text']
+
+def test_subclass():
+    class Parser(LatexParser):
+        def parse_break_macro(self, macroname, wnode, stack, **kwargs):
+            return stack
+    assert parse(Parser(), r'a\par b').children[1].species == 'text'
+    assert parse(LatexParser(), r'a\par b').children[1].species == 'break'
+
+def get_depth(node):
+    depth = 0
+    while node.children:
+        node = node.children[-1]
+        depth += 1
+    return depth
+
+@pytest.mark.parametrize('opening, closing', [
+    (r'\begin{enumerate}\item ', r'\end{enumerate}'),
+    (r'\begin{theorem}[T]', r'\end{theorem}'),
+    (r'\begin{center}a{', r'}\end{center}'),
+    (r'\textbf{', '}'),
+])
+def test_deep_nesting(opening, closing):
+    depth = 1000
+    nodes = walker.parse(opening * depth + 'x' + closing * depth)
+    root = LatexTreeNode()
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(100)
+    try:
+        LatexParser().parse_walker_nodelist(nodes, [root])
+    finally:
+        sys.setrecursionlimit(limit)
+    assert get_depth(root) >= depth
+
+def test_macro_environment():
+    root = parse(LatexParser(), r'\itemize \item a \item b \enditemize c \[x^2\] d \(y\)')
+    assert [child.species for child in root.children] == ['itemize', 'text', 'displaymath', 'text', 'latex']
+    assert [item.species for item in root.children[0].children] == ['item', 'item']
+    assert root.children[2].content == r'\[x^2\]' and root.children[4].content == '$y$'
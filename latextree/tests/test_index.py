@@ -0,0 +1,141 @@
+# test_index.py
+import os
+import pytest
+from parser import LatexParser
+from document import LatexDocument
+from index import DocumentIndex
+from registry import species_classes
+from content import Text
+
+def test_parse(parsed_doc):
+    doc = parsed_doc
+    assert not doc.index.stale
+    for species in ['chapter', 'section', 'image', 'quiz', 'equation', 'text']:
+        assert doc.find_all(species) == doc.root.get_phenotypes(species)
+    for label, node in doc.xrefs.items():
+        assert doc.by_label(label) is node
+    nodes = list(doc.root.iter_nodes())
+    assert sum([len(value) for value in doc.index.species.values()]) == len(nodes)
+    assert all([node.index is doc.index for node in nodes])
+
+@pytest.fixture
+def doc(make_book):
+    return make_book(*[('ch:%d' % n, [Text(text='c%d' % n)]) for n in range(3)])
+
+def test_append(doc):
+    chapters = doc.root.children
+    assert doc.find_all('chapter') == chapters
+    assert doc.find_all(genus='level') == chapters
+    assert doc.by_label('ch:1') is chapters[1]
+    assert doc.by_label('ch:9') is None
+    assert not doc.index.stale
+
+    # appending at the end of the document
+    chapters[-1].append_child(Text(text='d'))
+    assert [node.content for node in doc.find_all('text')] == ['c0', 'c1', 'c2', 'd']
+    assert not doc.index.stale
+
+def test_insert_remove(doc):
+    chapters = list(doc.root.children)
+    chapter = species_classes['chapter']()
+    chapter.label = 'ch:new'
+    doc.root.insert_child(1, chapter)
+    assert doc.find_all('chapter') == [chapters[0], chapter, chapters[1], chapters[2]]
+    assert doc.by_label('ch:new') is chapter
+
+    doc.root.remove_child(chapters[1])
+    assert doc.find_all('chapter') == [chapters[0], chapter, chapters[2]]
+    assert [node.content for node in doc.find_all('text')] == ['c0', 'c2']
+    assert doc.by_label('ch:1') is None
+    assert chapters[1].parent is None and chapters[1].index is None
+    with pytest.raises(ValueError):
+        doc.root.remove_child(chapters[1])
+
+def test_relabel(doc):
+    chapter = doc.root.children[0]
+    chapter.label = 'ch:first'
+    assert doc.by_label('ch:first') is chapter
+    assert doc.by_label('ch:0') is None
+    doc.root.children[2].label = 'ch:first'
+    assert doc.by_label('ch:first') is doc.root.children[2]
+
+def test_root(doc):
+    other = doc
+    doc = LatexDocument()
+    assert doc.find_all('chapter') == [] and doc.by_label('ch:0') is None
+    doc.root = other.root
+    assert doc.find_all('chapter') == doc.root.children
+    with pytest.raises(ValueError):
+        doc.find_all()
+    assert isinstance(DocumentIndex(doc.root).find_all('book')[0], species_classes['book'])
+
+def get_ancestors(node):
+    ancestors = []
+    while node.parent:
+        node = node.parent
+        ancestors.append(node)
+    return ancestors
+
+def test_numbering(parsed_doc):
+    doc = parsed_doc
+    nodes = list(doc.root.iter_nodes())
+    assert [node.pre for node in nodes] == range(len(nodes))
+    assert [node.post for node in doc.root.iter_nodes(order='post')] == range(len(nodes))
+    for node in nodes[::7]:
+        ancestors = get_ancestors(node)
+        assert node.depth == len(ancestors)
+        assert node.parent is None or node.parent.children[node.child_index] is node
+        assert [other for other in nodes if other.is_ancestor_of(node)] == ancestors[::-1]
+        assert doc.index.get_subtree(node) == list(node.iter_nodes())
+        for species in ['chapter', 'section']:
+            enclosing = [other for other in [node] + ancestors if other.species == species]
+            assert node.get_enclosing(species) is (enclosing[0] if enclosing else None)
+
+def test_nested_enclosing():
+    # itemize in itemize, with many itemize siblings before the last text
+    doc = LatexDocument(root=species_classes['book']())
+    outer = species_classes['itemize']()
+    doc.root.append_child(outer)
+    inner = species_classes['itemize']()
+    outer.append_child(inner)
+    for n in range(100):
+        inner.append_child(species_classes['itemize']())
+        inner.children[-1].append_child(Text(text='x'))
+    text = Text(text='y')
+    inner.append_child(text)
+    outer.append_child(Text(text='z'))
+    assert not doc.index.stale
+    assert doc.index.outer['itemize'][:3] == [-1, 0, 1] and set(doc.index.outer['itemize'][2:]) == set([1])
+    assert text.get_enclosing('itemize') is inner
+    assert outer.children[-1].get_enclosing('itemize') is outer
+    assert inner.children[0].children[0].get_enclosing('itemize') is inner.children[0]
+    assert text.get_enclosing('chapter') is None
+
+    # the same after a rebuild
+    doc.index.rebuild()
+    assert doc.index.outer['itemize'][:3] == [-1, 0, 1]
+    assert text.get_enclosing('itemize') is inner
+
+def test_within(tex_root):
+    doc = LatexParser().parse_latex_file(os.path.join(tex_root, 'LatexTreeTestBook', 'main.tex'))
+    for section in doc.find_all('section'):
+        for species in ['equation', 'text', 'section']:
+            assert doc.find_all(species, within=section) == section.get_phenotypes(species)
+    chapter = doc.find_all('chapter')[-1]
+    assert doc.find_all(genus='level', within=chapter) == list(chapter.iter_nodes(genus='level'))
+
+def test_mpath(doc):
+    chapter = doc.root.children[1]
+    for n in range(300):
+        chapter.append_child(Text(text=str(n)))
+    nodes = list(doc.root.iter_nodes())
+    mpaths = [node.get_mpath() for node in nodes]
+    assert mpaths[:3] == ['', '.00', '.00.00']
+    assert chapter.children[-1].get_mpath() == '.01.12c'
+    assert sorted(mpaths) == mpaths
+
+    # same paths without the index
+    doc.root.remove_child(chapter)
+    assert chapter.get_mpath() == '' and chapter.children[2].get_mpath() == '.002'
+    assert chapter.is_ancestor_of(chapter.children[2]) and not chapter.is_ancestor_of(chapter)
+    assert chapter.children[2].get_depth() == 1 and chapter.children[2].get_child_index() == 2
@@ -0,0 +1,99 @@
+# test_node.py
+import os, sys, resource
+import pytest
+from node import LatexTreeNode, Macro
+from factory import NodeFactory
+from registry import species_classes
+from parser import LatexParser
+from cache import dump_tree, load_tree
+
+def all_nodes(root):
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(node.children)
+
+def test_defaults():
+    node = LatexTreeNode()
+    assert (node.label, node.number, node.title, node.content, node.width) == (None,)*5
+    with pytest.raises(AttributeError):
+        node.colour = 'red'
+
+def test_taxonomy():
+    chapter = species_classes['chapter']()
+    assert (chapter.species, chapter.genus, chapter.family) == ('chapter', 'level', 'macro')
+    assert chapter.get_species() is chapter.species is intern('chapter')
+    node = NodeFactory('foo', BaseClass=Macro)
+    assert (node.species, node.genus, node.family) == ('foo', 'macro', 'latextreenode')
+    assert (LatexTreeNode.species, LatexTreeNode.genus, LatexTreeNode.family) == ('latextreenode', 'object', None)
+
+def test_slots(parsed_doc):
+    for node in all_nodes(parsed_doc.root):
+        assert not hasattr(node, '__dict__'), node.__class__
+
+def make_tree():
+    r'''
+    root(a(c, d), b(e)) with species a..e
+    '''
+    nodes = dict([(name, NodeFactory(name, BaseClass=Macro)) for name in 'abcde'])
+    root = NodeFactory('root', BaseClass=LatexTreeNode)
+    root.append_child(nodes['a'])
+    root.append_child(nodes['b'])
+    nodes['a'].append_child(nodes['c'])
+    nodes['a'].append_child(nodes['d'])
+    nodes['b'].append_child(nodes['e'])
+    return root
+
+@pytest.mark.parametrize('order, species', [('pre', 'rootacdbe'), ('post', 'cdaebroot')])
+def test_iter_nodes(order, species):
+    root = make_tree()
+    assert ''.join([node.species for node in root.iter_nodes(order)]) == species
+    assert [node.species for node in root.iter_nodes(order, species=['a', 'e'])] == [x for x in species if x in 'ae']
+    assert [node.species for node in root.iter_nodes(order, genus='macro', filter=lambda node: not node.children)] == [x for x in species if x in 'cde']
+    with pytest.raises(ValueError):
+        list(root.iter_nodes('in'))
+
+def test_iter_events():
+    root = make_tree()
+    events = [(node.species, depth, entering) for node, depth, entering in root.iter_events()]
+    assert events[:3] == [('root', 0, True), ('a', 1, True), ('c', 2, True)]
+    assert events[-2:] == [('b', 1, False), ('root', 0, False)]
+    assert len(events) == 12
+
+def test_deep_tree():
+    depth = 5000
+    root = node = LatexTreeNode()
+    for i in range(depth):
+        child = species_classes['itemize']()
+        child.label = 'lab:%d' % i
+        node.append_child(child)
+        node = child
+    node.append_child(species_classes['chapter']())
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(100)
+    try:
+        assert len(list(root.iter_nodes('post'))) == depth + 2
+        assert len(root.get_xref_dict()) == depth
+        assert len(root.get_phenotypes('itemize')) == depth
+        assert root.get_latex().count(r'\end{itemize}') == depth
+        assert len(root.show().split('\n')) == depth + 2
+        root.set_numbers()
+        root.set_titles()
+        assert node.children[0].number == 1
+        assert len(root.get_xml().xpath("//itemize")) == depth
+    finally:
+        sys.setrecursionlimit(limit)
+
+# memory used by the fixtures scaled up 1000 times (run with LATEXTREE_BENCHMARK=1)
+@pytest.mark.skipif(not os.environ.get('LATEXTREE_BENCHMARK'), reason='benchmark')
+def test_memory_benchmark(main_tex_files):
+    scale = 1000
+    pa = LatexParser()
+    records = [dump_tree(pa.parse_latex_file(main_tex).root) for main_tex in main_tex_files]
+    num_nodes = scale*sum([len(x) for x in records])
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    trees = [load_tree(x, pa.named_classes) for i in range(scale) for x in records]
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+    assert len(trees) == scale*len(records)
+    assert rss*1024/num_nodes < 300, '%d bytes per node' % (rss*1024/num_nodes)
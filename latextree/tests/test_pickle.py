@@ -0,0 +1,68 @@
+# test_pickle.py
+import os
+import sys
+import pickle
+import cPickle
+import multiprocessing
+import pytest
+from lxml import etree
+from parser import LatexParser, NAMED_CLASSES
+from registry import species_classes
+from factory import NodeFactory
+from content import Text
+
+@pytest.mark.parametrize('module', [pickle, cPickle])
+@pytest.mark.parametrize('protocol', [0, 2])
+def test_classes(module, protocol):
+    for cls in NAMED_CLASSES.values():
+        assert module.loads(module.dumps(cls, protocol)) is cls
+    cls = type(NodeFactory('gadget', BaseClass=species_classes['chapter']))
+    assert module.loads(module.dumps(cls, protocol)) is cls
+
+def test_document(parsed_doc):
+    doc = parsed_doc
+    new = cPickle.loads(cPickle.dumps(doc, cPickle.HIGHEST_PROTOCOL))
+    assert etree.tostring(new.root.get_xml()) == etree.tostring(doc.root.get_xml())
+    assert [(node.number, node.title is not None) for node in new.root.iter_nodes()] == \
+        [(node.number, node.title is not None) for node in doc.root.iter_nodes()]
+    assert sorted(new.xrefs) == sorted(doc.xrefs)
+    for label, node in new.xrefs.items():
+        assert new.by_label(label) is node and node.index is new.index
+    assert [(digest, len(nodes)) for digest, nodes, label in new.shards] == [(digest, len(nodes)) for digest, nodes, label in doc.shards]
+    assert all([node.parent is new.root for digest, nodes, label in new.shards for node in nodes])
+    assert new.head['filename'] == doc.head['filename'] and new.preamble == doc.preamble
+
+def test_subtree(tex_root):
+    doc = LatexParser().parse_latex_file(os.path.join(tex_root, 'LatexTreeTestBook', 'main.tex'))
+    chapter = doc.find_all('chapter')[1]
+    new = pickle.loads(pickle.dumps(chapter))
+    assert new.parent is None and new.index is None
+    assert etree.tostring(new.get_xml()) == etree.tostring(chapter.get_xml())
+    assert new.title is not None and new.title.parent is new
+    assert new.number == chapter.number
+
+def test_deep_tree():
+    root = node = species_classes['itemize']()
+    for depth in range(5000):
+        child = species_classes['itemize']()
+        node.append_child(child)
+        node = child
+    node.append_child(Text(text='x'))
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(100)
+    try:
+        for module in (pickle, cPickle):
+            new = module.loads(module.dumps(root, 2))
+            assert len(list(new.iter_nodes())) == 5002
+    finally:
+        sys.setrecursionlimit(limit)
+
+def test_process(tex_root):
+    doc = LatexParser().parse_latex_file(os.path.join(tex_root, 'LatexTreeTestExam', 'main.tex'))
+    pool = multiprocessing.Pool(1)
+    try:
+        root = pool.apply(getattr, (doc, 'root'))
+    finally:
+        pool.close()
+        pool.join()
+    assert etree.tostring(root.get_xml()) == etree.tostring(doc.root.get_xml())
@@ -0,0 +1,47 @@
+# test_postprocessor.py
+import os
+import pytest
+from parser import LatexParser
+from postprocessor import LatexPostProcessor
+
+def test_postprocess(main_tex):
+    doc = LatexParser().parse_latex_file(main_tex)
+    root = doc.root
+    numbers = [node.number for node in root.iter_nodes()]
+    titles = [node.title for node in root.iter_nodes()]
+
+    # compare with the separate traversals
+    for node in root.iter_nodes():
+        node.number = node.title = None
+    root.set_numbers()
+    root.set_titles()
+    assert [node.number for node in root.iter_nodes()] == numbers
+    assert [node.title for node in root.iter_nodes()] == titles
+    assert doc.xrefs == root.get_xref_dict()
+    assert doc.images == root.get_phenotypes('image')
+    assert doc.videos == root.get_phenotypes('media')
+    assert doc.quizzes == root.get_phenotypes('quiz')
+    assert doc.bibliography is next(iter(root.get_phenotypes('bibliography')), None)
+    for node in root.iter_nodes():
+        assert doc.enclosing[node] == (node.get_enclosing_chapter(), node.get_enclosing_section())
+
+def test_book(tex_root):
+    doc = LatexParser().parse_latex_file(os.path.join(tex_root, 'LatexTreeTestBook', 'main.tex'))
+    chapters = doc.root.get_phenotypes('chapter')
+    assert [chapter.number for chapter in chapters] == range(1, len(chapters) + 1)
+    assert doc.bibliography is not None and doc.images
+    assert set([doc.enclosing[image][0] for image in doc.images]) == set([chapters[-2]])
+
+def test_visit():
+    pp = LatexPostProcessor()
+    doc = LatexParser().parse_latex_document(r'\documentclass{article}\begin{document}\section{A}\label{sec:a}\begin{quiz}\end{quiz}\section{B}\includegraphics{x}\end{document}')
+    root = doc.root
+    for node in root.iter_nodes():
+        node.number = None
+    pp.visit(root)
+    sections = root.get_phenotypes('section')
+    assert [section.number for section in sections] == [1, 2]
+    assert pp.xrefs == {'sec:a': sections[0]}
+    assert pp.enclosing[pp.quizzes[0]] == (None, sections[0])
+    assert pp.enclosing[pp.images[0]] == (None, sections[1])
+    assert pp.enclosing[root] == (None, None)
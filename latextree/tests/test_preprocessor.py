@@ -1,4 +1,5 @@
 # test_walker.py
+import os
 import pytest
 from preprocessor import LatexPreProcessor
 
@@ -41,8 +42,85 @@ cleaned = r'''
     \end{document}
 '''
 
-#def test_expand_defs():
-#    pp = LatexPreProcessor()
-#    doc2 = doc.replace('\n','')
-#    cleaned2 = cleaned.replace('\n','')
-#    assert pp.expand_defs(doc2) == cleaned2
+def strip_lines(text):
+    return [x.strip() for x in text.split('\n') if x.strip()]
+
+def test_expand_defs():
+    pp = LatexPreProcessor()
+    assert strip_lines(pp.expand_defs(doc)) == strip_lines(cleaned)
+
+def test_expand_defs_escaped():
+    pp = LatexPreProcessor()
+    text = r'\def\bit{\begin{itemize}} a\\bit b \bit{} c'
+    assert pp.expand_defs(text) == r' a\\bit b \begin{itemize}{} c'
+
+# benchmark: expansion time should grow linearly with the number of definitions (run with LATEXTREE_BENCHMARK=1)
+@pytest.mark.skipif(not os.environ.get('LATEXTREE_BENCHMARK'), reason='benchmark')
+def test_expand_defs_scaling():
+    import timeit
+    def make_doc(n):
+        defs = ''.join([r'\def\mac%s{\textbf{%d}}' % (chr(97 + i % 26) * (1 + i // 26), i) for i in range(n)])
+        uses = ' '.join([r'\mac%s text' % (chr(97 + i % 26) * (1 + i // 26)) for i in range(n)])
+        return defs + uses * 10
+    pp = LatexPreProcessor()
+    small, large = make_doc(100), make_doc(800)
+    t_small = min(timeit.repeat(lambda: pp.expand_defs(small), number=3, repeat=3))
+    t_large = min(timeit.repeat(lambda: pp.expand_defs(large), number=3, repeat=3))
+    assert len(large) > 7 * len(small)
+    assert t_large < 8 * 3 * t_small
+
+macros = [
+    (r'\newcommand{\R}{\mathbb{R}} $x\in\R$', r'\newcommand{\R}{\mathbb{R}} $x\in\mathbb{R}$'),
+    (r'\newcommand\pair[2]{(#1,#2)} $\pair{a}{b}$', r'\newcommand\pair[2]{(#1,#2)} $(a,b)$'),
+    (r'\newcommand{\pair}[2]{(#1,#2)} $\pair a b$', r'\newcommand{\pair}[2]{(#1,#2)} $(a,b)$'),
+    (r'\newcommand{\vect}[2][x]{#1_{#2}} $\vect{1}+\vect[y]{2}$', r'\newcommand{\vect}[2][x]{#1_{#2}} $x_{1}+y_{2}$'),
+    (r'\def\pair#1#2{(#1,#2)}$\pair{a}{\pair{b}{c}}$', r'$(a,(b,c))$'),
+    (r'\def\half{\frac{1}{2}}\def\quarter{\half\half}$\quarter$', r'$\frac{1}{2}\frac{1}{2}$'),
+    (r'\newcommand{\hash}{\#} \hash', r'\newcommand{\hash}{\#} \#'),
+    (r'\newcommand{\R}{\mathbb{R}} % \R', r'\newcommand{\R}{\mathbb{R}} % \R'),
+    (r'\newcommand{\includevideo}[2][1]{\url{#2}}\includevideo{abc}', r'\newcommand{\includevideo}[2][1]{\url{#2}}\includevideo{abc}'),
+    (r'\renewcommand{\emph}[1]{\textbf{#1}}\emph{x}', r'\renewcommand{\emph}[1]{\textbf{#1}}\emph{x}'),
+]
+
+@pytest.mark.parametrize("text,expanded", macros)
+def test_expand_macros(text, expanded):
+    pp = LatexPreProcessor()
+    assert pp.expand_defs(text) == expanded
+
+def test_expand_macros_self_reference():
+    from preprocessor import LatexPreProcessorError
+    pp = LatexPreProcessor()
+    with pytest.raises(LatexPreProcessorError):
+        pp.expand_defs(r'\def\loop{x\loop} \loop')
+
+def test_expand_macros_size_limit():
+    from preprocessor import LatexPreProcessorError
+    text = ''.join([r'\def\m%s{\m%s\m%s}' % (chr(98 + i), chr(97 + i), chr(97 + i)) for i in range(20)])
+    pp = LatexPreProcessor(max_expansion=10**5)
+    with pytest.raises(LatexPreProcessorError):
+        pp.expand_defs(r'\def\ma{x}' + text + r'\mu')
+
+rewrites = [
+    (r'$$a+b$$ and $$c$$', r'\[a+b\] and \[c\]'),
+    (r"``quoted''", r"''quoted''"),
+    (r'\`{e} \$$x$ % $$ `', r'\`{e} \$$x$ % $$ `'),
+    (r'\def\dd{$$}\dd x=1 \dd', r'\[ x=1 \]'),
+]
+
+@pytest.mark.parametrize("text,rewritten", rewrites)
+def test_preprocess(text, rewritten):
+    pp = LatexPreProcessor()
+    assert pp.preprocess(text) == rewritten
+
+def test_add_rule():
+    pp = LatexPreProcessor()
+    pp.add_rule('tildes', r'~', lambda match, depth: ' ')
+    pp.add_rule('mbox', r'\\mbox\{', lambda match, depth: (r'\text{', match.end()), before='macros')
+    assert pp.preprocess(r'\def\nb{a~b}Dr.~X \nb $\mbox{c}$ \~{n}') == r'Dr. X a b $\text{c}$ \~{n}'
+    assert [rule.name for rule in pp.rules] == ['mbox', 'macros', 'backticks', 'double_dollars', 'tildes']
+
+def test_add_rule_duplicate():
+    from preprocessor import LatexPreProcessorError
+    pp = LatexPreProcessor()
+    with pytest.raises(LatexPreProcessorError):
+        pp.add_rule('backticks', r'`', lambda match, depth: None)
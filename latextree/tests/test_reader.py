@@ -0,0 +1,169 @@
+# test_reader.py
+import os
+import pytest
+from reader import resolve_latex_document, read_latex_document
+
+def write_files(tmpdir, files):
+    for name, text in files.items():
+        path = tmpdir.join(name)
+        path.dirpath().ensure(dir=True)
+        path.write_binary(text)
+    return str(tmpdir.join('main.tex'))
+
+def test_input_at_start_of_file(tmpdir):
+    main_tex = write_files(tmpdir, {
+        'main.tex': r'\input{a}' + '\nmain\n',
+        'a.tex': 'a\n',
+    })
+    assert read_latex_document(main_tex) == 'a\n\nmain\n'
+
+def test_comments(tmpdir):
+    main_tex = write_files(tmpdir, {
+        'main.tex': '% \\input{a}\n\\%\\input{b} 50\\% %\\include{a}\n',
+        'b.tex': 'b',
+    })
+    text, graph = resolve_latex_document(main_tex)
+    assert text == '% \\input{a}\n\\%b 50\\% %\\include{a}\n'
+    assert [os.path.basename(x) for x in graph.files] == ['main.tex', 'b.tex']
+
+def test_dependency_graph(tmpdir):
+    main_tex = write_files(tmpdir, {
+        'main.tex': r'\include{ch1}\subfile{ch2}\import{parts/}{p1}',
+        'ch1.tex': r'one\input{ch1/fig}',
+        'ch1/fig.tex': 'fig',
+        'ch2.tex': r'\documentclass[main]{subfiles}\begin{document}two\end{document}',
+        'parts/p1.tex': r'p1\subimport{sub/}{p2}',
+        'parts/sub/p2.tex': 'p2',
+    })
+    text, graph = resolve_latex_document(main_tex)
+    assert text == 'onefigtwop1p2'
+    names = [os.path.relpath(x, str(tmpdir)) for x in graph.files]
+    assert names == ['main.tex', 'ch1.tex', 'ch1/fig.tex', 'ch2.tex', 'parts/p1.tex', 'parts/sub/p2.tex']
+    fig = str(tmpdir.join('ch1/fig.tex'))
+    assert graph.files[fig].size == 3
+    assert graph.dependents(fig) == [main_tex, str(tmpdir.join('ch1.tex'))]
+    assert len(graph.dependencies(main_tex)) == 5
+    assert graph.modified_files() == []
+    tmpdir.join('ch1/fig.tex').write('figure')
+    assert graph.modified_files() == [fig]
+
+def test_cycle(tmpdir):
+    main_tex = write_files(tmpdir, {
+        'main.tex': r'main \input{a}',
+        'a.tex': r'a \input{b}',
+        'b.tex': r'b \input{a}',
+    })
+    text, graph = resolve_latex_document(main_tex)
+    assert text == 'main a b '
+    assert graph.cycles == [(str(tmpdir.join('b.tex')), str(tmpdir.join('a.tex')))]
+
+def test_prefetch(tmpdir, monkeypatch):
+    import time
+    import reader
+    files = dict([('ch%02d.tex' % i, 'chapter %d\n' % i) for i in range(20)])
+    files['main.tex'] = ''.join([r'\include{ch%02d}' % i for i in range(20)])
+    main_tex = write_files(tmpdir, files)
+
+    # simulate a slow (network) file system
+    read_source_file = reader.read_source_file
+    def slow_read_source_file(filename, **kwargs):
+        time.sleep(0.05)
+        return read_source_file(filename, **kwargs)
+    monkeypatch.setattr(reader, 'read_source_file', slow_read_source_file)
+
+    text, graph = resolve_latex_document(main_tex, max_workers=20)
+    assert text == ''.join(['chapter %d\n' % i for i in range(20)])
+    assert graph.read_time < 20 * 0.05
+    assert all([source.read_time >= 0 for source in graph])
+
+def test_source_map(tmpdir):
+    main_tex = write_files(tmpdir, {
+        'main.tex': 'first\n\\input{a}\nlast\n',
+        'a.tex': 'a1\na2',
+    })
+    text, graph = resolve_latex_document(main_tex)
+    assert text == 'first\na1\na2\nlast\n'
+    source_map = graph.source_map
+    def locate(s):
+        filename, line, column = source_map.locate(text.index(s))
+        return os.path.basename(filename), line, column
+    assert locate('first') == ('main.tex', 1, 1)
+    assert locate('a1') == ('a.tex', 1, 1)
+    assert locate('a2') == ('a.tex', 2, 1)
+    assert locate('\nlast') == ('main.tex', 2, 10)
+    assert locate('last') == ('main.tex', 3, 1)
+    with pytest.raises(IndexError):
+        source_map.locate(len(text))
+
+def test_source_map_subfile(tmpdir):
+    main_tex = write_files(tmpdir, {
+        'main.tex': 'x \\subfile{b}y',
+        'b.tex': '\\documentclass{subfiles}\n\\begin{document}\nb1\n\\end{document}\n',
+    })
+    text, graph = resolve_latex_document(main_tex)
+    assert text == 'x \nb1\ny'
+    assert graph.source_map.locate(text.index('b1'))[1:] == (3, 1)
+    assert graph.source_map.locate(text.index('y'))[1:] == (1, 14)
+
+@pytest.mark.parametrize('use_mmap', [False, True])
+@pytest.mark.parametrize('block_size', [None, 1])
+def test_mmap(tmpdir, monkeypatch, use_mmap, block_size):
+    if block_size:
+        import reader
+        monkeypatch.setattr(reader, 'COPY_BLOCK_SIZE', block_size)
+    main_tex = write_files(tmpdir, {
+        'main.tex': 'x \\input{a}\\subfile{b}\\input{empty}y',
+        'a.tex': 'caf\xc3\xa9 \\input{c}\n\xc3\xa9',
+        'b.tex': '\xc3\xa9\\begin{document}b\\end{document}',
+        'c.tex': 'c',
+        'empty.tex': '',
+    })
+    text, graph = resolve_latex_document(main_tex, use_mmap=use_mmap)
+    assert text == 'x caf\xc3\xa9 c\n\xc3\xa9by'
+    assert graph.source_map.locate(text.index('c'))[1:] == (1, 1)
+    assert graph.source_map.locate(text.index('\n'))[1:] == (1, 16)
+    text, graph = resolve_latex_document(main_tex, use_mmap=use_mmap, encoding='utf-8')
+    assert text == u'x caf\xe9 c\n\xe9by'
+    assert graph.source_map.locate(text.index(u'\n'))[1:] == (1, 15)
+    assert graph.source_map.locate(text.index(u'\n') + 1)[1:] == (2, 1)
+    assert graph.source_map.locate(text.index(u'b'))[1:] == (1, 18)
+
+def test_map_in_threads():
+    import threading
+    from reader import map_in_threads
+    count = threading.active_count()
+    assert map_in_threads(lambda n: n * n, range(50), 8) == [n * n for n in range(50)]
+    assert threading.active_count() == count
+    with pytest.raises(ZeroDivisionError):
+        map_in_threads(lambda n: 1 / n, range(10), 4)
+    assert threading.active_count() == count
+
+# peak memory of reading a 100 MB document (run with LATEXTREE_BENCHMARK=1)
+@pytest.mark.skipif(not os.environ.get('LATEXTREE_BENCHMARK'), reason='benchmark')
+@pytest.mark.parametrize('use_mmap', [False, True])
+def test_memory_benchmark(tmpdir, use_mmap):
+    import sys, subprocess
+    line = 'Some text with $x^2$ and \\emph{words} in a fairly ordinary line.\n'
+    part = line * (25 * 2**20 // len(line))
+    files = {'main.tex': '\\begin{document}\n' + ''.join(['\\input{part%d}\n' % n for n in range(4)]) + '\\end{document}\n'}
+    for n in range(4):
+        files['part%d.tex' % n] = part
+    main_tex = write_files(tmpdir, files)
+    size = 4*len(part)
+    del files, part
+
+    # in a new process, so that ru_maxrss is not raised by other tests
+    script = '''
+import sys, resource
+from reader import resolve_latex_document
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+text = resolve_latex_document(sys.argv[1], use_mmap=sys.argv[2] == 'True')[0]
+print len(text), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+'''
+    env = dict(os.environ, PYTHONPATH=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    output = subprocess.check_output([sys.executable, '-c', script, main_tex, str(use_mmap)], env=env)
+    length, rss = [int(value) for value in output.split()]
+    assert length > size
+    # the document, its source map and (without mmap) one included file
+    limit = 1.2 if use_mmap else 1.5
+    assert rss*1024 < limit*size, '%.2f bytes per byte of the document' % (rss*1024.0/size)
@@ -0,0 +1,39 @@
+# test_registry.py
+import pytest
+import taxonomy as tax
+from parser import LatexParser
+from registry import family_classes, genus_classes, species_classes
+
+def test_shared_classes():
+    assert LatexParser().classes is LatexParser().classes is species_classes
+    root = LatexParser().parse_latex_document(r'\documentclass{book}\begin{document}\chapter{A}\end{document}').root
+    assert isinstance(root.children[0], species_classes['chapter'])
+
+@pytest.mark.parametrize('family, genera', [('macro', tax.macros), ('environment', tax.environments), ('switch', tax.switches)])
+def test_taxonomy(family, genera):
+    for genus in genera:
+        assert genus_classes[(family, genus)].get_genus() == family
+        for species in genera[genus]:
+            cls = species_classes[species]
+            assert cls.get_species() == species
+            assert species in genera[cls.get_genus()]
+            assert cls.get_family() == family
+    assert set(family_classes) == set(['macro', 'environment', 'switch'])
+
+def test_frozen():
+    with pytest.raises(TypeError):
+        species_classes['chapter'] = None
+    assert 'chapter' in species_classes and 'foo' not in species_classes
+
+def test_parser_creation(monkeypatch):
+    import factory, registry
+    calls = []
+    def count(*args, **kwargs):
+        calls.append(args)
+        return ClassFactory(*args, **kwargs)
+    ClassFactory = factory.ClassFactory
+    for module in (factory, registry):
+        monkeypatch.setattr(module, 'ClassFactory', count)
+    first, second = LatexParser(), LatexParser()
+    assert calls == []
+    assert first.classes is second.classes is species_classes
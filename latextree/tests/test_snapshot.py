@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# test_snapshot.py
+import os
+import sys
+import subprocess
+import cPickle
+import pytest
+from array import array
+from lxml import etree
+from document import LatexDocument
+from content import Text, Image
+import snapshot
+from snapshot import SnapshotError
+
+@pytest.mark.parametrize('compression', [None, 'zlib', 'bz2'])
+def test_save_load(tmpdir, parsed_doc, compression):
+    doc = parsed_doc
+    filename = str(tmpdir.join('doc.ltree'))
+    doc.save(filename, compression=compression)
+    new = LatexDocument.load(filename)
+    assert etree.tostring(new.root.get_xml()) == etree.tostring(doc.root.get_xml())
+    assert [node.number for node in new.root.iter_nodes()] == [node.number for node in doc.root.iter_nodes()]
+    assert sorted(new.xrefs) == sorted(doc.xrefs)
+    for label, node in new.xrefs.items():
+        assert new.by_label(label) is node
+    assert len(new.images) == len(doc.images) and len(new.quizzes) == len(doc.quizzes)
+    assert [len(nodes) for digest, nodes, label in new.shards] == [len(nodes) for digest, nodes, label in doc.shards]
+    assert new.preamble == doc.preamble and new.head['filename'] == doc.head['filename']
+
+@pytest.fixture
+def doc(make_book):
+    images = [Image(), Image()]
+    images[0].width, images[1].width = 2**40, 0.5
+    return make_book((u'ch:caf\xe9', [Text(text=value) for value in ['plain', u'α + β', 'caf\xe9']] + images))
+
+def get_values(doc):
+    return [(type(node).__name__, type(node.content), node.content, node.label, node.width) for node in doc.root.iter_nodes()]
+
+def test_values(tmpdir, doc):
+    filename = str(tmpdir.join('doc.ltree'))
+    doc.save(filename)
+    new = LatexDocument.load(filename)
+    assert get_values(new) == get_values(doc)
+    assert new.by_label(u'ch:caf\xe9') is new.root.children[0]
+
+def test_byte_order(doc):
+    sections = snapshot.dump_document(doc)
+    for position, typecode in zip([1, 2] + range(4, 11), 'Bi' + 'iiiiiBi'):
+        table = array(typecode)
+        table.fromstring(sections[position])
+        table.byteswap()
+        sections[position] = table.tostring()
+    other = 'big' if sys.byteorder == 'little' else 'little'
+    root, state = snapshot.load_sections(sections, other)
+    assert [node.content for node in root.iter_nodes()] == [node.content for node in doc.root.iter_nodes()]
+
+def test_errors(tmpdir, doc):
+    with pytest.raises(ValueError):
+        doc.save(str(tmpdir.join('doc.ltree')), compression='rar')
+    filename = str(tmpdir.join('doc.ltree'))
+    doc.save(filename, compression=None)
+    with open(filename, 'rb') as f:
+        data = f.read()
+    bad = {
+        'text': 'not a snapshot',
+        'version': data[:8] + chr(snapshot.FORMAT_VERSION + 1) + data[9:],
+        'compression': data[:9] + chr(7) + data[10:],
+        'truncated': data[:-5],
+        'bad zlib': data[:9] + chr(1) + data[10:],
+    }
+    for name, value in bad.items():
+        filename = str(tmpdir.join(name.replace(' ', '_')))
+        with open(filename, 'wb') as f:
+            f.write(value)
+        with pytest.raises(SnapshotError):
+            LatexDocument.load(filename)
+
+class Opener(object):
+    # unpickled as a call to open
+    def __init__(self, filename):
+        self.filename = filename
+    def __reduce__(self):
+        return (open, (self.filename, 'w'))
+
+def test_tampered(tmpdir, doc):
+    marker = str(tmpdir.join('marker'))
+    sections = snapshot.dump_document(doc)
+    state = cPickle.loads(sections[0])
+    state['head']['x'] = Opener(marker)
+    sections[0] = cPickle.dumps(state, 2)
+    filename = str(tmpdir.join('doc.ltree'))
+    snapshot.write_sections(filename, sections, 'zlib')
+    with pytest.raises(SnapshotError):
+        LatexDocument.load(filename)
+    assert not os.path.exists(marker)
+
+    # values that cannot be loaded are not saved
+    doc.head['x'] = Opener(marker)
+    with pytest.raises(ValueError):
+        doc.save(filename)
+
+def test_no_parser(tmpdir, parsed_doc):
+    # loading a snapshot does not import the parser
+    filename = str(tmpdir.join('doc.ltree'))
+    parsed_doc.save(filename)
+    script = '''
+import sys
+from document import LatexDocument
+doc = LatexDocument.load(sys.argv[1])
+print len(doc.find_all('section')), sorted(set(['parser', 'walker', 'tokenizer', 'pylatexenc']) & set(sys.modules))
+'''
+    env = dict(os.environ, PYTHONPATH=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    output = subprocess.check_output([sys.executable, '-c', script, filename], env=env)
+    assert output.split(' ', 1) == [str(len(parsed_doc.find_all('section'))), '[]\n']
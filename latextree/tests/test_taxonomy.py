@@ -0,0 +1,17 @@
+# test_taxonomy.py
+import pytest
+import taxonomy as tax
+from registry import species_classes
+
+def test_sets():
+    assert 'chapter' in tax.macro_species and 'itemize' in tax.environment_species and 'bf' in tax.switch_species
+    assert tax.species == tax.macro_species | tax.environment_species | tax.switch_species
+    assert tax.macro_sets['level'] == frozenset(tax.macros['level'])
+    assert tax.reference_species == frozenset(tax.macros['xref'] + tax.macros['href'])
+
+@pytest.mark.parametrize('species', sorted(tax.species))
+def test_index(species):
+    cls = species_classes[species]
+    assert tax.species_index[species] == (cls.genus, cls.family)
+    category = {'macro': tax.Category.MACRO, 'environment': tax.Category.ENVIRONMENT, 'switch': tax.Category.SWITCH}[cls.family]
+    assert tax.species_category[species] & category
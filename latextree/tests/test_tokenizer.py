@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# test_tokenizer.py
+# differential tests: the regex front end must give the same nodes as pylatexenc
+import sys
+import random
+import pytest
+from lxml import etree
+import walker
+from parser import LatexParser
+from reader import resolve_latex_document
+from preprocessor import LatexPreProcessor
+
+def parse_both(text):
+    return repr(walker.parse(text, front_end='pylatexenc')), repr(walker.parse(text, front_end='regex'))
+
+@pytest.mark.parametrize('preprocess', [False, True])
+def test_fixture(main_tex, preprocess):
+    text = resolve_latex_document(main_tex)[0]
+    if preprocess:
+        text = LatexPreProcessor().preprocess(text)
+    expected, actual = parse_both(text)
+    assert actual == expected
+
+quirks = [
+    'a  \n\nb',                                  # spaces before a paragraph break are dropped
+    'a \n \n\n \nb\n\n\n\nc',
+    'a\r\n\r\nb',
+    'end of input  ',
+    r'\textbf  {x} \& y \\  z',                   # space after alphabetic macros only
+    r'\item[a] \item [b]\item{c}',
+    r'\frac{a}   %c' + '\n{b}',                     # comment inside macro arguments
+    r'\frac{a}     %abc' + '\n{b}',
+    r'%first' + '\r\n  ' + r'%second',
+    r'} a ] \end{center} b',                     # unmatched closing braces and environments
+    r'\begin{tabular}[t]{ll}a\end{tabular}',     # optional or mandatory environment argument
+    r'\begin{center} [x]\end{center}',
+    r'$$x$$ $a{$b$}c$ \$',
+    r'\section*{A}\section**{B}\begin*{x}',
+    r'\newcommand{\R}[1][x]{#1} \renewcommand\foo{bar}',
+    r'\textbf\end{x}',
+    r'\frac{a}',
+    r'\textbf',
+    u'\\caf\xe9 \\x\xb2 \xe9t\xe9',
+    '\\\\[2ex] \\[x\\] \\(y\\)',
+]
+
+@pytest.mark.parametrize('text', quirks)
+def test_quirks(text):
+    expected, actual = parse_both(text)
+    assert actual == expected
+
+pieces = ['a', 'b c', ' ', '\n', '\n\n', '\r\n', '\t', '{', '}', '[', ']', '$', '%c\n', '\\\\', '\\[', '\\]', '\\textbf', '\\textbf ',
+    '\\frac', '\\item', '\\item[x]', '\\section*', '\\begin{itemize}', '\\end{itemize}', '\\begin{center}', '\\end{center}', '\\end{x}',
+    '\\newcommand', '\\includegraphics', '\\href', '\\&', '\\ ', '*', '_', '^', "\\'", '\\documentclass', '\\cite', '#1', '~']
+
+def parse_or_error(text, front_end):
+    try:
+        return repr(walker.parse(text, front_end=front_end))
+    except Exception as error:
+        return type(error).__name__
+
+def test_random():
+    rand = random.Random(1)
+    for count in range(500):
+        text = ''.join([rand.choice(pieces) for idx in range(rand.randint(1, 30))])
+        expected = parse_or_error(text, 'pylatexenc')
+        # pylatexenc fails on \begin{...} at the end of the input
+        if expected != 'IndexError':
+            assert parse_or_error(text, 'regex') == expected, text
+
+def test_deep_nesting():
+    depth = 3000
+    text = r'\textbf{\begin{center}[x]{' * depth + 'x' + r'}\end{center}}' * depth
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(100)
+    try:
+        nodes = walker.parse(text, front_end='regex')
+    finally:
+        sys.setrecursionlimit(limit)
+    assert len(nodes) == 1
+
+def test_front_ends():
+    assert walker.DEFAULT_FRONT_END in walker.FRONT_ENDS
+    with pytest.raises(ValueError):
+        walker.parse('x', front_end='none')
+    walker.register_front_end('chars', lambda text, **kwargs: [walker.LatexCharsNode(chars=text)])
+    try:
+        assert walker.parse(r'\x', front_end='chars')[0].chars == r'\x'
+    finally:
+        del walker.FRONT_ENDS['chars']
+
+def test_parser(main_tex, parsed_doc):
+    # parsed_doc is parsed with the default (regex) front end
+    assert walker.DEFAULT_FRONT_END == 'regex'
+    doc = LatexParser(front_end='pylatexenc').parse_latex_file(main_tex)
+    assert etree.tostring(doc.root.get_xml()) == etree.tostring(parsed_doc.root.get_xml())
@@ -1,6 +1,9 @@
 # test_walker.py
+import os
+import sys
 import pytest
-from walker import parse, nodelist_to_latex
+from StringIO import StringIO
+from walker import parse, nodelist_to_latex, NodeRange
 
 test_strings = (
     r'\alpha',
@@ -16,3 +19,48 @@ test_strings = (
 @pytest.mark.parametrize("latex_str", test_strings)
 def test_walker(latex_str):
     assert latex_str == nodelist_to_latex(parse(latex_str))
+
+def test_node_range():
+    nodes = parse(r'a\[b\]c')
+    view = NodeRange(nodes, 1, 4)
+    assert len(view) == 3 and list(view) == nodes[1:4] and view[-1] is nodes[3]
+    assert list(NodeRange(view, 1)) == nodes[2:4]
+    with pytest.raises(IndexError):
+        view[3]
+
+def test_deep_nodelist():
+    depth = 1000
+    latex_str = r'\textbf{' * depth + '{' * depth + r'$x$' + '}' * depth + '}' * depth
+    nodes = parse(latex_str)
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(100)
+    try:
+        assert latex_str == nodelist_to_latex(nodes)
+    finally:
+        sys.setrecursionlimit(limit)
+
+def test_pylatexenc_recursion_limit():
+    limit = sys.getrecursionlimit()
+    latex_str = r'\textbf{' * 300 + 'x' + '}' * 300
+    assert latex_str == nodelist_to_latex(parse(latex_str, front_end='pylatexenc'))
+    assert sys.getrecursionlimit() == limit
+
+@pytest.mark.parametrize("latex_str", test_strings + (r'a \[x + y\] b $c$ d', r'\begin{align}x &= 1\end{align}'))
+def test_stream(latex_str):
+    stream = StringIO()
+    assert nodelist_to_latex(parse(latex_str), stream=stream, non_breaking_spaces=True) is None
+    assert stream.getvalue() == nodelist_to_latex(parse(latex_str), non_breaking_spaces=True)
+
+# benchmark: serialization time should grow linearly with the length of an equation (run with LATEXTREE_BENCHMARK=1)
+@pytest.mark.skipif(not os.environ.get('LATEXTREE_BENCHMARK'), reason='benchmark')
+def test_math_scaling():
+    import timeit
+    def make_align(n):
+        rows = [r'x_{%d} & = a_{%d} + \frac{b}{%d} \\' % (i, i, i) for i in range(n)]
+        return parse(r'\begin{align}%s\end{align}' % ' '.join(rows))
+    small, large = make_align(250), make_align(2000)
+    serialize = lambda nodes: nodelist_to_latex(nodes, non_breaking_spaces=True)
+    assert '~' in serialize(small) and len(serialize(large)) > 7 * len(serialize(small))
+    t_small = min(timeit.repeat(lambda: serialize(small), number=3, repeat=3))
+    t_large = min(timeit.repeat(lambda: serialize(large), number=3, repeat=3))
+    assert t_large < 8 * 3 * t_small
@@ -0,0 +1,383 @@
+"""
+tokenizer.py
+Regular-expression front end for walker.parse.
+
+LatexTokenizer produces the same LatexNode objects (pylatexenc node
+classes) as pylatexenc's LatexWalker with keep_inline_math=True, but
+    tokens are matched with compiled regular expressions, and runs of
+    plain text (words and the spaces between them) are read as one token
+    groups, environments and macro arguments are parsed without recursion:
+    each parsing routine is a generator that yields the routines it calls
+    (see LatexTokenizer.run)
+
+The behaviour of LatexWalker is reproduced, including its quirks:
+    spaces before a paragraph break (two newlines) are dropped
+    spaces after alphabetic macros are consumed (macro_post_space)
+    trailing spaces at the end of the input are dropped
+    unmatched closing braces and \end{...} are dropped
+    an environment takes either an optional or a mandatory argument,
+    but not both
+
+>>> from tokenizer import LatexTokenizer
+>>> LatexTokenizer(r'\textbf{bold}', macro_dict=macrosdef.macro_dict).get_latex_nodes()
+"""
+
+import re, sys, types
+
+from pylatexenc.latexwalker import (
+    LatexEnvironmentNode,
+    LatexMathNode,
+    LatexCommentNode,
+    LatexMacroNode,
+    LatexCharsNode,
+    LatexGroupNode,
+    LatexWalkerError,
+    LatexWalkerParseError,
+    LatexWalkerEndOfStream,
+    default_macro_dict,
+)
+
+import logging
+logger = logging.getLogger(__name__)
+
+#------------------------------------------------
+# token patterns
+#------------------------------------------------
+# LatexWalker uses str.isspace and str.isalpha (ascii) for byte strings and
+# unicode.isspace and unicode.isalpha for unicode strings
+def build_patterns(flags):
+    '''
+    Compile the token patterns (flags is 0 or re.UNICODE).
+    '''
+    text = r'[^\\%{}$\s]'
+    text_no_brackets = r'[^\\%{}$\[\]\s]'
+    words = r'%s+(?:[^\S\n]*(?:\n[^\S\n]*)?%s+)*'
+    return {
+        'space': re.compile(r'\s*', flags),
+        'macro': re.compile(r'\\(?:([^\W\d_]+)|(.))(\*?)', flags | re.DOTALL),
+        'text': re.compile(words % (text, text), flags),
+        'text_no_brackets': re.compile(words % (text_no_brackets, text_no_brackets), flags),
+    }
+
+PATTERNS = {str: build_patterns(0), unicode: build_patterns(re.UNICODE)}
+
+# these are compiled without flags by LatexWalker (ascii \s and \w)
+ENVIRONMENT_RE = re.compile(r'\s*\{([\w*]+)\}')
+COMMENT_RE = re.compile(r'%([^\n\r]*)([\n\r]\s*)?')
+
+# token types (as LatexToken.tok)
+CHAR, MACRO, COMMENT, BRACE_OPEN, BRACE_CLOSE, MATHMODE_INLINE, BEGIN_ENVIRONMENT, END_ENVIRONMENT = (
+    'char', 'macro', 'comment', 'brace_open', 'brace_close', 'mathmode_inline', 'begin_environment', 'end_environment')
+
+
+#------------------------------------------------
+# tokenizer
+#------------------------------------------------
+class LatexTokenizer(object):
+    '''
+    Drop-in replacement for pylatexenc's LatexWalker.
+        s - the latex source (str or unicode)
+        macro_dict - MacrosDef for each macro name (see macrosdef.py)
+        keep_inline_math, tolerant_parsing, strict_braces - as LatexWalker
+    Tokens are tuples (tok, arg, pos, len, pre_space, post_space).
+    '''
+    def __init__(self, s, macro_dict=None, keep_inline_math=False, tolerant_parsing=True, strict_braces=False):
+        self.s = s
+        self.macro_dict = macro_dict if macro_dict is not None else default_macro_dict
+        self.keep_inline_math = keep_inline_math
+        self.tolerant_parsing = tolerant_parsing
+        self.strict_braces = strict_braces
+        patterns = PATTERNS[unicode if isinstance(s, unicode) else str]
+        self.space_re = patterns['space']
+        self.macro_re = patterns['macro']
+        self.text_re = patterns['text']
+        self.text_no_brackets_re = patterns['text_no_brackets']
+
+    def get_token(self, pos, brackets_are_chars=True, environments=True, keep_inline_math=None, text=False):
+        '''
+        Read the token at pos (see LatexWalker.get_token). If text is True
+        a run of plain text is returned as a single char token.
+        Raises LatexWalkerEndOfStream at the end of the input.
+        '''
+        s = self.s
+
+        # leading space (a paragraph break is a token)
+        end = self.space_re.match(s, pos).end()
+        space = ''
+        if end > pos:
+            space = s[pos:end]
+            idx = space.find('\n\n')
+            if idx >= 0:
+                return (CHAR, '\n\n', pos + idx, 2, '', '')
+            pos = end
+        if pos >= len(s):
+            raise LatexWalkerEndOfStream()
+        char = s[pos]
+
+        # macros and environments
+        if char == '\\':
+            match = self.macro_re.match(s, pos)
+            if match is None:
+                return (CHAR, char, pos, 1, space, '')
+            name = match.group(1)
+            if name is not None and not name.isalpha():
+                # the pattern also matches numeric characters (e.g. superscript digits)
+                name = name[:[c.isalpha() for c in name].index(False)]
+                macro = name or s[pos + 1]
+                end = pos + 1 + len(macro)
+                if s[end:end + 1] == '*':
+                    macro += '*'
+                    end += 1
+            else:
+                macro = (name or match.group(2)) + match.group(3)
+                end = match.end()
+            if environments and (macro == 'begin' or macro == 'end'):
+                match = ENVIRONMENT_RE.match(s, end)
+                if match is None:
+                    raise LatexWalkerParseError(s=s, pos=pos, msg="Bad \\%s macro: expected {environment}" % macro)
+                return (BEGIN_ENVIRONMENT if macro == 'begin' else END_ENVIRONMENT, match.group(1), pos, match.end() - pos, space, '')
+            post_space = ''
+            if name:
+                # LaTeX does not consume space after non-alpha macros, like \&
+                post_end = self.space_re.match(s, end).end()
+                if post_end > end:
+                    post_space = s[end:post_end]
+                    end = post_end
+            return (MACRO, macro, pos, end - pos, space, post_space)
+
+        # comments
+        if char == '%':
+            match = COMMENT_RE.match(s, pos)
+            return (COMMENT, match.group(1), pos, match.end() - pos, space, match.group(2) or '')
+
+        # braces
+        if char == '{' or (char == '[' and not brackets_are_chars):
+            return (BRACE_OPEN, char, pos, 1, space, '')
+        if char == '}' or (char == ']' and not brackets_are_chars):
+            return (BRACE_CLOSE, char, pos, 1, space, '')
+
+        # inline maths ($$ is not)
+        if char == '$':
+            if keep_inline_math is None:
+                keep_inline_math = self.keep_inline_math
+            if keep_inline_math and s[pos + 1:pos + 2] != '$':
+                return (MATHMODE_INLINE, char, pos, 1, space, '')
+            return (CHAR, char, pos, 1, space, '')
+
+        # text
+        if text:
+            match = (self.text_re if brackets_are_chars else self.text_no_brackets_re).match(s, pos)
+            if match is not None:
+                return (CHAR, match.group(), pos, match.end() - pos, space, '')
+        return (CHAR, char, pos, 1, space, '')
+
+    #--------------------------------------------
+    # parsing routines
+    #
+    # Each routine is a generator which yields the routines it calls (and
+    # receives their results) and finally yields its own result, a tuple
+    # (node or nodelist, pos, len) as in LatexWalker.
+    #--------------------------------------------
+    def run(self, routine):
+        '''
+        Run a routine and the routines it calls on an explicit stack.
+        Exceptions are passed on to the calling routine.
+        '''
+        stack = [routine]
+        value = None
+        error = None
+        while True:
+            try:
+                if error is None:
+                    result = stack[-1].send(value)
+                else:
+                    error, exc_info = None, error
+                    result = stack[-1].throw(*exc_info)
+            except LatexWalkerError:
+                stack.pop()
+                if not stack:
+                    raise
+                error = sys.exc_info()
+                continue
+            if isinstance(result, types.GeneratorType):
+                stack.append(result)
+                value = None
+            else:
+                stack.pop()
+                if not stack:
+                    return result
+                value = result
+
+    def get_latex_nodes(self, pos=0, stop_upon_closing_brace=None, stop_upon_end_environment=None, stop_upon_closing_mathmode=None):
+        '''
+        Parse the source into a list of nodes (see LatexWalker.get_latex_nodes).
+        Returns (nodelist, pos, len).
+        '''
+        return self.run(self.latex_nodes_routine(pos, stop_upon_closing_brace, stop_upon_end_environment, stop_upon_closing_mathmode))
+
+    def latex_nodes_routine(self, pos, stop_upon_closing_brace=None, stop_upon_end_environment=None, stop_upon_closing_mathmode=None):
+        nodelist = []
+        brackets_are_chars = (stop_upon_closing_brace != ']')
+        origpos = pos
+        lastchars = []
+
+        while True:
+            try:
+                try:
+                    tok, arg, tpos, tlen, pre_space, post_space = self.get_token(pos, brackets_are_chars=brackets_are_chars, text=True)
+                except LatexWalkerEndOfStream:
+                    if not self.tolerant_parsing:
+                        raise
+                    break
+                pos = tpos + tlen
+
+                # characters are collected
+                if tok == CHAR:
+                    lastchars.append(pre_space)
+                    lastchars.append(arg)
+                    continue
+
+                # anything else: flush the characters (and leading space) first
+                if lastchars:
+                    lastchars.append(pre_space)
+                    nodelist.append(LatexCharsNode(chars=''.join(lastchars)))
+                    lastchars = []
+                elif pre_space:
+                    nodelist.append(LatexCharsNode(chars=pre_space))
+
+                if tok == BRACE_CLOSE:
+                    if arg == stop_upon_closing_brace:
+                        break
+                    if not self.tolerant_parsing:
+                        raise LatexWalkerParseError(s=self.s, pos=tpos, msg="Unexpected mismatching closing brace: `%s'" % arg)
+
+                elif tok == END_ENVIRONMENT:
+                    if arg == stop_upon_end_environment:
+                        break
+                    if not self.tolerant_parsing:
+                        raise LatexWalkerParseError(s=self.s, pos=tpos,
+                            msg="Unexpected mismatching closing environment: `%s', expecting `%s'" % (arg, stop_upon_end_environment))
+
+                elif tok == MATHMODE_INLINE:
+                    if stop_upon_closing_mathmode is not None:
+                        if stop_upon_closing_mathmode != '$':
+                            raise LatexWalkerParseError(s=self.s, pos=tpos, msg="Unexpected mismatching closing math mode: `$'")
+                        break
+                    mathlist, mpos, mlen = yield self.latex_nodes_routine(pos, stop_upon_closing_mathmode='$')
+                    pos = mpos + mlen
+                    nodelist.append(LatexMathNode(displaytype='inline', nodelist=mathlist))
+
+                elif tok == COMMENT:
+                    nodelist.append(LatexCommentNode(comment=arg, comment_post_space=post_space))
+
+                elif tok == BRACE_OPEN:
+                    group, gpos, glen = yield self.latex_braced_group_routine(tpos)
+                    pos = gpos + glen
+                    nodelist.append(group)
+
+                elif tok == BEGIN_ENVIRONMENT:
+                    env, epos, elen = yield self.latex_environment_routine(tpos, arg)
+                    pos = epos + elen
+                    nodelist.append(env)
+
+                elif tok == MACRO:
+                    nodeoptarg = None
+                    nodeargs = []
+                    mac = self.macro_dict.get(arg.rstrip('*'))
+                    if mac is not None:
+                        if mac.optarg:
+                            optarg = yield self.latex_maybe_optional_arg_routine(pos)
+                            if optarg is not None:
+                                nodeoptarg, pos = optarg[0], optarg[1] + optarg[2]
+                        for kind in (mac.numargs if isinstance(mac.numargs, basestring) else '{' * mac.numargs):
+                            if kind == '{':
+                                node, npos, nlen = yield self.latex_expression_routine(pos)
+                                pos = npos + nlen
+                            elif kind == '[':
+                                optarg = yield self.latex_maybe_optional_arg_routine(pos)
+                                node = None
+                                if optarg is not None:
+                                    node, pos = optarg[0], optarg[1] + optarg[2]
+                            else:
+                                raise LatexWalkerError("Unknown macro argument kind for macro %s: %s" % (mac.macname, kind))
+                            nodeargs.append(node)
+                    nodelist.append(LatexMacroNode(macroname=arg, nodeoptarg=nodeoptarg, nodeargs=nodeargs, macro_post_space=post_space))
+
+            except LatexWalkerEndOfStream:
+                # raised by a macro argument
+                if stop_upon_closing_brace or stop_upon_end_environment:
+                    if not self.tolerant_parsing:
+                        raise LatexWalkerError("Unexpected end of stream!")
+                else:
+                    break
+
+        if lastchars:
+            nodelist.append(LatexCharsNode(chars=''.join(lastchars)))
+        yield (nodelist, origpos, pos - origpos)
+
+    def latex_braced_group_routine(self, pos, brace_type='{'):
+        if brace_type == '{':
+            closing_brace = '}'
+        elif brace_type == '[':
+            closing_brace = ']'
+        else:
+            raise LatexWalkerParseError(s=self.s, pos=pos, msg="Uknown brace type: %s" % brace_type)
+        tok, arg, tpos, tlen, pre_space, post_space = self.get_token(pos, brackets_are_chars=(brace_type != '['))
+        if tok != BRACE_OPEN or arg != brace_type:
+            raise LatexWalkerParseError(s=self.s, pos=pos, msg='get_latex_braced_group: not an opening brace/bracket: %s' % self.s[pos])
+        nodelist, npos, nlen = yield self.latex_nodes_routine(tpos + tlen, stop_upon_closing_brace=closing_brace)
+        yield (LatexGroupNode(nodelist=nodelist), tpos, npos + nlen - tpos)
+
+    def latex_environment_routine(self, pos, environmentname):
+        startpos = pos
+        tok, arg, tpos, tlen, pre_space, post_space = self.get_token(pos)
+        if tok != BEGIN_ENVIRONMENT or arg != environmentname:
+            raise LatexWalkerParseError(s=self.s, pos=pos, msg=r'get_latex_environment: expected \begin{%s}: %s' % (environmentname, arg))
+        pos = tpos + tlen
+
+        # an optional or a mandatory argument (no space before it)
+        optargs = []
+        args = []
+        optarg = None
+        if self.s[pos:pos + 1] == '[':
+            optarg = yield self.latex_maybe_optional_arg_routine(pos)
+        if optarg is not None:
+            optargs.append(optarg[0])
+            pos = optarg[1] + optarg[2]
+        elif self.s[pos:pos + 1] == '{':
+            argnode, apos, alen = yield self.latex_braced_group_routine(pos)
+            args.append(argnode)
+            pos = apos + alen
+
+        nodelist, npos, nlen = yield self.latex_nodes_routine(pos, stop_upon_end_environment=environmentname)
+        yield (LatexEnvironmentNode(envname=environmentname, nodelist=nodelist, optargs=optargs, args=args), startpos, npos + nlen - startpos)
+
+    def latex_maybe_optional_arg_routine(self, pos):
+        tok, arg = self.get_token(pos, brackets_are_chars=False, environments=False)[:2]
+        result = None
+        if tok == BRACE_OPEN and arg == '[':
+            result = yield self.latex_braced_group_routine(pos, brace_type='[')
+        yield result
+
+    def latex_expression_routine(self, pos):
+        # macro arguments (strict_braces is off, see LatexWalker.get_latex_expression)
+        while True:
+            tok, arg, tpos, tlen, pre_space, post_space = self.get_token(pos, environments=False, keep_inline_math=False)
+            if tok != COMMENT:
+                break
+            # as LatexWalker (skips tlen from pos, not from tpos)
+            pos = pos + tlen
+        if tok == MACRO:
+            if arg == 'end':
+                if not self.tolerant_parsing:
+                    raise LatexWalkerParseError("Expected expression, got \end", self.s, pos)
+                yield (LatexCharsNode(chars=''), tpos, 0)
+            else:
+                yield (LatexMacroNode(macroname=arg, nodeoptarg=None, nodeargs=[], macro_post_space=post_space), tpos, tlen)
+        elif tok == BRACE_OPEN:
+            result = yield self.latex_braced_group_routine(tpos)
+            yield result
+        elif tok == BRACE_CLOSE:
+            yield (LatexCharsNode(chars=''), tpos, 0)
+        else:
+            yield (LatexCharsNode(chars=arg), tpos, tlen)
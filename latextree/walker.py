@@ -2,6 +2,10 @@
 taxonomy.py 
 Wrappers for the `pylatexenc.latexwalker` parser.
 
+The source is parsed by a front end (see FRONT_ENDS below): pylatexenc's
+LatexWalker or the regular-expression tokenizer of tokenizer.py, which
+produces the same nodes.
+
 The `pylatexenc.latexwalker` package defines six classes of LatexNode objects:
 
 LatexMacroNode
@@ -44,7 +48,7 @@ additional arguments, as opposed to say \begin{tabular}{ccc} or
 \begin{theorem}[pythagoras]. 
 """
 
-import re
+import re, sys
 
 from pylatexenc.latexwalker import (
     LatexEnvironmentNode, 
@@ -64,6 +68,9 @@ log = logging.getLogger(__name__)
 import taxonomy as tax
 import macrosdef
 
+# recursion limit for LatexWalker (enough for a few thousand nested levels)
+PARSE_RECURSION_LIMIT = 10000
+
 def show_node(node, depth=0):
     '''
    Return a nice string representation for debugging (recursive)
@@ -107,32 +114,99 @@ def show_node(node, depth=0):
         print 'NODE TYPE NOT RECOGNISED: %s (%s)' % (str(node), type(node))
         
  
+class NodeRange(object):
+    '''
+    Read-only view of nodelist[start:end], used for the runs of nodes 
+    between \[ and \] (or \itemize and \enditemize) instead of a copy.
+    '''
+    __slots__ = ('nodelist', 'start', 'end')
+
+    def __init__(self, nodelist, start=0, end=None):
+        if end is None:
+            end = len(nodelist)
+        if isinstance(nodelist, NodeRange):
+            start, end = nodelist.start + start, nodelist.start + end
+            nodelist = nodelist.nodelist
+        self.nodelist = nodelist
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self.nodelist[self.start + i] for i in xrange(*idx.indices(len(self)))]
+        if idx < 0:
+            idx = idx + len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError('NodeRange index out of range')
+        return self.nodelist[self.start + idx]
+
+    def __iter__(self):
+        for idx in xrange(self.start, self.end):
+            yield self.nodelist[idx]
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+def get_range(nodelist):
+    '''
+    Returns (list, start, end) for a list or a NodeRange.
+    '''
+    if isinstance(nodelist, NodeRange):
+        return nodelist.nodelist, nodelist.start, nodelist.end
+    return nodelist, 0, len(nodelist)
+
+
+def find_macro(nodelist, start, end, macronames):
+    '''
+    Index of the first macro in nodelist[start:end] whose name is in 
+    macronames, or end if there is none.
+    '''
+    for idx in xrange(start, end):
+        wnode = nodelist[idx]
+        if wnode is not None and wnode.isNodeType(LatexMacroNode) and wnode.macroname in macronames:
+            return idx
+    return end
+
+
+def brace_pair(brace_char):
+    '''
+    Opening and closing delimiters for put_in_braces.
+    '''
+    if brace_char in BRACE_PAIRS:
+        return BRACE_PAIRS[brace_char]
+    return brace_char, brace_char
+
+BRACE_PAIRS = {'{': ('{', '}'), '[': ('[', ']'), '(': ('(', ')'), '<': ('<', '>')}
+
+
 def put_in_braces(brace_char, thestring):
     '''
     Taken from pylatexenc.latexwalker.
     '''
-    if (brace_char == '{'):
-        return '{%s}' %(thestring)
-    if (brace_char == '['):
-        return '[%s]' %(thestring)
-    if (brace_char == '('):
-        return '(%s)' %(thestring)
-    if (brace_char == '<'):
-        return '<%s>' %(thestring)
-    return brace_char + thestring + brace_char
+    opening, closing = brace_pair(brace_char)
+    return opening + thestring + closing
 
 
-def environment_node_to_latex(wnode):
+#------------------------------------------------
+# Serialization
+#
+# The serializers work on an explicit stack of items (no recursion), so
+# that deeply nested node lists do not hit the recursion limit. An item
+# is a string (output) or a tuple (kind, node, kwargs). Math nodes open a
+# new output buffer, which is closed (and post-processed) by a MATH_END item.
+# Output is collected as a list of chunks and joined once (or written to a
+# stream), so serialization takes linear time.
+#------------------------------------------------
+NODE, NODELIST, MATH, MATH_END = range(4)
+
+def expand_environment_node(wnode):
     '''
-    Serialize a LatexEnvionmentNode object back to raw latex.
-    
-    The contents of the environment are contained in wnode.nodelist.
-    We call node_to_latex recursively on these objects in turn.
+    Items for a LatexEnvironmentNode object.
     '''
-
-    if not wnode.isNodeType(LatexEnvironmentNode):
-        raise TypeError("Expected LatexEnvironmentNode type, not `%s'" % type(wnode))
-        
     # crop starred environment names
     envname = wnode.envname[:-1] if wnode.envname[-1]=='*' else wnode.envname
 
@@ -142,58 +216,37 @@ def environment_node_to_latex(wnode):
     # 1. We transfer this environment's nodelist to a new LatexMathMode,
     # 2. then set the 'displaytype' attribute to transmit the environment name
     # This allows us to use math_node_to_latex directly
-    if envname in tax.environments['dispmath']:
+    if envname in tax.environment_sets['dispmath']:
         math_node = LatexMathNode(displaytype=envname, nodelist=wnode.nodelist)
-        return math_node_to_latex(math_node)
+        return [(MATH, math_node, {})]
     
     # opening
-    latex = r'\begin{%s}' % (wnode.envname)
+    items = [r'\begin{%s}' % (wnode.envname)]
     
     # optional arguments
     for optarg in wnode.optargs:
-        latex += put_in_braces('[', node_to_latex(optarg))
+        items.extend(['[', (NODE, optarg, {}), ']'])
     
     # mandatory arguments (curly braces aaargh!)
     for arg in wnode.args:
-        latex += put_in_braces('{', node_to_latex(arg))
+        items.extend(['{', (NODE, arg, {}), '}'])
         
     # contents
-    latex += nodelist_to_latex(wnode.nodelist)
+    items.append((NODELIST, wnode.nodelist, {}))
     
     # closing
-    latex += r'\end{%s}' % (wnode.envname)
-    return latex
+    items.append(r'\end{%s}' % (wnode.envname))
+    return items
 
 
-def macro_node_to_latex(wnode):
+def expand_macro_node(wnode):
     '''
-    Serialize a LatexMacroNode object back to raw latex.
-    
-    The contents of the macro are mostly contained in wnode.nodeargs
-    Some content may be contained in an optional argument nodeoptarg.
-    The macros_dict specifies the correct braces for each macro.
-    These are imported from macrosdef.py
+    Items for a LatexMacroNode object.
     '''
-    
-    if not wnode.isNodeType(LatexMacroNode):
-        raise TypeError("Expected LatexMacroNode object, not `%s'" % type(wnode))
-        
-    # displaymath environment, \[ ... \]
-    # these should no longer get through provided we only use 
-    # nodelist_to_latex when needed. Here the \[ macros are picked up
-    # and shelved until the corresponding \] node is encountered.
-    # The interim nodes are in the meantime converted to latex (recursively).
-    # When the correspoonding \] is reached, a new LatexMathNode object is 
-    # created, its content attribute is set to the recovered text, and its 
-    # displaytype attribute is set to `displaymath`.
-        
     # sanity check
     if wnode.macroname == '[':
         print "THIS SHOULD NOT HAPPEN!"
     
-    # set macro name
-    macroname = wnode.macroname
-
     # define sequence of braces from macro_dict specification
     macro = None
     braces = '{'*len(wnode.nodeargs)
@@ -218,7 +271,7 @@ def macro_node_to_latex(wnode):
         wnode.nodeargs[0] = LatexCharsNode(chars=new_macro_str)
 
     # opening
-    latex = r'\%s' % wnode.macroname
+    items = [r'\%s' % wnode.macroname]
     
     # process optional argument (if any). These also include e.g. \\[2ex]
     # [2ex] is an optional to the \ command (newline) 
@@ -227,55 +280,40 @@ def macro_node_to_latex(wnode):
     # this covers macros of the form \macroname[opt]{man1}{man2} etc
     # macro.numargs is the number of mandatory arguments in this case
     if macro and macro.optarg and wnode.nodeoptarg is not None:
-        latex += put_in_braces('[', node_to_latex(wnode.nodeoptarg))
+        items.extend(['[', (NODE, wnode.nodeoptarg, {}), ']'])
     
     # process mandatory arguments 
     # macro.numargs is the number of mandatory arguments
     # pesky curly-brackets around LatexGroupNode objects
     for idx, arg in enumerate(wnode.nodeargs):
         if arg is not None:
-            latex += put_in_braces(braces[idx], node_to_latex(arg))
+            opening, closing = brace_pair(braces[idx])
+            items.extend([opening, (NODE, arg, {}), closing])
 
-            
-    # closing
-    return latex
+    return items
 
 
-def math_node_to_latex(wnode, **kwargs):
+def expand_math_node(wnode, **kwargs):
     '''
-    Serialize a LatexMathNode object back to raw latex.
-    This deals with internal stuff:
-        subscript (_) and superscript(^) commands
-    
-    Internal environments (e.g. array) will have been parsed by
-    LatexWalker into LatexEnvironmentNode objects:
-        Contents are contained in wnode.nodelist
-        We call node_to_latex recursively on these objects in turn
-        
-    This is not where we deal with \[...\]. These have already been turned
-    into LatexMathNode objects in `parse_nodelist`. 
+    Items for the contents of a LatexMathNode object (the delimiters are 
+    added by finish_math_node).
     '''
-    if (not wnode.isNodeType(LatexMathNode)):
-        raise TypeError("Expected math node, got '%s'" % type(wnode))
-    
-    # init
-    content = ''
-    
-    # iterate over contents
+    items = []
+    nodelist = wnode.nodelist
     idx = 0
-    while idx < len(wnode.nodelist):
-        wnode2 = wnode.nodelist[idx]
+    while idx < len(nodelist):
+        wnode2 = nodelist[idx]
         
         # check for NoneType
         if wnode2 is not None:
             
             # check for subscript and superscript commands (to fix braces problem!)
             if wnode2.isNodeType(LatexCharsNode) and wnode2.chars[-1] in ['_', '^']:
-                content += wnode2.chars
+                items.append(wnode2.chars)
                 
                 # next
-                if idx < len(wnode.nodelist) - 1:
-                    wnode3 = wnode.nodelist[idx+1]
+                if idx < len(nodelist) - 1 and nodelist[idx+1] is not None:
+                    wnode3 = nodelist[idx+1]
                     
                     # put brackets around a group. We should also do it for 
                     # simple macros like \infty so that the latex markup
@@ -283,36 +321,38 @@ def math_node_to_latex(wnode, **kwargs):
                     # need to remove all spaces from within Maths objects!
                     # Pesky curly braces around LatexGroupNode objects part II
                     if wnode3.isNodeType(LatexGroupNode):
-                        content += put_in_braces('{', node_to_latex(wnode3))
+                        items.extend(['{', (NODE, wnode3, {}), '}'])
                         idx = idx + 1
                     
                     elif wnode3.isNodeType(LatexMacroNode):
-                        if 'insert_strict_braces' in kwargs and kwargs['insert_strict_braces']:
-                            content += put_in_braces('{', node_to_latex(wnode3))
+                        if kwargs.get('insert_strict_braces'):
+                            items.extend(['{', (NODE, wnode3, {}), '}'])
                             idx = idx + 1
                     
             # otherwise
             else:
-                content += node_to_latex(wnode2)
+                items.append((NODE, wnode2, {}))
         # next
         idx = idx + 1
+    return items
 
-        # process text        
-        if 'non_breaking_spaces' in kwargs and kwargs['non_breaking_spaces']:
-            content = content.replace(' ', '~')
-
-        if 'insert_strict_braces' in kwargs and kwargs['insert_strict_braces']:
-            content = content.replace(' ', '~')
 
+def finish_math_node(wnode, content, **kwargs):
+    '''
+    Process the text of a LatexMathNode object and add the delimiters.
+    '''
+    # process text        
+    if kwargs.get('non_breaking_spaces') or kwargs.get('insert_strict_braces'):
+        content = content.replace(' ', '~')
     
     # output according to displaytype
     if wnode.displaytype == 'inline':
-        if 'strict_inline_maths' in kwargs and kwargs['strict_inlne_maths']:
+        if kwargs.get('strict_inline_maths'):
             return (r'\(%s\)' % content)
         return (r'$%s$' % content)
     
     elif wnode.displaytype == 'displaymath':
-        if 'strict_display_maths' in kwargs and kwargs['strict_display_maths']:
+        if kwargs.get('strict_display_maths'):
             return (r'\begin{displaymath}%s\end{displaymath}' % content)
         return (r'\[%s\]' % content)
     
@@ -320,89 +360,188 @@ def math_node_to_latex(wnode, **kwargs):
         return (r'\begin{%s}%s\end{%s}' % (wnode.displaytype, content, wnode.displaytype))
 
 
-def node_to_latex(wnode, **kwargs):
+def expand_node(wnode, **kwargs):
     '''
-    Serialize a LatexNode object back to raw latex.
+    Items for a LatexNode object.
     '''
     if wnode.isNodeType(LatexMathNode):
-        return math_node_to_latex(wnode, **kwargs)
+        return [(MATH, wnode, kwargs)]
 
     elif wnode.isNodeType(LatexCharsNode):
-        return wnode.chars
+        return [wnode.chars]
 
     elif wnode.isNodeType(LatexCommentNode):
-        return '%' + wnode.comment + '\n'
+        return ['%' + wnode.comment + '\n']
     
     elif wnode.isNodeType(LatexGroupNode):
         # return put_in_braces('{', nodelist_to_latex(wnode.nodelist))
-        return nodelist_to_latex(wnode.nodelist)
+        return [(NODELIST, wnode.nodelist, {})]
 
     elif wnode.isNodeType(LatexEnvironmentNode):
-        return environment_node_to_latex(wnode)
+        return expand_environment_node(wnode)
 
     elif wnode.isNodeType(LatexMacroNode):
-        return macro_node_to_latex(wnode)
+        return expand_macro_node(wnode)
 
     else:
-        return ''
+        return []
 
 
-def nodelist_to_latex(nodelist, **kwargs):
+def expand_nodelist(nodelist, **kwargs):
     '''
-    Serialize a list of LatexNode objects back to raw latex.
+    Items for a list of LatexNode objects.
     
     We replace a sequence of nodes falling between '\[' and '\]' macros into
-    a single LatexMathNode object, then call node_to_latex on each
-    member of this (possibly reduced) list.
-    
-    Warning. Possible bug in LatexWalker?
-    Creating a new LatexMathNode object as follows:
-        new_math_node = LatexMathNode(displaytype='displaymath")
-    this does not appear to set the new_math_node.nodelist to []
+    a single LatexMathNode object.
     '''
-    idx = 0
-    latex = ''
-    while idx < len(nodelist):
-        if nodelist[idx]:
+    nodelist, idx, end = get_range(nodelist)
+    items = []
+    while idx < end:
+        wnode = nodelist[idx]
+        if wnode:
             
             # check for dispmath environments
-            if nodelist[idx].isNodeType(LatexEnvironmentNode) and nodelist[idx].envname in tax.environments['dispmath']:
+            if wnode.isNodeType(LatexEnvironmentNode) and wnode.envname in tax.environment_sets['dispmath']:
                 new_math_node = LatexMathNode(
-                    displaytype = nodelist[idx].envname,
-                    nodelist = nodelist[idx].nodelist
+                    displaytype = wnode.envname,
+                    nodelist = wnode.nodelist
                 )
-                latex += math_node_to_latex(new_math_node, **kwargs)
+                items.append((MATH, new_math_node, kwargs))
 
             # check for displaymath macro \[
-            elif nodelist[idx].isNodeType(LatexMacroNode) and nodelist[idx].macroname == '[':
-                new_math_node = LatexMathNode(displaytype='displaymath', nodelist=[])
-                while idx < len(nodelist):
-                    idx = idx + 1
-                    if nodelist[idx].isNodeType(LatexMacroNode) and nodelist[idx].macroname == ']':
-                        break
-                    new_math_node.nodelist.append(nodelist[idx])
-                latex += math_node_to_latex(new_math_node, **kwargs)
+            elif wnode.isNodeType(LatexMacroNode) and wnode.macroname == '[':
+                close = find_macro(nodelist, idx + 1, end, [']'])
+                new_math_node = LatexMathNode(displaytype='displaymath', nodelist=NodeRange(nodelist, idx + 1, close))
+                items.append((MATH, new_math_node, kwargs))
+                idx = close
 
             # check for latex mathnode 
-            # we don't need this: it will be caught by the else statement
-            elif nodelist[idx].isNodeType(LatexMathNode):
-                latex += math_node_to_latex(nodelist[idx], **kwargs)
+            elif wnode.isNodeType(LatexMathNode):
+                items.append((MATH, wnode, kwargs))
 
             # check for LatexGroupNode
-            # we don't need this: it will be caught by the else statement
-            elif nodelist[idx].isNodeType(LatexGroupNode):
-                latex += put_in_braces('{', nodelist_to_latex(nodelist[idx].nodelist))
+            elif wnode.isNodeType(LatexGroupNode):
+                items.extend(['{', (NODELIST, wnode.nodelist, {}), '}'])
 
             # everything else
             else:
-                latex += node_to_latex(nodelist[idx], **kwargs)
+                items.append((NODE, wnode, kwargs))
 
         idx = idx + 1
 
-    return latex
+    return items
+
+
+def serialize(items, stream=None):
+    '''
+    Concatenate the output of a list of items (see above). If stream (a
+    file-like object) is given, the output is written to it instead and
+    None is returned (math nodes are written when they are complete).
+    '''
+    buffers = [[]]
+    work = list(reversed(items))
+    while work:
+        item = work.pop()
+        if isinstance(item, basestring):
+            buffers[-1].append(item)
+        else:
+            kind, wnode, kwargs = item
+            if kind == NODE:
+                work.extend(reversed(expand_node(wnode, **kwargs)))
+            elif kind == NODELIST:
+                work.extend(reversed(expand_nodelist(wnode, **kwargs)))
+            elif kind == MATH:
+                buffers.append([])
+                work.append((MATH_END, wnode, kwargs))
+                work.extend(reversed(expand_math_node(wnode, **kwargs)))
+            else:
+                content = ''.join(buffers.pop())
+                buffers[-1].append(finish_math_node(wnode, content, **kwargs))
+        if stream is not None and len(buffers) == 1 and buffers[0]:
+            stream.writelines(buffers[0])
+            del buffers[0][:]
+    if stream is None:
+        return ''.join(buffers[0])
+
+
+def environment_node_to_latex(wnode, stream=None):
+    '''
+    Serialize a LatexEnvionmentNode object back to raw latex.
+    
+    The contents of the environment are contained in wnode.nodelist.
+    '''
+    if not wnode.isNodeType(LatexEnvironmentNode):
+        raise TypeError("Expected LatexEnvironmentNode type, not `%s'" % type(wnode))
+    return serialize(expand_environment_node(wnode), stream=stream)
+
+
+def macro_node_to_latex(wnode, stream=None):
+    '''
+    Serialize a LatexMacroNode object back to raw latex.
+    
+    The contents of the macro are mostly contained in wnode.nodeargs
+    Some content may be contained in an optional argument nodeoptarg.
+    The macros_dict specifies the correct braces for each macro.
+    These are imported from macrosdef.py
+    '''
+    if not wnode.isNodeType(LatexMacroNode):
+        raise TypeError("Expected LatexMacroNode object, not `%s'" % type(wnode))
+    return serialize(expand_macro_node(wnode), stream=stream)
+
+
+def math_node_to_latex(wnode, stream=None, **kwargs):
+    '''
+    Serialize a LatexMathNode object back to raw latex.
+    This deals with internal stuff:
+        subscript (_) and superscript(^) commands
+    
+    Internal environments (e.g. array) will have been parsed by
+    LatexWalker into LatexEnvironmentNode objects:
+        Contents are contained in wnode.nodelist
+        
+    This is not where we deal with \[...\]. These have already been turned
+    into LatexMathNode objects in `parse_nodelist`. 
+    '''
+    if (not wnode.isNodeType(LatexMathNode)):
+        raise TypeError("Expected math node, got '%s'" % type(wnode))
+    return serialize([(MATH, wnode, kwargs)], stream=stream)
+
+
+def node_to_latex(wnode, stream=None, **kwargs):
+    '''
+    Serialize a LatexNode object back to raw latex.
+    '''
+    return serialize([(NODE, wnode, kwargs)], stream=stream)
+
+
+def nodelist_to_latex(nodelist, stream=None, **kwargs):
+    '''
+    Serialize a list of LatexNode objects back to raw latex.
+    
+    We replace a sequence of nodes falling between '\[' and '\]' macros into
+    a single LatexMathNode object, then serialize each member of this 
+    (possibly reduced) list.
+
+    All of the *_to_latex functions return a string, or write the latex to
+    stream (a file-like object) if given.
+    >>> nodelist_to_latex(parse(text), stream=sys.stdout)
+    '''
+    return serialize([(NODELIST, nodelist, kwargs)], stream=stream)
             
     
-def parse(text, **kwargs):
+#------------------------------------------------
+# Front ends
+#
+# A front end turns latex source into a list of LatexNode objects (the
+# pylatexenc node classes). LatexParser only depends on these nodes, so
+# front ends can be swapped:
+#     pylatexenc - pylatexenc's LatexWalker
+#     regex - tokenizer.LatexTokenizer (same nodes, compiled regular
+#             expressions, no recursion)
+# Use parse(text, front_end='pylatexenc') or LatexParser(front_end=...) to
+# choose one; register_front_end adds others.
+#------------------------------------------------
+def parse_pylatexenc(text, **kwargs):
     '''
     A wrapper for LatexWalker.get_latex_nodes()
     Returns a list of LatexNodes
@@ -412,11 +551,54 @@ def parse(text, **kwargs):
     LatexWalker does not parse displaymath environments
         \[ and \] are parsed as zero-argument macros
         \begin{equation}...\end{equation} is completely parsed like any other environment
-    '''
 
-    walker = LatexWalker(text, macro_dict=macrosdef.macro_dict, keep_inline_math=True)
-    nodes = walker.get_latex_nodes()[0]
+    LatexWalker parses groups and environments recursively (about three
+    frames per level), so the recursion limit is raised to PARSE_RECURSION_LIMIT
+    while it runs.
+    '''
+    limit = sys.getrecursionlimit()
+    if limit < PARSE_RECURSION_LIMIT:
+        sys.setrecursionlimit(PARSE_RECURSION_LIMIT)
+    try:
+        walker = LatexWalker(text, macro_dict=macrosdef.macro_dict, keep_inline_math=True)
+        nodes = walker.get_latex_nodes()[0]
+    finally:
+        sys.setrecursionlimit(limit)
     return nodes
+
+
+def parse_regex(text, **kwargs):
+    '''
+    Parse with the regular-expression tokenizer (see tokenizer.py).
+    Returns the same list of LatexNodes as parse_pylatexenc.
+    '''
+    from tokenizer import LatexTokenizer
+    tokenizer = LatexTokenizer(text, macro_dict=macrosdef.macro_dict, keep_inline_math=True)
+    return tokenizer.get_latex_nodes()[0]
+
+
+FRONT_ENDS = {
+    'pylatexenc': parse_pylatexenc,
+    'regex': parse_regex,
+}
+DEFAULT_FRONT_END = 'regex'
+
+def register_front_end(name, front_end):
+    '''
+    Make front_end(text, **kwargs) available as parse(text, front_end=name).
+    '''
+    FRONT_ENDS[name] = front_end
+
+
+def parse(text, front_end=None, **kwargs):
+    '''
+    Parse latex source into a list of LatexNodes with the given front end
+    (by default DEFAULT_FRONT_END).
+    '''
+    name = front_end or DEFAULT_FRONT_END
+    if name not in FRONT_ENDS:
+        raise ValueError("Unknown front end `%s'" % name)
+    return FRONT_ENDS[name](text, **kwargs)
    
 
 #------------------------------------------------